@@ -0,0 +1,254 @@
+"""
+Micro-benchmarks of the serializers and of in-process view dispatch, run by
+the benchmark_serializers command
+
+Each benchmark is timed for several object counts. Results are kept as JSON
+so a run can be compared against the previous one.
+"""
+
+import base64
+import io
+import json
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from rest_framework.authtoken.models import Token
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from dark_maps.api.v1.models import Device, PreKey, SignedPreKey, Message
+from dark_maps.api.v1.renderers import ORJSONRenderer, ORJSONParser
+from dark_maps.api.v1.serializers import MessageSerializer, MessageV2Serializer, PreKeyBundleSerializer, DeviceSerializer, PreKeySerializer
+from dark_maps.api.v1.serializers import message_columns, represent_messages, represent_prekey_bundle
+
+SIZES = (1, 100, 10000)
+# Each timing repeats the benchmark until about this many objects have been
+# handled, calling it at most CALLS_PER_TIMING times, or REQUESTS_PER_TIMING for views
+OBJECTS_PER_TIMING = 10000
+CALLS_PER_TIMING = 1000
+REQUESTS_PER_TIMING = 100
+# Prekeys stocked for the bundle benchmark to claim while it is timed
+PREKEYS_CLAIMED = 1000
+
+IDENTITY_KEY = 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+SIGNATURE = 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+CONTENT = json.dumps({'registration_id': 1234, 'content': base64.b64encode(bytes(200)).decode()})
+
+
+class Fixture:
+    """A sender and a recipient with a registered device each, created in the database"""
+
+    def __init__(self):
+        User = get_user_model()
+        self.sender = User.objects.create_user(email='benchmark-sender@example.com', password='benchmark')
+        self.sender_device = self.create_device(self.sender, 1234)
+        self.recipient = User.objects.create_user(email='benchmark-recipient@example.com', password='benchmark')
+        self.recipient_device = self.create_device(self.recipient, 5678)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=self.recipient).key}")
+        self.sender_client = APIClient()
+        self.sender_client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=self.sender).key}")
+
+    @staticmethod
+    def create_device(user, registration_id):
+        device = Device.objects.create(user=user, address=f'{user.email}.1', identity_key=IDENTITY_KEY, registration_id=registration_id)
+        SignedPreKey.objects.create(device=device, key_id=1, public_key=IDENTITY_KEY, signature=SIGNATURE)
+        return device
+
+    def messages(self, count, ciphertext=False):
+        """Unsaved messages to the recipient"""
+        return [
+            Message(
+                id=x,
+                recipient=self.recipient_device,
+                content='' if ciphertext else CONTENT,
+                ciphertext=bytes(200) if ciphertext else None,
+                sender_registration_id=1234,
+                sender_address=self.sender_device.address
+            )
+            for x in range(1, count + 1)
+        ]
+
+    def fill_inbox(self, count):
+        Message.objects.filter(recipient=self.recipient_device).delete()
+        Message.objects.bulk_create(self.messages(count, ciphertext=True))
+
+
+def message_serialize(fixture, size):
+    messages = fixture.messages(size)
+    return lambda: MessageSerializer(messages, many=True).data
+
+def message_v2_serialize(fixture, size):
+    messages = fixture.messages(size, ciphertext=True)
+    return lambda: MessageV2Serializer(messages, many=True).data
+
+def message_represent(fixture, size):
+    rows = [message_columns(message) for message in fixture.messages(size)]
+    return lambda: represent_messages(rows, fixture.recipient_device)
+
+def message_v2_represent(fixture, size):
+    rows = [message_columns(message) for message in fixture.messages(size, ciphertext=True)]
+    return lambda: represent_messages(rows, fixture.recipient_device, 2)
+
+def message_validate(fixture, size):
+    data = [{'content': CONTENT, 'sender_address': fixture.sender_device.address, 'sender_registration_id': 1234}] * size
+    return lambda: MessageSerializer(data=data, many=True).is_valid(raise_exception=True)
+
+def prekey_bundle_serialize(fixture, size):
+    device = fixture.recipient_device
+    bundles = [
+        {
+            'address': device.address,
+            'identity_key': device.identity_key,
+            'registration_id': device.registration_id,
+            'signed_pre_key': device.signedprekey,
+            'pre_key': PreKey(key_id=x, public_key=IDENTITY_KEY)
+        }
+        for x in range(size)
+    ]
+    return lambda: PreKeyBundleSerializer(bundles, many=True).data
+
+def prekey_bundle_represent(fixture, size):
+    device = fixture.recipient_device
+    pre_keys = [PreKey(key_id=x, public_key=IDENTITY_KEY) for x in range(size)]
+    return lambda: [represent_prekey_bundle(device, device.signedprekey, pre_key) for pre_key in pre_keys]
+
+def prekey_serialize(fixture, size):
+    pre_keys = [PreKey(key_id=x, public_key=IDENTITY_KEY) for x in range(size)]
+    return lambda: PreKeySerializer(pre_keys, many=True).data
+
+def prekey_validate(fixture, size):
+    data = [{'key_id': x, 'public_key': IDENTITY_KEY} for x in range(size)]
+    return lambda: PreKeySerializer(data=data, many=True, context={'device': fixture.recipient_device}).is_valid(raise_exception=True)
+
+def device_validate(fixture, size):
+    # Includes the query checking each address is free
+    data = [
+        {
+            'address': f'benchmark-{x}@example.com.1',
+            'identity_key': IDENTITY_KEY,
+            'registration_id': x,
+            'pre_keys': [{'key_id': 1, 'public_key': IDENTITY_KEY}],
+            'signed_pre_key': {'key_id': 1, 'public_key': IDENTITY_KEY, 'signature': SIGNATURE}
+        }
+        for x in range(size)
+    ]
+    return lambda: DeviceSerializer(data=data, many=True).is_valid(raise_exception=True)
+
+def inbox_render(renderer_class):
+    def setup(fixture, size):
+        rows = [message_columns(message) for message in fixture.messages(size, ciphertext=True)]
+        data = {'results': represent_messages(rows, fixture.recipient_device, 2), 'next': None}
+        renderer = renderer_class()
+        return lambda: renderer.render(data, 'application/json')
+    return setup
+
+def prekeys_parse(parser_class):
+    def setup(fixture, size):
+        body = json.dumps([{'key_id': x, 'public_key': IDENTITY_KEY} for x in range(size)]).encode()
+        parser = parser_class()
+        return lambda: parser.parse(io.BytesIO(body), 'application/json', {'encoding': 'utf-8'})
+    return setup
+
+def view_messages_get(fixture, size):
+    fixture.fill_inbox(size)
+    return lambda: _expect(fixture.client.get('/v1/5678/messages/?envelope=2'), 200)
+
+def view_messages_post(fixture, size):
+    # Every call stores one message, so the size is the recipient's inbox
+    fixture.fill_inbox(size)
+    body = {'recipient': fixture.recipient.email, 'registration_id': 5678, 'ciphertext': base64.b64encode(bytes(200)).decode()}
+    return lambda: _expect(fixture.sender_client.post('/v1/1234/messages/', body, format='json'), 201)
+
+def view_prekey_bundle_get(fixture, size):
+    # Each call claims a prekey, the size is how many the recipient has stocked
+    # beyond those claimed while timing
+    PreKey.objects.filter(device=fixture.recipient_device).delete()
+    PreKey.objects.bulk_create([PreKey(device=fixture.recipient_device, key_id=x, public_key=IDENTITY_KEY) for x in range(size + PREKEYS_CLAIMED)])
+    url = f"/v1/prekeybundles/{fixture.recipient_device.address.encode().hex()}/1234/"
+    return lambda: _expect(fixture.sender_client.get(url), 200)
+
+def _expect(response, status_code):
+    if response.status_code != status_code:
+        raise AssertionError(f"Expected HTTP {status_code}, received {response.status_code}: {response.content[:200]}")
+    return response
+
+
+# Name, setup returning the function to time, whether the size is the number
+# of objects handled by each call, and whether each call is a request
+BENCHMARKS = (
+    ('MessageSerializer.serialize', message_serialize, True, False),
+    ('MessageV2Serializer.serialize', message_v2_serialize, True, False),
+    ('represent_messages', message_represent, True, False),
+    ('represent_messages v2', message_v2_represent, True, False),
+    ('MessageSerializer.validate', message_validate, True, False),
+    ('PreKeyBundleSerializer.serialize', prekey_bundle_serialize, True, False),
+    ('represent_prekey_bundle', prekey_bundle_represent, True, False),
+    ('PreKeySerializer.serialize', prekey_serialize, True, False),
+    ('PreKeySerializer.validate', prekey_validate, True, False),
+    ('DeviceSerializer.validate', device_validate, True, False),
+    ('JSONRenderer inbox', inbox_render(JSONRenderer), True, False),
+    ('ORJSONRenderer inbox', inbox_render(ORJSONRenderer), True, False),
+    ('JSONParser prekeys', prekeys_parse(JSONParser), True, False),
+    ('ORJSONParser prekeys', prekeys_parse(ORJSONParser), True, False),
+    ('GET messages', view_messages_get, True, True),
+    ('POST message', view_messages_post, False, True),
+    ('GET prekey bundle', view_prekey_bundle_get, False, True),
+)
+
+
+def time_call(function, calls, repeat):
+    """Returns the time of each of `repeat` timings of `calls` calls, divided by `calls`"""
+    timings = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        for _ in range(calls):
+            function()
+        timings.append((time.perf_counter() - tic) / calls)
+    return timings
+
+
+def run(sizes=SIZES, repeat=5, names=None, fixture=None):
+    """
+    Times every benchmark, or those in `names`, at each size. Needs a database
+    it may write to. Returns {name: {size: result}} with times in seconds.
+    """
+    fixture = fixture or Fixture()
+    results = {}
+    for name, setup, per_object, request in BENCHMARKS:
+        if (names is not None) and (name not in names):
+            continue
+        results[name] = {}
+        for size in sizes:
+            function = setup(fixture, size)
+            # Warm up, then time enough calls for the result to be stable
+            function()
+            calls = (OBJECTS_PER_TIMING // size) if per_object else OBJECTS_PER_TIMING
+            calls = max(1, min(calls, REQUESTS_PER_TIMING if request else CALLS_PER_TIMING))
+            timings = time_call(function, calls, repeat)
+            # The fastest timing is the least disturbed by the rest of the machine
+            best = min(timings)
+            results[name][str(size)] = {
+                'calls': calls,
+                'repeat': repeat,
+                'best': best,
+                'median': statistics.median(timings),
+                'per_object': (best / size) if per_object else best,
+            }
+    return results
+
+
+def compare(previous, current, tolerance):
+    """
+    Returns (name, size, previous best, current best) for every result more
+    than `tolerance` (a fraction) slower than in the previous run
+    """
+    regressions = []
+    for name, sizes in current.items():
+        for size, result in sizes.items():
+            before = previous.get(name, {}).get(size)
+            if (before is not None) and (result['best'] > before['best'] * (1 + tolerance)):
+                regressions.append((name, size, before['best'], result['best']))
+    return regressions
@@ -0,0 +1,84 @@
+"""
+Times the serializers and in-process view dispatch against a throwaway test
+database, and compares the results with the previous run
+"""
+
+import json
+import os
+import platform
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from benchmarks import serializers as benchmarks
+
+# Kept beside the benchmarks and ignored by git
+RESULTS = os.path.join(os.path.dirname(benchmarks.__file__), 'results.json')
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the serializers and views, flagging results slower than the previous run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=list(benchmarks.SIZES), help="Object counts to time each benchmark with")
+        parser.add_argument('--repeat', type=int, default=5, help="Timings taken of each benchmark, the fastest is reported")
+        parser.add_argument('--benchmark', action='append', dest='names', help="Only run this benchmark, may be given more than once")
+        parser.add_argument('--results', default=RESULTS, help="JSON file holding the previous run, replaced by this run's results")
+        parser.add_argument('--tolerance', type=float, default=0.25, help="Fraction slower than the previous run before a result is flagged")
+        parser.add_argument('--no-save', action='store_true', help="Compare with the previous run without replacing it")
+        parser.add_argument('--check', action='store_true', help="Exit with an error if any result is flagged")
+
+    def handle(self, *args, **options):
+        previous = {}
+        if os.path.exists(options['results']):
+            with open(options['results']) as f:
+                previous = json.load(f)['results']
+
+        results = self.run(options['sizes'], options['repeat'], options['names'])
+        regressions = benchmarks.compare(previous, results, options['tolerance'])
+        self.report(previous, results, regressions)
+
+        if not options['no_save']:
+            with open(options['results'], 'w') as f:
+                json.dump({
+                    'created': datetime.now(tz=timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'database': connection.vendor,
+                    'results': results,
+                }, f, indent=2)
+        if regressions and options['check']:
+            raise CommandError(f"{len(regressions)} results are more than {options['tolerance']:.0%} slower than the previous run")
+
+    def run(self, sizes, repeat, names):
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            return benchmarks.run(sizes=sizes, repeat=repeat, names=names)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def report(self, previous, results, regressions):
+        flagged = {(name, size) for name, size, _, _ in regressions}
+        self.stdout.write(f"{'benchmark':<34}{'size':>7}{'best':>12}{'per object':>12}{'previous':>12}{'change':>9}")
+        for name, sizes in results.items():
+            for size, result in sizes.items():
+                before = previous.get(name, {}).get(size)
+                line = f"{name:<34}{size:>7}{self.duration(result['best']):>12}{self.duration(result['per_object']):>12}"
+                if before is not None:
+                    line += f"{self.duration(before['best']):>12}{result['best'] / before['best'] - 1:>+9.0%}"
+                if (name, size) in flagged:
+                    self.stdout.write(self.style.ERROR(f"{line}  slower"))
+                else:
+                    self.stdout.write(line)
+
+    @staticmethod
+    def duration(seconds):
+        if seconds >= 1:
+            return f"{seconds:.2f}s"
+        if seconds >= 0.001:
+            return f"{seconds * 1000:.2f}ms"
+        return f"{seconds * 1000000:.1f}us"
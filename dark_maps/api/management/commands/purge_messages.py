@@ -0,0 +1,45 @@
+"""
+Deletes messages older than the retention period or past their TTL. Run once
+from a scheduler, or with --forever as a worker process.
+"""
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from dark_maps.api.v1.models import Message
+
+
+class Command(BaseCommand):
+    help = "Deletes expired messages in small batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.MESSAGE_PURGE_BATCH_SIZE, help="Most messages deleted in one transaction")
+        parser.add_argument('--pause', type=float, default=settings.MESSAGE_PURGE_PAUSE, help="Seconds to wait between batches")
+        parser.add_argument('--forever', action='store_true', help="Keep purging, sleeping --interval seconds once nothing is left")
+        parser.add_argument('--interval', type=float, default=60, help="Seconds to sleep between runs with --forever")
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = self.purge(options['batch_size'], options['pause'])
+            self.stdout.write(f"Deleted {deleted} expired messages")
+            if not options['forever']:
+                return
+            time.sleep(options['interval'])
+
+    def purge(self, batch_size, pause):
+        created_before = None
+        if settings.MESSAGE_RETENTION_DAYS > 0:
+            created_before = timezone.now() - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
+        total = 0
+        while True:
+            deleted = Message.objects.purge_expired(created_before, batch_size)
+            total += deleted
+            if deleted == 0:
+                return total
+            if deleted == batch_size:
+                # Let replicas catch up and other writers in between full batches
+                time.sleep(pause)
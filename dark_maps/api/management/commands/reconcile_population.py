@@ -0,0 +1,27 @@
+"""
+Recounts the population totals, run periodically to correct any drift. Run
+once from a scheduler, or with --forever as a worker process.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from dark_maps.api.v1 import population
+
+
+class Command(BaseCommand):
+    help = "Recounts users, devices, queued messages and stocked prekeys and stores the totals"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--forever', action='store_true', help="Keep recounting, sleeping --interval seconds between runs")
+        parser.add_argument('--interval', type=float, default=3600, help="Seconds to sleep between runs with --forever")
+
+    def handle(self, *args, **options):
+        while True:
+            totals = population.reconcile()
+            for name, value in totals.items():
+                self.stdout.write(f"{name}: {value}")
+            if not options['forever']:
+                return
+            time.sleep(options['interval'])
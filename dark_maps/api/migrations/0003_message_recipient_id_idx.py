@@ -0,0 +1,17 @@
+# Generated by Django 3.2.4 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_auto_20201219_0831'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['recipient', 'id'], name='message_recipient_id_idx'),
+        ),
+    ]
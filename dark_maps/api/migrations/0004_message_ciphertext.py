@@ -0,0 +1,23 @@
+# Generated by Django 3.2.4 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_message_recipient_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='ciphertext',
+            field=models.BinaryField(max_length=750, null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.CharField(blank=True, max_length=1000),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Converts stored version 1 messages to the version 2 format
+
+import base64
+import binascii
+import json
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def pack_content(content, registration_id):
+    """
+    Returns the raw ciphertext of a version 1 message, or None if the message
+    holds anything that could not be rebuilt from the ciphertext and the
+    recipient's registration ID
+    """
+    try:
+        parsed = json.loads(content)
+    except ValueError:
+        return None
+    if not (isinstance(parsed, dict) and (set(parsed) == {'registration_id', 'content'})):
+        return None
+    if (parsed['registration_id'] != registration_id) or (not isinstance(parsed['content'], str)):
+        return None
+    # Version 1 readers are sent the string rebuilt as below, so only convert
+    # messages stored exactly as it would be rebuilt
+    if json.dumps({'registration_id': registration_id, 'content': parsed['content']}) != content:
+        return None
+    try:
+        ciphertext = base64.b64decode(parsed['content'], validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    if base64.b64encode(ciphertext).decode() != parsed['content']:
+        return None
+    return ciphertext
+
+
+def pack_messages(apps, schema_editor):
+    Message = apps.get_model('api', 'Message')
+    last_id = 0
+    while True:
+        rows = list(
+            Message.objects.filter(id__gt=last_id, ciphertext__isnull=True)
+            .order_by('id')
+            .values_list('id', 'content', 'recipient__registration_id')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        for message_id, content, registration_id in rows:
+            ciphertext = pack_content(content, registration_id)
+            if ciphertext is not None:
+                Message.objects.filter(id=message_id).update(content='', ciphertext=ciphertext)
+        last_id = rows[-1][0]
+
+
+def unpack_messages(apps, schema_editor):
+    Message = apps.get_model('api', 'Message')
+    rows = Message.objects.filter(ciphertext__isnull=False).values_list('id', 'ciphertext', 'recipient__registration_id')
+    for message_id, ciphertext, registration_id in rows.iterator():
+        content = json.dumps({'registration_id': registration_id, 'content': base64.b64encode(bytes(ciphertext)).decode()})
+        Message.objects.filter(id=message_id).update(content=content, ciphertext=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_message_ciphertext'),
+    ]
+
+    operations = [
+        migrations.RunPython(pack_messages, unpack_messages),
+    ]
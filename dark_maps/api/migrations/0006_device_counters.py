@@ -0,0 +1,38 @@
+# Generated by Django 3.2.4 on 2026-10-18 12:44
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_existing(apps, schema_editor):
+    Device = apps.get_model('api', 'Device')
+    PreKey = apps.get_model('api', 'PreKey')
+    Message = apps.get_model('api', 'Message')
+    prekeys = PreKey.objects.filter(device=OuterRef('pk')).order_by().values('device').annotate(count=Count('id')).values('count')
+    messages = Message.objects.filter(recipient=OuterRef('pk')).order_by().values('recipient').annotate(count=Count('id')).values('count')
+    Device.objects.update(
+        prekey_count=Coalesce(Subquery(prekeys), 0),
+        inbox_count=Coalesce(Subquery(messages), 0)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_pack_message_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='inbox_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='prekey_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.4 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+from dark_maps.api.migration_operations import AddIndexWithoutLocking
+
+
+class Migration(migrations.Migration):
+
+    # Indexes cannot be built concurrently inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0007_denied_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='expires',
+            field=models.DateTimeField(null=True),
+        ),
+        AddIndexWithoutLocking(
+            model_name='message',
+            index=models.Index(fields=['created'], name='message_created_idx'),
+        ),
+        AddIndexWithoutLocking(
+            model_name='message',
+            index=models.Index(condition=models.Q(('expires__isnull', False)), fields=['expires'], name='message_expires_idx'),
+        ),
+    ]
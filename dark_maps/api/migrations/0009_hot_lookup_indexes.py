@@ -0,0 +1,36 @@
+# Generated by Django 3.2.4 on 2026-10-18 13:14
+
+from django.db import migrations, models
+
+from dark_maps.api.migration_operations import AddIndexWithoutLocking, AddUniqueConstraintWithoutLocking
+
+
+class Migration(migrations.Migration):
+
+    # Indexes cannot be built concurrently inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0008_message_expiry'),
+    ]
+
+    operations = [
+        # Addresses were only unique per user, fails if two devices share an address
+        AddUniqueConstraintWithoutLocking(
+            model_name='device',
+            constraint=models.UniqueConstraint(fields=('address',), name='unique_device_address'),
+        ),
+        # Covered by the address constraint as each user has at most one device
+        migrations.AlterUniqueTogether(
+            name='device',
+            unique_together=set(),
+        ),
+        AddIndexWithoutLocking(
+            model_name='message',
+            index=models.Index(fields=['recipient', 'created'], name='message_recipient_created_idx'),
+        ),
+        AddIndexWithoutLocking(
+            model_name='prekey',
+            index=models.Index(fields=['device', 'id'], name='prekey_device_id_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.4 on 2026-10-18 14:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def count_population(apps, schema_editor):
+    """Starts the totals from the current counts, as reconcile_population would"""
+    totals = {
+        'users': apps.get_model(settings.AUTH_USER_MODEL).objects.count(),
+        'devices': apps.get_model('api', 'Device').objects.count(),
+        'messages': apps.get_model('api', 'Message').objects.count(),
+        'prekeys': apps.get_model('api', 'PreKey').objects.count(),
+    }
+    PopulationTotal = apps.get_model('api', 'PopulationTotal')
+    PopulationTotal.objects.bulk_create([PopulationTotal(name=name, value=value) for name, value in totals.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0010_signed_token_cutoff'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopulationTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=16, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_population, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+"""
+Token authentication which loads the user's device with the token and keeps
+both in the cache for a short time
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from dark_maps.api.v1.models import Device
+
+# Counters change with every message and prekey, they are left out of cached
+# devices and loaded from the database only when read
+VOLATILE_DEVICE_FIELDS = ('prekey_count', 'inbox_count')
+
+def _key(token_key):
+    return f"auth_token:{hashlib.sha256(token_key.encode()).hexdigest()}"
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Resolves token, user and device in one query. The result is cached for
+    AUTH_TOKEN_CACHE_TIMEOUT seconds and removed when the token is deleted,
+    for example on logout, or when the user or their device changes.
+    """
+
+    def authenticate_credentials(self, key):
+        token = cache.get(_key(key))
+        if token is None:
+            try:
+                token = Token.objects.select_related('user__device').get(key=key)
+            except Token.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            self._cache(token)
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        return (token.user, token)
+
+    @staticmethod
+    def _cache(token):
+        device = getattr(token.user, 'device', None)
+        counters = {}
+        if device is not None:
+            counters = {field: device.__dict__.pop(field) for field in VOLATILE_DEVICE_FIELDS}
+        try:
+            cache.set(_key(token.key), token, settings.AUTH_TOKEN_CACHE_TIMEOUT)
+        finally:
+            if device is not None:
+                device.__dict__.update(counters)
+
+def invalidate_user(user_id):
+    """Removes the cached authentication of every token the user holds"""
+    keys = Token.objects.filter(user_id=user_id).values_list('key', flat=True)
+    cache.delete_many([_key(key) for key in keys])
+
+@receiver(post_delete, sender=Token)
+def token_deleted_callback(sender, instance, **kwargs):
+    cache.delete(_key(instance.key))
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved_callback(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_user(instance.pk)
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def device_changed_callback(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
@@ -0,0 +1,68 @@
+"""
+Caches the details needed to address a device, keyed by email and by address
+"""
+
+import hashlib
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from dark_maps.api.v1.instrumentation import record_cache
+from dark_maps.api.v1.models import Device
+
+class DirectoryEntry(namedtuple('DirectoryEntry', ['device_id', 'registration_id', 'address', 'identity_key'])):
+    __slots__ = ()
+
+    def as_device(self):
+        """Returns a Device usable as a foreign key target without loading it"""
+        device = Device(id=self.device_id, registration_id=self.registration_id, address=self.address, identity_key=self.identity_key)
+        device._state.adding = False
+        device._state.db = 'default'
+        return device
+
+def _key(kind, value):
+    return f"device_directory:{kind}:{hashlib.md5(value.encode()).hexdigest()}"
+
+def _lookup(kind, value, cached, **filters):
+    """
+    Entries are removed when the device changes, but only from the cache of the
+    process making the change. DEVICE_DIRECTORY_TIMEOUT bounds how long other
+    processes may see a deleted or registered again device when the cache is
+    not shared, callers pass cached=False to read it afresh when in doubt.
+    """
+    key = _key(kind, value)
+    timeout = settings.DEVICE_DIRECTORY_TIMEOUT
+    if cached and (timeout > 0):
+        entry = cache.get(key)
+        record_cache(entry is not None)
+        if entry is not None:
+            return DirectoryEntry(*entry)
+    row = Device.objects.filter(**filters).values_list('id', 'registration_id', 'address', 'identity_key').first()
+    if row is None:
+        cache.delete(key)
+        return None
+    if timeout > 0:
+        cache.set(key, tuple(row), timeout)
+    return DirectoryEntry(*row)
+
+def get_by_email(email, cached=True):
+    """Returns the DirectoryEntry for the device owned by the user with this email, or None"""
+    return _lookup('email', email, cached, user__email=email)
+
+def get_by_address(address, cached=True):
+    """Returns the DirectoryEntry for the device with this address, or None"""
+    return _lookup('address', address, cached, address=address)
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def device_changed_callback(sender, instance, **kwargs):
+    keys = [_key('address', instance.address)]
+    try:
+        keys.append(_key('email', instance.user.email))
+    except Exception:
+        # Fall back to the email the address was built from
+        keys.append(_key('email', instance.address.rpartition('.')[0]))
+    cache.delete_many(keys)
@@ -1,65 +1,96 @@
 """
 Global error definitions
+
+Each error builds a new Response, a Response is rendered once in the format
+negotiated for its first request so it cannot be shared between requests
 """
 
 from rest_framework import status
 from rest_framework.response import Response
 
-no_user = Response({
-    "code": "no_user",
-    "message": "User does not exist"
-}, status=status.HTTP_400_BAD_REQUEST)
-
-no_device = Response({
-    "code": "no_device",
-    "message": "User has not yet registered a device"
-}, status=status.HTTP_404_NOT_FOUND)
-
-no_recipient_user = Response({
-    "code": "no_recipient_user",
-    "message": "Recipient does not exist"
-}, status=status.HTTP_404_NOT_FOUND)
-
-no_recipient_device = Response({
-    "code": "no_recipient_device",
-    "message": "Recipient has not yet registered a device"
-}, status=status.HTTP_404_NOT_FOUND)
-
-device_exists = Response({
-    "code": "device_exists",
-    "message": "A device has already been created for this user"
-}, status=status.HTTP_403_FORBIDDEN)
-
-device_changed = Response({
-    "code": "device_changed",
-    "message": "Own device has changed"
-}, status=status.HTTP_403_FORBIDDEN)
-
-recipient_identity_changed = Response({
-    "code": "recipient_identity_changed",
-    "message": "Recipients device has changed"
-}, status=status.HTTP_403_FORBIDDEN)
-
-reached_max_prekeys = Response({
-    "code": "reached_max_prekeys",
-    "message": "User has reached the maximum number of prekeys allowed"
-}, status=status.HTTP_400_BAD_REQUEST)
-
-prekey_id_exists = Response({
-    "code": "prekey_id_exists",
-    "message": "A prekey with that key_id already exists"
-}, status=status.HTTP_400_BAD_REQUEST)
-
-invalid_recipient_email = Response({
-    "code": "invalid_recipient_email",
-    "message": "The email provided for the recipient is incorrectly formatted"
-}, status=status.HTTP_400_BAD_REQUEST)
-
-error_incrementing = Response({
-    "code": "error_incrementing",
-    "message": "There was an error incrementing the signing counter"
-}, status=status.HTTP_400_BAD_REQUEST)
+def no_user():
+    return Response({
+        "code": "no_user",
+        "message": "User does not exist"
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+def no_device():
+    return Response({
+        "code": "no_device",
+        "message": "User has not yet registered a device"
+    }, status=status.HTTP_404_NOT_FOUND)
+
+def no_recipient_user():
+    return Response({
+        "code": "no_recipient_user",
+        "message": "Recipient does not exist"
+    }, status=status.HTTP_404_NOT_FOUND)
+
+def no_recipient_device():
+    return Response({
+        "code": "no_recipient_device",
+        "message": "Recipient has not yet registered a device"
+    }, status=status.HTTP_404_NOT_FOUND)
+
+def device_exists():
+    return Response({
+        "code": "device_exists",
+        "message": "A device has already been created for this user"
+    }, status=status.HTTP_403_FORBIDDEN)
+
+def device_changed():
+    return Response({
+        "code": "device_changed",
+        "message": "Own device has changed"
+    }, status=status.HTTP_403_FORBIDDEN)
+
+def recipient_identity_changed():
+    return Response({
+        "code": "recipient_identity_changed",
+        "message": "Recipients device has changed"
+    }, status=status.HTTP_403_FORBIDDEN)
+
+def reached_max_prekeys():
+    return Response({
+        "code": "reached_max_prekeys",
+        "message": "User has reached the maximum number of prekeys allowed"
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+def prekey_id_exists():
+    return Response({
+        "code": "prekey_id_exists",
+        "message": "A prekey with that key_id already exists"
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+def invalid_recipient_email():
+    return Response({
+        "code": "invalid_recipient_email",
+        "message": "The email provided for the recipient is incorrectly formatted"
+    }, status=status.HTTP_400_BAD_REQUEST)
 
+def error_incrementing():
+    return Response({
+        "code": "error_incrementing",
+        "message": "There was an error incrementing the signing counter"
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+def signed_tokens_disabled():
+    return Response({
+        "code": "signed_tokens_disabled",
+        "message": "Signed tokens are not enabled on this server"
+    }, status=status.HTTP_404_NOT_FOUND)
+
+def invalid_refresh_token():
+    return Response({
+        "code": "invalid_refresh_token",
+        "message": "The refresh token is invalid, expired or revoked"
+    }, status=status.HTTP_401_UNAUTHORIZED)
+
+def long_poll_busy():
+    return Response({
+        "code": "long_poll_busy",
+        "message": "Too many requests are waiting for messages, retry shortly"
+    }, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "1"})
 
 # This error is appended to a list of responses when trying to process
 # multiple messages, so should NOT be in the Response() format
@@ -0,0 +1,134 @@
+"""
+Fans out newly stored messages to the WebSocket connections of their recipients
+"""
+
+import asyncio
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class Subscription:
+    """
+    Receives the messages published for one device. Messages may be published
+    from any thread, they are handed to the subscriber's event loop.
+    """
+
+    def __init__(self, fanout, device_id):
+        self._fanout = fanout
+        self.device_id = device_id
+        self._loop = None
+        self._queue = None
+
+    async def __aenter__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._fanout._add(self)
+        return self
+
+    async def __aexit__(self, *args):
+        self._fanout._remove(self)
+
+    async def get(self):
+        return await self._queue.get()
+
+    def put(self, message):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, message)
+        except RuntimeError:
+            # The subscriber's event loop has already closed
+            pass
+
+
+class InMemoryFanout:
+    """
+    Delivers messages to subscribers in the current process only. Suitable
+    when a single process serves every WebSocket connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, device_id):
+        return Subscription(self, device_id)
+
+    def publish(self, device_id, build):
+        """
+        Sends the message returned by `build()` to the device's subscribers,
+        it is only built if there are any
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(device_id, ()))
+        if subscriptions:
+            self._put(subscriptions, build())
+
+    def deliver(self, device_id, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(device_id, ()))
+        self._put(subscriptions, message)
+
+    @staticmethod
+    def _put(subscriptions, message):
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def _add(self, subscription):
+        with self._lock:
+            self._subscriptions.setdefault(subscription.device_id, set()).add(subscription)
+
+    def _remove(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.device_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.device_id]
+
+
+class LocalBroker:
+    """
+    Stand-in for a pub/sub broker shared by several nodes. Every published
+    message is delivered to every connected node, as a broker would.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._nodes = []
+
+    def connect(self, node):
+        with self._lock:
+            self._nodes.append(node)
+
+    def publish(self, device_id, message):
+        with self._lock:
+            nodes = list(self._nodes)
+        for node in nodes:
+            node.deliver(device_id, message)
+
+
+class BrokerFanout(InMemoryFanout):
+    """
+    Publishes through a broker so subscribers on every node receive the
+    message. A real broker needs only the `connect` and `publish` methods of
+    LocalBroker.
+    """
+
+    def __init__(self, broker=None):
+        super().__init__()
+        self.broker = broker if broker is not None else LocalBroker()
+        self.broker.connect(self)
+
+    def publish(self, device_id, build):
+        # Subscribers may be on any node, so the message is always built
+        self.broker.publish(device_id, build())
+
+
+_fanout = None
+
+def get_fanout():
+    global _fanout
+    if _fanout is None:
+        _fanout = import_string(settings.MESSAGE_FANOUT_BACKEND)()
+    return _fanout
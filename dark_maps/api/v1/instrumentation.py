@@ -0,0 +1,106 @@
+"""
+Collects database, cache and serializer timings for the request being handled
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Timings of one request, reported by instrumentation_middleware"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.timings = {'serializer': 0.0}
+        self._active = set()
+
+    def record_query(self, execute, sql, params, many, context):
+        """Database execute wrapper, see connection.execute_wrapper"""
+        tic = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - tic
+            self.db_queries += 1
+
+    def server_timing(self, total):
+        entries = [
+            f'total;dur={total * 1000:.2f}',
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.db_queries} queries"',
+            f'cache;desc="{self.cache_hits} hits {self.cache_misses} misses"',
+        ]
+        for name, duration in self.timings.items():
+            entries.append(f'{name};dur={duration * 1000:.2f}')
+        return ', '.join(entries)
+
+    def as_dict(self, total):
+        record = {
+            'total_ms': round(total * 1000, 2),
+            'db_ms': round(self.db_time * 1000, 2),
+            'db_queries': self.db_queries,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+        }
+        for name, duration in self.timings.items():
+            record[f'{name}_ms'] = round(duration * 1000, 2)
+        return record
+
+
+@contextmanager
+def collect():
+    """Makes a new RequestMetrics current for the duration of the block"""
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+def current():
+    """Returns the metrics of the request being handled, or None outside a request"""
+    return _current.get()
+
+
+def record_cache(hit):
+    metrics = _current.get()
+    if metrics is not None:
+        if hit:
+            metrics.cache_hits += 1
+        else:
+            metrics.cache_misses += 1
+
+
+@contextmanager
+def timed(name):
+    """Adds the time spent in the block to the named timing. Nested blocks of the same name are only counted once."""
+    metrics = _current.get()
+    if (metrics is None) or (name in metrics._active):
+        yield
+        return
+    metrics._active.add(name)
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timings[name] = metrics.timings.get(name, 0.0) + time.perf_counter() - tic
+        metrics._active.discard(name)
+
+
+class TimedSerializerMixin:
+    """Counts the time spent validating and representing data as serializer time"""
+
+    def run_validation(self, *args, **kwargs):
+        with timed('serializer'):
+            return super().run_validation(*args, **kwargs)
+
+    def to_representation(self, instance):
+        with timed('serializer'):
+            return super().to_representation(instance)
@@ -0,0 +1,204 @@
+"""
+Ships log records from a background thread so that slow log destinations,
+such as CloudWatch, are kept off the request path
+"""
+
+import copy
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+
+class QueuedBatchHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a bounded queue which a BatchListener drains into the
+    target handler. When the queue passes its high water mark only one in
+    `info_sample_rate` INFO records is kept, and once it is full INFO records
+    are dropped. Warnings and errors wait up to `block_timeout` seconds for
+    room before being dropped.
+
+    The target is given as a handler instance or, for dictConfig, a dict with
+    the handler's dotted "class" and its keyword arguments.
+    """
+
+    def __init__(self, target, queue_size=10000, batch_size=100, flush_interval=1.0,
+                 high_water=0.8, info_sample_rate=10, block_timeout=0.1):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        if isinstance(target, dict):
+            target = dict(target)
+            target = import_string(target.pop('class'))(**target)
+        self.target = target
+        self.high_water_size = int(queue_size * high_water)
+        self.info_sample_rate = info_sample_rate
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._sampled = 0
+        self._lock = threading.Lock()
+        self.listener = BatchListener(self.queue, target, batch_size, flush_interval, self)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        # Records are formatted by the target once they leave the queue
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            formatter = self.formatter or logging.Formatter()
+            record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if record.levelno <= logging.INFO:
+            if self.queue.qsize() >= self.high_water_size:
+                with self._lock:
+                    self._sampled += 1
+                    keep = (self._sampled % self.info_sample_rate) == 0
+                if not keep:
+                    self._drop()
+                    return
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self._drop()
+        else:
+            try:
+                self.queue.put(record, timeout=self.block_timeout)
+            except queue.Full:
+                self._drop()
+
+    def _drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def take_dropped(self):
+        """Returns the number of records dropped since the last call"""
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    def flush(self):
+        self.listener.flush()
+
+    def close(self):
+        # Called by logging.shutdown when the worker exits
+        self.listener.stop()
+        self.target.close()
+        super().close()
+
+
+class BatchListener:
+    """
+    Background thread which takes up to `batch_size` records off the queue,
+    or whatever has arrived after `flush_interval` seconds, hands them to the
+    target and then flushes it once for the whole batch
+    """
+
+    _flush = object()
+    _stop = object()
+
+    def __init__(self, queue, target, batch_size, flush_interval, handler):
+        self.queue = queue
+        self.target = target
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.handler = handler
+        self._thread = None
+        self._flushed = threading.Condition()
+        self._flush_requests = 0
+        self._flushes_done = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-shipping', daemon=True)
+        self._thread.start()
+
+    def flush(self, timeout=5):
+        """Waits until every record queued before the call has been shipped"""
+        if (self._thread is None) or not self._thread.is_alive():
+            return
+        with self._flushed:
+            self._flush_requests += 1
+            ticket = self._flush_requests
+        self.queue.put(self._flush)
+        with self._flushed:
+            self._flushed.wait_for(lambda: self._flushes_done >= ticket, timeout)
+
+    def stop(self, timeout=5):
+        if (self._thread is None) or not self._thread.is_alive():
+            return
+        self.queue.put(self._stop)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            batch, control = self._next_batch()
+            self._ship(batch)
+            if control is self._flush:
+                with self._flushed:
+                    self._flushes_done += 1
+                    self._flushed.notify_all()
+            elif control is self._stop:
+                return
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if batch and (remaining <= 0):
+                break
+            try:
+                item = self.queue.get(timeout=remaining) if batch else self.queue.get()
+            except queue.Empty:
+                break
+            if (item is self._flush) or (item is self._stop):
+                return batch, item
+            batch.append(item)
+        return batch, None
+
+    def _ship(self, batch):
+        dropped = self.handler.take_dropped()
+        if dropped:
+            batch.append(logging.makeLogRecord({
+                'name': 'watchtower',
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': f"[Logging] [Dropped {dropped} records]",
+            }))
+        if not batch:
+            return
+        for record in batch:
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+        try:
+            self.target.flush()
+        except Exception:
+            pass
+
+
+class InMemoryLogHandler(logging.Handler):
+    """Keeps formatted records in memory, standing in for CloudWatch in tests"""
+
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.records = []
+        self.batches = [[]]
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+        self.batches[-1].append(self.records[-1])
+
+    def flush(self):
+        if self.batches[-1]:
+            self.batches.append([])
@@ -0,0 +1,82 @@
+"""
+Parks long-polling inbox fetches on the ASGI event loop
+
+Django runs synchronous views on a single shared thread under ASGI, so a view
+waiting for a message would hold up every other request. Long polls are
+instead parked here without holding a thread, then handed to Django with the
+wait removed once a message arrives or the wait expires.
+"""
+
+import asyncio
+from urllib.parse import parse_qsl, urlencode
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpRequest
+from rest_framework.exceptions import AuthenticationFailed
+
+from dark_maps.api.v1.authentication import CachedTokenAuthentication
+from dark_maps.api.v1.fanout import get_fanout
+from dark_maps.api.v1.signed_tokens import SignedTokenAuthentication
+from dark_maps.api.v1.websocket import inbox_path
+
+
+def requested_wait(scope):
+    """Returns the seconds a GET of an inbox asks to wait for, 0 if it is not a valid long poll"""
+    if (scope['method'] != 'GET') or (not inbox_path.match(scope['path'])):
+        return 0
+    params = dict(parse_qsl(scope.get('query_string', b'').decode('latin1')))
+    try:
+        wait = int(params.get('wait', 0))
+    except ValueError:
+        return 0
+    # Anything out of range is left for the view to refuse
+    return wait if 0 < wait <= settings.MESSAGE_LONG_POLL_MAX_WAIT else 0
+
+
+def get_device(scope):
+    """Authenticates the request as MessageList does, returns the user's device or None"""
+    request = HttpRequest()
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            request.META['HTTP_AUTHORIZATION'] = value.decode('latin1')
+    for authentication in (CachedTokenAuthentication(), SignedTokenAuthentication()):
+        try:
+            result = authentication.authenticate(request)
+        except AuthenticationFailed:
+            return None
+        if result is not None:
+            return getattr(result[0], 'device', None)
+    return None
+
+
+def has_messages(device, after):
+    return device.received_messages.unexpired().filter(id__gt=after).exists()
+
+
+async def long_poll(scope, receive, send, application):
+    """
+    Waits for up to the requested time for a message to reach the device, then
+    passes the request to `application` without its wait parameter
+    """
+    wait = requested_wait(scope)
+    params = parse_qsl(scope.get('query_string', b'').decode('latin1'))
+    try:
+        after = int(dict(params).get('after', 0))
+    except ValueError:
+        after = None
+
+    device = await sync_to_async(get_device)(scope)
+    match = inbox_path.match(scope['path'])
+    # Failed checks are answered by the view
+    if (device is not None) and (after is not None) and (int(match.group('requestedDeviceregistration_id')) == device.registration_id):
+        # Subscribe before checking the inbox so nothing stored in between is missed
+        async with get_fanout().subscribe(device.id) as subscription:
+            if not await sync_to_async(has_messages)(device, after):
+                try:
+                    await asyncio.wait_for(subscription.get(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    query_string = urlencode([(key, value) for key, value in params if key != 'wait']).encode('latin1')
+    await application(dict(scope, query_string=query_string), receive, send)
@@ -0,0 +1,70 @@
+"""
+Prometheus metrics for the API, served from /metrics
+
+When the PROMETHEUS_MULTIPROC_DIR environment variable is set each gunicorn
+worker writes its samples to that directory and the endpoint adds up the
+samples of every worker, see gunicorn.conf.py
+"""
+
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+# Views reported by name, every other request is reported as "other"
+TRACKED_VIEWS = {'MessageList', 'PreKeyBundleView', 'PreKeyBundleListView', 'UserPreKeys', 'UserSignedPreKeys', 'DeviceView'}
+
+REQUEST_LATENCY = Histogram(
+    'darkmaps_request_latency_seconds',
+    'Time taken to handle a request',
+    ['view', 'method'],
+)
+RESPONSES = Counter(
+    'darkmaps_responses',
+    'Responses sent, by status code',
+    ['view', 'method', 'status'],
+)
+THROTTLED = Counter(
+    'darkmaps_throttled_requests',
+    'Requests rejected by a throttle',
+    ['view', 'method'],
+)
+DB_QUERIES = Histogram(
+    'darkmaps_request_db_queries',
+    'Database queries run by a request',
+    ['view', 'method'],
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, float('inf')),
+)
+DB_TIME = Histogram(
+    'darkmaps_request_db_seconds',
+    'Time a request spent waiting on the database',
+    ['view', 'method'],
+)
+
+
+def view_label(request):
+    view_class = getattr(getattr(getattr(request, 'resolver_match', None), 'func', None), 'view_class', None)
+    if (view_class is not None) and (view_class.__name__ in TRACKED_VIEWS):
+        return view_class.__name__
+    return 'other'
+
+
+def observe(request, response, request_metrics, total):
+    """Records a finished request, called by the instrumentation middleware"""
+    view = view_label(request)
+    method = request.method
+    REQUEST_LATENCY.labels(view, method).observe(total)
+    RESPONSES.labels(view, method, str(response.status_code)).inc()
+    if response.status_code == 429:
+        THROTTLED.labels(view, method).inc()
+    DB_QUERIES.labels(view, method).observe(request_metrics.db_queries)
+    DB_TIME.labels(view, method).observe(request_metrics.db_time)
+
+
+def render():
+    """Returns the exposition text and its content type"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -2,6 +2,16 @@
 Defines Django middleware
 """
 
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from dark_maps.api.v1 import instrumentation, metrics as prometheus_metrics
+
+
 def x_robots_middleware(get_response):
     # One-time configuration and initialization.
 
@@ -16,3 +26,30 @@ def x_robots_middleware(get_response):
         return response
 
     return middleware
+
+def instrumentation_middleware(get_response):
+    # Reports the time spent on each request in a Server-Timing header and one log record
+
+    def middleware(request):
+        logger = logging.getLogger("watchtower")
+        with instrumentation.collect() as metrics, connection.execute_wrapper(metrics.record_query):
+            response = get_response(request)
+        total = time.perf_counter() - metrics.started
+
+        response['Server-Timing'] = metrics.server_timing(total)
+        prometheus_metrics.observe(request, response, metrics, total)
+
+        record = {
+            'view': getattr(getattr(request, 'resolver_match', None), 'view_name', None) or request.path_info,
+            'method': request.method,
+            'status': response.status_code,
+        }
+        record.update(metrics.as_dict(total))
+        logger.info(f"[Request] {json.dumps(record)}")
+
+        if metrics.db_queries > settings.REQUEST_QUERY_BUDGET:
+            logger.warning(f"[Request] [Query budget exceeded] [{metrics.db_queries} queries] [{record['view']}]")
+
+        return response
+
+    return middleware
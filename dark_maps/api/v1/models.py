@@ -2,8 +2,42 @@
 Defines Django models
 """
 
-from django.db import models
+import collections
+
+from django.db import models, connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
 from django.conf import settings
+from django.utils import timezone
+
+from dark_maps.api.v1 import population
+
+class DeviceManager(models.Manager):
+    def adjust_counts(self, device, prekey_count=0, inbox_count=0, max_prekeys=None):
+        """
+        Adds to the device's stored prekey and message counters in a single
+        UPDATE. Counters never drop below zero, and when max_prekeys is given
+        an increase that would take the prekey counter past it is not made.
+        Returns whether the counters were changed, False if the device no
+        longer exists or is at its limit. The UPDATE keeps the device's row
+        locked until the transaction ends.
+        """
+        changes = {}
+        for field, delta in (('prekey_count', prekey_count), ('inbox_count', inbox_count)):
+            if delta > 0:
+                changes[field] = F(field) + delta
+            elif delta < 0:
+                changes[field] = Greatest(F(field) - (-delta), 0)
+        if not changes:
+            return True
+        devices = self.filter(id=device.id)
+        if (max_prekeys is not None) and (prekey_count > 0):
+            # Checked against the stored counter in the same statement, so concurrent uploads cannot both pass
+            devices = devices.filter(prekey_count__lte=max_prekeys - prekey_count)
+        if not devices.update(**changes):
+            return False
+        population.adjust(prekeys=prekey_count, messages=inbox_count)
+        return True
 
 class Device(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -11,18 +45,112 @@ class Device(models.Model):
     identity_key = models.CharField(max_length=44, blank=False)
     registration_id = models.PositiveIntegerField(blank=False)
     address = models.CharField(max_length=100, blank=False)
+    # Kept up to date as prekeys and messages are stored and removed so they never need counting
+    prekey_count = models.PositiveIntegerField(default=0)
+    inbox_count = models.PositiveIntegerField(default=0)
+    objects = DeviceManager()
     class Meta:
-        unique_together = ('user', 'address',)
+        constraints = [
+            # Recipients are looked up by address when fetching prekey bundles
+            models.UniqueConstraint(fields=['address'], name='unique_device_address')
+        ]
+
+class PreKeyManager(models.Manager):
+    def claim(self, device):
+        """
+        Removes one of the device's prekeys and returns it, or None if it has
+        none left. Concurrent claims never return the same prekey.
+        """
+        if connection.vendor == 'postgresql':
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"DELETE FROM {table} WHERE id = ("
+                        f"SELECT id FROM {table} WHERE device_id = %s ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED"
+                        f") RETURNING id, key_id, public_key",
+                        [device.id]
+                    )
+                    row = cursor.fetchone()
+                if row is None:
+                    return None
+                Device.objects.adjust_counts(device, prekey_count=-1)
+            return self.model(id=row[0], device=device, key_id=row[1], public_key=row[2])
+
+        # Writes are serialised on other backends, only the claim that deletes the row keeps it
+        while True:
+            pre_key = self.filter(device=device).order_by('id').first()
+            if pre_key is None:
+                return None
+            with transaction.atomic():
+                deleted, _ = self.filter(id=pre_key.id).delete()
+                if deleted:
+                    Device.objects.adjust_counts(device, prekey_count=-1)
+                    return pre_key
+
+    def claim_many(self, devices):
+        """
+        Removes one prekey from each device with a fixed number of queries and
+        returns them keyed by device ID. Devices with no prekeys left are missing
+        from the result.
+        """
+        devices = {device.id: device for device in devices}
+        if not devices:
+            return {}
+        if connection.vendor == 'postgresql':
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"DELETE FROM {table} WHERE id IN ("
+                        f"SELECT claimed.id FROM unnest(%s::integer[]) AS requested(device_id) CROSS JOIN LATERAL ("
+                        f"SELECT id FROM {table} WHERE device_id = requested.device_id ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED"
+                        f") AS claimed) RETURNING id, device_id, key_id, public_key",
+                        [list(devices)]
+                    )
+                    rows = cursor.fetchall()
+                claimed = {row[1]: self.model(id=row[0], device=devices[row[1]], key_id=row[2], public_key=row[3]) for row in rows}
+                Device.objects.filter(id__in=claimed).update(prekey_count=Greatest(F('prekey_count') - 1, 0))
+                population.adjust(prekeys=-len(claimed))
+            return claimed
+
+        # Writes are serialised on other backends, retry if another claim removed one of the chosen rows first
+        firstIds = self.filter(device__in=list(devices)).values('device').annotate(first=models.Min('id')).values('first')
+        while True:
+            try:
+                with transaction.atomic():
+                    pre_keys = list(self.filter(id__in=firstIds))
+                    deleted, _ = self.filter(id__in=[pre_key.id for pre_key in pre_keys]).delete()
+                    if deleted != len(pre_keys):
+                        raise _ClaimConflict()
+                    claimed = {}
+                    for pre_key in pre_keys:
+                        pre_key.device = devices[pre_key.device_id]
+                        claimed[pre_key.device_id] = pre_key
+                    Device.objects.filter(id__in=claimed).update(prekey_count=Greatest(F('prekey_count') - 1, 0))
+                    population.adjust(prekeys=-len(claimed))
+                return claimed
+            except _ClaimConflict:
+                continue
+
+class _ClaimConflict(Exception):
+    pass
 
 class PreKey(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE)
     key_id = models.PositiveIntegerField(blank=False)
     # Public key length is 44 text characters
     public_key = models.CharField(max_length=44, blank=False)
+    objects = PreKeyManager()
     class Meta:
         constraints = [
+            # Also serves the key_id probes when prekeys are uploaded
             models.UniqueConstraint(fields=['device', 'key_id'], name='unique_key_id')
         ]
+        indexes = [
+            # Claims take the device's oldest prekey
+            models.Index(fields=['device', 'id'], name='prekey_device_id_idx'),
+        ]
 
 
 class SignedPreKey(models.Model):
@@ -33,11 +161,111 @@ class SignedPreKey(models.Model):
     # Signature length is 88 text characters
     signature = models.CharField(max_length=88, blank=False)
 
+class MessageQuerySet(models.QuerySet):
+    def unexpired(self):
+        """Excludes messages whose TTL has passed but which have not been purged yet"""
+        return self.filter(models.Q(expires__isnull=True) | models.Q(expires__gt=timezone.now()))
+
+class MessageManager(models.Manager.from_queryset(MessageQuerySet)):
+    def consume(self, recipient, limit):
+        """
+        Removes up to `limit` of the recipient's oldest messages and returns them.
+        The read and the delete happen in one transaction so a message is only
+        ever handed out once.
+        """
+        if connection.vendor == 'postgresql':
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"DELETE FROM {table} WHERE id IN ("
+                        f"SELECT id FROM {table} WHERE recipient_id = %s AND (expires IS NULL OR expires > %s) ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED"
+                        f") RETURNING id, created, content, ciphertext, sender_registration_id, sender_address, expires",
+                        [recipient.id, timezone.now(), limit]
+                    )
+                    rows = cursor.fetchall()
+                Device.objects.adjust_counts(recipient, inbox_count=-len(rows))
+            messages = [
+                self.model(id=row[0], recipient=recipient, created=row[1], content=row[2], ciphertext=row[3], sender_registration_id=row[4], sender_address=row[5], expires=row[6])
+                for row in rows
+            ]
+            return sorted(messages, key=lambda message: message.id)
+
+        # Backends without DELETE ... RETURNING serialise writes, so read then delete
+        with transaction.atomic():
+            messages = list(self.filter(recipient=recipient).unexpired().select_for_update().order_by('id')[:limit])
+            for message in messages:
+                message.recipient = recipient
+            deleted, _ = self.filter(id__in=[message.id for message in messages]).delete()
+            Device.objects.adjust_counts(recipient, inbox_count=-deleted)
+        return messages
+
+    def purge_expired(self, created_before, batch_size):
+        """
+        Deletes up to `batch_size` messages created before `created_before`, or
+        whose TTL has passed, in one short transaction and returns how many were
+        deleted. Call repeatedly until it returns 0.
+        """
+        conditions = [models.Q(expires__lte=timezone.now())]
+        if created_before is not None:
+            conditions.insert(0, models.Q(created__lt=created_before))
+        for condition in conditions:
+            deleted = self._purge_batch(condition, batch_size)
+            if deleted:
+                return deleted
+        return 0
+
+    def _purge_batch(self, condition, batch_size):
+        with transaction.atomic():
+            # Rows being consumed are skipped rather than waited on
+            rows = list(self.filter(condition).select_for_update(skip_locked=True).order_by().values_list('id', 'recipient_id')[:batch_size])
+            if not rows:
+                return 0
+            deleted, _ = self.filter(id__in=[row[0] for row in rows]).delete()
+            # One UPDATE for each distinct number of messages removed from a device
+            byCount = collections.defaultdict(list)
+            for device_id, count in collections.Counter(row[1] for row in rows).items():
+                byCount[count].append(device_id)
+            for count, device_ids in byCount.items():
+                Device.objects.filter(id__in=device_ids).update(inbox_count=Greatest(F('inbox_count') - count, 0))
+            population.adjust(messages=-deleted)
+        return deleted
+
 class Message(models.Model):
     recipient = models.ForeignKey(Device, on_delete=models.CASCADE, related_name="received_messages")
     created = models.DateTimeField(auto_now_add=True)
-    content = models.CharField(max_length=1000, blank=False)
+    # Version 1 messages store the JSON string sent by the client
+    content = models.CharField(max_length=1000, blank=True)
+    # Version 2 messages store only the raw ciphertext
+    ciphertext = models.BinaryField(max_length=750, null=True)
     sender_registration_id = models.PositiveIntegerField(blank=False)
     sender_address = models.CharField(max_length=100, blank=False)
+    # Set when the sender chose a TTL shorter than the server's retention period
+    expires = models.DateTimeField(null=True)
+    objects = MessageManager()
     class Meta:
         ordering = ('created',)
+        indexes = [
+            # Supports keyset pagination of a device's inbox
+            models.Index(fields=['recipient', 'id'], name='message_recipient_id_idx'),
+            # Supports the full inbox listing in the default ordering
+            models.Index(fields=['recipient', 'created'], name='message_recipient_created_idx'),
+            # Support the expiry purge
+            models.Index(fields=['created'], name='message_created_idx'),
+            models.Index(fields=['expires'], name='message_expires_idx', condition=models.Q(expires__isnull=False)),
+        ]
+
+class DeniedToken(models.Model):
+    # Signed tokens revoked before they expire, removed once they would have expired anyway
+    jti = models.CharField(max_length=64, unique=True)
+    expires = models.DateTimeField(db_index=True)
+
+class SignedTokenCutoff(models.Model):
+    # Signed refresh tokens issued before a user's logout or password change are refused
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='signed_token_cutoff')
+    revoked = models.DateTimeField()
+
+class PopulationTotal(models.Model):
+    # Running totals kept by population.py, one row per counter so they are updated independently
+    name = models.CharField(max_length=16, unique=True)
+    value = models.BigIntegerField(default=0)
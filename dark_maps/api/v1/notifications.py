@@ -0,0 +1,117 @@
+"""
+Wakes requests that are waiting for a device's next message
+"""
+
+import logging
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+
+CHANNEL = 'dark_maps_inbox'
+
+
+class InboxNotifier:
+    """
+    Keeps a set of events per device which are set when a message for that
+    device is stored. On Postgres the wake up is sent with NOTIFY so that
+    requests parked in other processes are woken as well, a background thread
+    in each process LISTENs and sets the local events. Other backends only
+    wake requests in the current process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._parked = 0
+        self._listener = None
+
+    @contextmanager
+    def listen(self, device_id):
+        """
+        Registers interest in a device's messages. Register before checking
+        the inbox so a message stored in between is not missed.
+        """
+        self._ensure_listener()
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(device_id, set()).add(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(device_id)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[device_id]
+
+    @contextmanager
+    def park(self):
+        """
+        Takes one of the MESSAGE_LONG_POLL_MAX_WAITERS places for a request
+        parked in this process, yields False if they are all taken
+        """
+        with self._lock:
+            parked = self._parked < settings.MESSAGE_LONG_POLL_MAX_WAITERS
+            if parked:
+                self._parked += 1
+        try:
+            yield parked
+        finally:
+            if parked:
+                with self._lock:
+                    self._parked -= 1
+
+    def notify(self, device_id):
+        """Wakes anything waiting on the device once the current transaction commits"""
+        if connection.vendor == 'postgresql':
+            # NOTIFY is only delivered on commit
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_notify(%s, %s)", [CHANNEL, str(device_id)])
+        else:
+            transaction.on_commit(lambda: self.wake(device_id))
+
+    def wake(self, device_id):
+        with self._lock:
+            waiters = list(self._waiters.get(device_id, ()))
+        for event in waiters:
+            event.set()
+
+    def _ensure_listener(self):
+        if connection.vendor != 'postgresql':
+            return
+        with self._lock:
+            if (self._listener is not None) and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(target=self._listen_forever, name='inbox-listener', daemon=True)
+            self._listener.start()
+
+    def _listen_forever(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        logger = logging.getLogger("watchtower")
+        params = connections['default'].get_connection_params()
+        while True:
+            try:
+                pg_connection = psycopg2.connect(**params)
+                pg_connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with pg_connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+                while True:
+                    if select.select([pg_connection], [], [], 5) == ([], [], []):
+                        continue
+                    pg_connection.poll()
+                    while pg_connection.notifies:
+                        notification = pg_connection.notifies.pop(0)
+                        self.wake(int(notification.payload))
+            except Exception:
+                logger.error(f"[Inbox Listener] [Error - Listener connection lost]")
+                time.sleep(1)
+
+
+inbox_notifier = InboxNotifier()
@@ -0,0 +1,70 @@
+"""
+Keeps running totals of users, devices, queued messages and stocked prekeys
+in the database as they change, so they never need counting on the request
+path. Every worker updates the same rows.
+"""
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+COUNTERS = ('users', 'devices', 'messages', 'prekeys')
+
+def _totals():
+    return apps.get_model('api', 'PopulationTotal').objects
+
+def _apply(deltas):
+    # One short UPDATE per counter, a missing row is restored by the next reconcile
+    for name, delta in deltas.items():
+        _totals().filter(name=name).update(value=F('value') + delta)
+
+def adjust(**deltas):
+    """Adds to the named totals once the current transaction commits"""
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if deltas:
+        transaction.on_commit(lambda: _apply(deltas))
+
+def get_totals():
+    """Returns each total, or None for totals missing until the next reconcile"""
+    values = dict(_totals().filter(name__in=COUNTERS).values_list('name', 'value'))
+    return {name: values.get(name) for name in COUNTERS}
+
+def reconcile():
+    """
+    Counts every table and stores the totals. This scans the tables, so it is
+    run by the reconcile_population command rather than on the request path.
+    """
+    Device = apps.get_model('api', 'Device')
+    totals = {
+        'users': apps.get_model(settings.AUTH_USER_MODEL).objects.count(),
+        'devices': Device.objects.count(),
+        'messages': apps.get_model('api', 'Message').objects.count(),
+        'prekeys': apps.get_model('api', 'PreKey').objects.count(),
+    }
+    with transaction.atomic():
+        for name, value in totals.items():
+            _totals().update_or_create(name=name, defaults={'value': value})
+    return totals
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved_callback(sender, instance, created, **kwargs):
+    if created:
+        adjust(users=1)
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_deleted_callback(sender, instance, **kwargs):
+    adjust(users=-1)
+
+@receiver(post_save, sender='api.Device')
+def device_saved_callback(sender, instance, created, **kwargs):
+    if created:
+        adjust(devices=1, prekeys=instance.prekey_count, messages=instance.inbox_count)
+
+@receiver(pre_delete, sender='api.Device')
+def device_deleted_callback(sender, instance, **kwargs):
+    # Its prekeys and messages are removed with it. Read before the delete as
+    # devices loaded by authentication fetch their counters on first use.
+    adjust(devices=-1, prekeys=-instance.prekey_count, messages=-instance.inbox_count)
@@ -0,0 +1,109 @@
+"""
+Renderers and parsers selected in settings.py
+
+ORJSONRenderer and ORJSONParser are used in place of REST framework's JSON
+pair when JSON_BACKEND is "orjson". The output is byte for byte that of
+JSONRenderer for every payload the API returns. The one difference, floats
+with an exponent ("1e-5" rather than "1e-05"), cannot occur because no
+endpoint returns floats.
+
+MessagePackRenderer and MessagePackParser serve clients sending or accepting
+application/msgpack. Ciphertext, base64 text in JSON, is raw bytes. Keys are
+stored as the text clients uploaded, so they remain text.
+"""
+
+import msgpack
+import orjson
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# JSONRenderer escapes these so its output is also valid javascript
+LINE_SEPARATOR = '\u2028'.encode()
+PARAGRAPH_SEPARATOR = '\u2029'.encode()
+
+# Datetimes are passed to the default function so they are formatted as
+# JSONRenderer formats them, with "Z" for UTC
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    Renders JSON with orjson. Indented output, asked for by the browsable API
+    or an "indent" media type parameter, and values orjson cannot encode, such
+    as integers wider than 64 bits, are left to JSONRenderer.
+    """
+
+    def __init__(self):
+        self.default = JSONEncoder().default
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if (not self.compact) or self.ensure_ascii or (not self.strict) or (self.get_indent(accepted_media_type, renderer_context or {}) is not None):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        return ret.replace(LINE_SEPARATOR, b'\\u2028').replace(PARAGRAPH_SEPARATOR, b'\\u2029')
+
+
+class ORJSONParser(JSONParser):
+    """
+    Parses JSON with orjson. Bodies in a charset other than UTF-8 are left to
+    JSONParser. Integers wider than 64 bits are read as floats, where
+    JSONParser would keep them as integers, either way they fail validation.
+    """
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+def accepts_binary(request):
+    """Whether the response is rendered in a format, MessagePack, which carries bytes as they are"""
+    return request.accepted_renderer.render_style == 'binary'
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renders MessagePack. Bytes, ciphertext given by views that check
+    accepts_binary(), are sent as the bin type. Anything else MessagePack has
+    no type for is converted as JSONRenderer converts it.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def __init__(self):
+        self.default = JSONEncoder().default
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=self.default, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    """
+    Parses MessagePack. Ciphertext sent as bytes is passed on as bytes, which
+    the serializers accept in place of base64 text.
+    """
+    media_type = 'application/msgpack'
+    renderer_class = MessagePackRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, msgpack.UnpackException) as exc:
+            raise ParseError('MessagePack parse error - %s' % str(exc))
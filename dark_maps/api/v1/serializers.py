@@ -2,39 +2,149 @@
 Defines Django serialisers
 """
 
+import base64
+import binascii
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
 from rest_framework import serializers
 from dark_maps.api.v1.models import Message, Device, PreKey, SignedPreKey
+from dark_maps.api.v1.notifications import inbox_notifier
+from dark_maps.api.v1.fanout import get_fanout
+from dark_maps.api.v1.instrumentation import TimedSerializerMixin, timed
 from django.core.exceptions import PermissionDenied, FieldError
+from django.utils import timezone
+
+# Maximum number of one-time prekeys stored for a device
+MAX_PREKEYS = 100
 
-class MessageSerializer(serializers.Serializer):
+class MessageSerializer(TimedSerializerMixin, serializers.Serializer):
     id = serializers.ReadOnlyField()
     sender_address = serializers.CharField(max_length=100, min_length=0)
     sender_registration_id = serializers.IntegerField(min_value=0, max_value=999999)
     content = serializers.CharField(max_length=1000, min_length=0)
     recipient_address = serializers.SerializerMethodField()
+    # Seconds the message is kept for if never fetched, at most the retention period
+    ttl = serializers.IntegerField(min_value=1, required=False, write_only=True)
+    def validate_ttl(self, value):
+        retention = settings.MESSAGE_RETENTION_DAYS * 24 * 60 * 60
+        if (retention > 0) and (value > retention):
+            raise serializers.ValidationError(f"Must be no more than the retention period of {retention} seconds.")
+        return value
     def create(self, validated_data):
         recipient_device = self.context['recipient_device']
-        return Message.objects.create(recipient=recipient_device, **validated_data)
+        ttl = validated_data.pop('ttl', None)
+        if ttl is not None:
+            validated_data['expires'] = timezone.now() + timedelta(seconds=ttl)
+        with transaction.atomic():
+            # Counted first, locking the recipient's row, so a device deleted since it
+            # was looked up is found before the message insert fails on it
+            if not Device.objects.adjust_counts(recipient_device, inbox_count=1):
+                raise Device.DoesNotExist("The recipient's device no longer exists")
+            message = Message.objects.create(recipient=recipient_device, **validated_data)
+        # Wake any long-polling request from the recipient and push to their WebSocket,
+        # the pushed message is only built if someone is subscribed
+        inbox_notifier.notify(recipient_device.id)
+        transaction.on_commit(lambda: get_fanout().publish(recipient_device.id, lambda: represent_messages([message_columns(message)], recipient_device)[0]))
+        return message
     @classmethod
     def get_recipient_address(cls, obj):
         return obj.recipient.address
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # Rebuild the version 1 JSON string for messages stored as raw ciphertext
+        if instance.ciphertext is not None:
+            data['content'] = json.dumps({
+                'registration_id': instance.recipient.registration_id,
+                'content': base64.b64encode(bytes(instance.ciphertext)).decode()
+            })
+        return data
+
+class Base64BinaryField(serializers.Field):
+    """
+    Bytes sent as base64 text in JSON. Formats which carry bytes, MessagePack,
+    send them as they are, and the field returns bytes when the serializer's
+    context has `binary` set.
+    """
+    default_error_messages = {
+        'invalid': 'Must be base64 encoded.',
+        'max_length': 'Must be no more than {max_length} bytes once decoded.',
+    }
+    def __init__(self, max_length=None, **kwargs):
+        self.max_length = max_length
+        super().__init__(**kwargs)
+    def to_internal_value(self, data):
+        if isinstance(data, bytes):
+            value = data
+        else:
+            try:
+                value = base64.b64decode(data, validate=True)
+            except (TypeError, ValueError, binascii.Error):
+                self.fail('invalid')
+        if (self.max_length is not None) and (len(value) > self.max_length):
+            self.fail('max_length', max_length=self.max_length)
+        return value
+    def to_representation(self, value):
+        if self.context.get('binary'):
+            return bytes(value)
+        return base64.b64encode(bytes(value)).decode()
+
+class MessageV2Serializer(MessageSerializer):
+    content = None
+    ciphertext = Base64BinaryField(max_length=750)
+    def to_representation(self, instance):
+        data = super(MessageSerializer, self).to_representation(instance)
+        # Messages stored before version 2 keep their original JSON string
+        if instance.ciphertext is None:
+            data.pop('ciphertext')
+            data['content'] = instance.content
+        return data
+
+class PreKeyListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    def create(self, validated_data):
+        deviceReference = self.context['device']
+        newKeyIds = [x['key_id'] for x in validated_data]
+        if len(set(newKeyIds)) != len(newKeyIds):
+            raise FieldError()
+        with transaction.atomic():
+            # Limit to max 100 prekeys, counted first so the device stays locked until the keys are stored
+            if not Device.objects.adjust_counts(deviceReference, prekey_count=len(validated_data), max_prekeys=MAX_PREKEYS):
+                raise PermissionDenied()
+            # Check no existing prekey has one of the new IDs
+            if deviceReference.prekey_set.filter(key_id__in=newKeyIds).exists():
+                raise FieldError()
+            try:
+                preKeys = PreKey.objects.bulk_create([PreKey(device=deviceReference, **x) for x in validated_data])
+            except IntegrityError:
+                # A concurrent upload stored one of the same key IDs first
+                raise FieldError()
+        # Devices from the authentication cache leave the counter deferred, it is then read after the update
+        if 'prekey_count' in deviceReference.__dict__:
+            deviceReference.prekey_count += len(preKeys)
+        return preKeys
 
-class PreKeySerializer(serializers.Serializer):
+class PreKeySerializer(TimedSerializerMixin, serializers.Serializer):
     key_id = serializers.IntegerField(min_value=0, max_value=999999)
     public_key = serializers.CharField(max_length=44, min_length=44)
+    class Meta:
+        list_serializer_class = PreKeyListSerializer
     def create(self, validated_data):
         user = self.context['user']
         registration_id = self.context['registration_id']
         deviceReference = Device.objects.filter(user=user, registration_id=registration_id).get()
-        # Limit to max 100 prekeys
-        if deviceReference.prekey_set.count() > 99:
-            raise PermissionDenied()
-        # Check an existing prekey does not have the same ID
-        if not deviceReference.prekey_set.filter(key_id=validated_data['key_id']).count() == 0:
-            raise FieldError()
-        return PreKey.objects.create(device=deviceReference, **validated_data)
+        with transaction.atomic():
+            # Limit to max 100 prekeys
+            if not Device.objects.adjust_counts(deviceReference, prekey_count=1, max_prekeys=MAX_PREKEYS):
+                raise PermissionDenied()
+            # Check an existing prekey does not have the same ID
+            if not deviceReference.prekey_set.filter(key_id=validated_data['key_id']).count() == 0:
+                raise FieldError()
+            preKey = PreKey.objects.create(device=deviceReference, **validated_data)
+        return preKey
 
-class SignedPreKeySerializer(serializers.Serializer):
+class SignedPreKeySerializer(TimedSerializerMixin, serializers.Serializer):
     key_id = serializers.IntegerField(min_value=0, max_value=999999)
     public_key = serializers.CharField(max_length=44, min_length=44)
     signature = serializers.CharField(max_length=88, min_length=88)
@@ -44,12 +154,23 @@ class SignedPreKeySerializer(serializers.Serializer):
         deviceReference = Device.objects.filter(user=user, registration_id=registration_id).get()
         return SignedPreKey.objects.create(device=deviceReference, **validated_data)
 
-class DeviceSerializer(serializers.Serializer):
+class DeviceSerializer(TimedSerializerMixin, serializers.Serializer):
     identity_key = serializers.CharField(max_length=44, min_length=44)
     address = serializers.CharField(max_length=100)
     registration_id = serializers.IntegerField(min_value=0, max_value=999999)
     pre_keys = PreKeySerializer(many=True)
     signed_pre_key = SignedPreKeySerializer()
+    def validate_pre_keys(self, value):
+        if len(value) > MAX_PREKEYS:
+            raise serializers.ValidationError(f"No more than {MAX_PREKEYS} prekeys can be stored.")
+        keyIds = [x['key_id'] for x in value]
+        if len(set(keyIds)) != len(keyIds):
+            raise serializers.ValidationError("Each prekey must have a unique key_id.")
+        return value
+    def validate_address(self, value):
+        if Device.objects.filter(address=value).exists():
+            raise serializers.ValidationError("A device with this address already exists.")
+        return value
     def create(self, validated_data):
         user = self.context['user']
         # Limit to max 1 device for security reasons
@@ -57,15 +178,75 @@ class DeviceSerializer(serializers.Serializer):
             raise PermissionDenied()
         signed_pre_key = validated_data.pop('signed_pre_key')
         pre_keys = validated_data.pop('pre_keys')
-        deviceReference = Device.objects.create(user=user, **validated_data)
-        SignedPreKey.objects.create(device=deviceReference, **signed_pre_key)
-        for x in pre_keys:
-            PreKey.objects.create(device=deviceReference, **x)
+        with transaction.atomic():
+            try:
+                deviceReference = Device.objects.create(user=user, prekey_count=len(pre_keys), **validated_data)
+            except IntegrityError:
+                # A concurrent request registered the same address first
+                raise serializers.ValidationError({'address': ["A device with this address already exists."]})
+            SignedPreKey.objects.create(device=deviceReference, **signed_pre_key)
+            PreKey.objects.bulk_create([PreKey(device=deviceReference, **x) for x in pre_keys])
         return deviceReference
 
-class PreKeyBundleSerializer(serializers.Serializer):
+class PreKeyBundleSerializer(TimedSerializerMixin, serializers.Serializer):
     address = serializers.CharField(max_length=100, min_length=1)
     identity_key = serializers.CharField(max_length=33, min_length=33)
     registration_id = serializers.IntegerField(min_value=0, max_value=999999)
     pre_key = PreKeySerializer(required=False)
     signed_pre_key = SignedPreKeySerializer()
+
+# Read paths build responses from column tuples rather than a serializer per
+# object. Their output must match MessageSerializer, MessageV2Serializer and
+# PreKeyBundleSerializer exactly.
+
+# Columns read by represent_messages, use with values_list
+MESSAGE_COLUMNS = ('id', 'sender_address', 'sender_registration_id', 'content', 'ciphertext')
+
+def message_columns(message):
+    """Returns the MESSAGE_COLUMNS of a message already loaded"""
+    return (message.id, message.sender_address, message.sender_registration_id, message.content, message.ciphertext)
+
+def represent_messages(rows, recipient, envelope=1, binary=False):
+    """
+    Returns the representation of messages to `recipient` given as
+    MESSAGE_COLUMNS tuples, as MessageV2Serializer if `envelope` is 2 and
+    otherwise as MessageSerializer. Version 2 ciphertext is left as bytes if
+    `binary` is set, as with a `binary` serializer context.
+    """
+    with timed('serializer'):
+        address = recipient.address
+        data = []
+        for message_id, sender_address, sender_registration_id, content, ciphertext in rows:
+            message = {'id': message_id, 'sender_address': sender_address, 'sender_registration_id': int(sender_registration_id)}
+            if envelope == 2:
+                message['recipient_address'] = address
+                if ciphertext is None:
+                    message['content'] = content
+                elif binary:
+                    message['ciphertext'] = bytes(ciphertext)
+                else:
+                    message['ciphertext'] = base64.b64encode(bytes(ciphertext)).decode()
+            else:
+                if ciphertext is None:
+                    message['content'] = content
+                else:
+                    # Rebuild the version 1 JSON string for messages stored as raw ciphertext
+                    message['content'] = json.dumps({
+                        'registration_id': recipient.registration_id,
+                        'content': base64.b64encode(bytes(ciphertext)).decode()
+                    })
+                message['recipient_address'] = address
+            data.append(message)
+        return data
+
+def represent_prekey_bundle(recipient, signed_pre_key, pre_key=None):
+    """
+    Returns the PreKeyBundleSerializer representation of a bundle for a
+    DirectoryEntry or Device, its SignedPreKey and an optional PreKey
+    """
+    with timed('serializer'):
+        bundle = {'address': recipient.address, 'identity_key': recipient.identity_key, 'registration_id': int(recipient.registration_id)}
+        if pre_key is not None:
+            bundle['pre_key'] = {'key_id': int(pre_key.key_id), 'public_key': pre_key.public_key}
+        bundle['signed_pre_key'] = {'key_id': int(signed_pre_key.key_id), 'public_key': signed_pre_key.public_key, 'signature': signed_pre_key.signature}
+        return bundle
@@ -0,0 +1,163 @@
+"""
+Optional signed token authentication. Access tokens carry the user and their
+device as claims so requests are authenticated without touching the database
+or the cache.
+"""
+
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_logged_out
+from django.db import IntegrityError
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from dark_maps.api.v1.models import Device, DeniedToken, SignedTokenCutoff
+
+
+class Denylist:
+    """
+    Revoked token IDs. Each process keeps a copy of the unexpired entries and
+    reloads it every SIGNED_TOKEN_DENYLIST_REFRESH seconds, so a revocation
+    reaches other processes within that time. Entries are deleted once the
+    token would have expired.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jtis = set()
+        self._loaded = None
+
+    def deny(self, token):
+        expires = datetime.fromtimestamp(token['exp'], tz=timezone.utc)
+        try:
+            DeniedToken.objects.create(jti=token['jti'], expires=expires)
+        except IntegrityError:
+            pass
+        DeniedToken.objects.filter(expires__lte=datetime.now(tz=timezone.utc)).delete()
+        with self._lock:
+            self._jtis.add(token['jti'])
+
+    def is_denied(self, jti):
+        if (self._loaded is None) or (time.monotonic() - self._loaded > settings.SIGNED_TOKEN_DENYLIST_REFRESH):
+            self.reload()
+        return jti in self._jtis
+
+    def reload(self):
+        jtis = set(DeniedToken.objects.filter(expires__gt=datetime.now(tz=timezone.utc)).values_list('jti', flat=True))
+        with self._lock:
+            self._jtis = jtis
+            self._loaded = time.monotonic()
+
+
+denylist = Denylist()
+
+
+def device_claim(device):
+    return {'id': device.id, 'registration_id': device.registration_id, 'address': device.address}
+
+
+def issue(user):
+    """Returns a new refresh token and an access token carrying the user's current device"""
+    refresh = RefreshToken.for_user(user)
+    refresh['email'] = user.email
+    # Fractional so a token issued just after a logout is not mistaken for one issued before it
+    refresh['iat'] = time.time()
+    return refresh, access_for(refresh, user)
+
+
+def access_for(refresh, user):
+    access = refresh.access_token
+    device = Device.objects.filter(user=user).only('id', 'registration_id', 'address').first()
+    if device is not None:
+        access['device'] = device_claim(device)
+    return access
+
+
+def refresh(raw_refresh):
+    """
+    Returns a new access token for a refresh token, with the device claim read
+    afresh. Raises TokenError if the refresh token is invalid or revoked.
+    """
+    refresh = RefreshToken(raw_refresh)
+    if denylist.is_denied(refresh['jti']):
+        raise TokenError(_('Token has been revoked'))
+    user = get_user_model().objects.filter(id=refresh['user_id'], is_active=True).select_related('signed_token_cutoff').first()
+    if user is None:
+        raise TokenError(_('User not found'))
+    if hasattr(user, 'signed_token_cutoff') and (issued_at(refresh) < user.signed_token_cutoff.revoked.timestamp()):
+        raise TokenError(_('Token has been revoked'))
+    return access_for(refresh, user)
+
+
+def issued_at(refresh):
+    # Tokens issued without an "iat" claim are dated from their expiry
+    return refresh.get('iat', refresh['exp'] - api_settings.REFRESH_TOKEN_LIFETIME.total_seconds())
+
+
+def revoke_all(user_id):
+    """Refuses every refresh token issued to the user until now"""
+    SignedTokenCutoff.objects.update_or_create(user_id=user_id, defaults={'revoked': datetime.now(tz=timezone.utc)})
+
+
+@receiver(user_logged_out)
+def user_logged_out_callback(sender, user, **kwargs):
+    # Sent by djoser's token logout, and on password change when LOGOUT_ON_PASSWORD_CHANGE is set
+    if user is not None:
+        revoke_all(user.pk)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def password_changed_callback(sender, instance, created, **kwargs):
+    # set_password() keeps the new password until save() has finished, djoser's
+    # password change and reset confirmation both save through it
+    if (not created) and (getattr(instance, '_password', None) is not None):
+        revoke_all(instance.pk)
+
+
+class SignedTokenAuthentication(JWTAuthentication):
+    """
+    Authenticates "Bearer" access tokens when SIGNED_TOKENS_ENABLED is set.
+    The user and their device are built from the token's claims, the device's
+    counters are loaded from the database only when read.
+    """
+
+    def authenticate(self, request):
+        if not settings.SIGNED_TOKENS_ENABLED:
+            return None
+        return super().authenticate(request)
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if denylist.is_denied(token['jti']):
+            raise InvalidToken(_('Token has been revoked'))
+        return token
+
+    def get_user(self, validated_token):
+        try:
+            user = get_user_model()(id=validated_token['user_id'], email=validated_token.get('email', ''), is_active=True)
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        user._state.adding = False
+        user._state.db = 'default'
+        claim = validated_token.get('device')
+        if claim is None:
+            # Cache the absence so hasattr(user, 'device') does not query
+            get_user_model().device.related.set_cached_value(user, None)
+        else:
+            device = Device(id=claim['id'], user=user, registration_id=claim['registration_id'], address=claim['address'])
+            device._state.adding = False
+            device._state.db = 'default'
+            # Everything else is deferred and loaded on first use
+            for field in ('identity_key', 'prekey_count', 'inbox_count'):
+                device.__dict__.pop(field, None)
+            user.device = device
+        return user
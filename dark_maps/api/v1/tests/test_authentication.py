@@ -0,0 +1,109 @@
+"""
+Tests for the cached token authentication
+"""
+
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from dark_maps.api.v1.models import Device
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CachedTokenAuthenticationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.device1 = Device.objects.create(
+            user=self.user1,
+            address='testuser1@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234
+        )
+        self.token = Token.objects.create(user=self.user1)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+    def test_single_query(self):
+        """Token, user and device are loaded together, then served from the cache"""
+        # Authentication, then the inbox
+        with self.assertNumQueries(2):
+            response = self.client.delete('/v1/1234/messages/', ['1'], format='json')
+        self.assertEqual(response.status_code, 200)
+        # The inbox only
+        with self.assertNumQueries(1):
+            response = self.client.delete('/v1/1234/messages/', ['1'], format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_counters_not_cached(self):
+        """Device counters are read fresh while the rest of the device is cached"""
+        self.client.get('/v1/devices/')
+        Device.objects.adjust_counts(self.device1, prekey_count=3)
+        # The inbox, then the counter
+        with self.assertNumQueries(2):
+            response = self.client.get('/v1/1234/messages/')
+        self.assertEqual(response['X-Prekeys-Remaining'], '3')
+
+    def test_invalid_token(self):
+        """Unknown tokens are refused"""
+        self.client.credentials(HTTP_AUTHORIZATION="Token abcdef")
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_logout(self):
+        """Logging out removes the cached token"""
+        self.client.get('/v1/devices/')
+        response = self.client.post('/v1/auth/logout/')
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_deleted(self):
+        """Deleting the token removes it from the cache"""
+        self.client.get('/v1/devices/')
+        self.token.delete()
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_user_deactivated(self):
+        """Deactivating the user removes their cached tokens"""
+        self.client.get('/v1/devices/')
+        self.user1.is_active = False
+        self.user1.save()
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_device_deleted(self):
+        """Deleting the device removes the cached device"""
+        self.client.get('/v1/devices/')
+        response = self.client.delete('/v1/devices/')
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_device_created(self):
+        """Creating a device replaces the cached absence of one"""
+        self.device1.delete()
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post('/v1/devices/', {
+            'address': 'testuser1@test.com.1',
+            'identity_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            'registration_id': 5678,
+            'pre_keys': [
+                {'key_id': 1, 'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'}
+            ],
+            'signed_pre_key': {
+                'key_id': 1,
+                'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+                'signature': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+            }
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['registration_id'], 5678)
+        self.assertEqual(response['X-Prekeys-Remaining'], '1')
@@ -0,0 +1,39 @@
+"""
+Tests for the serializer and view benchmarks
+"""
+
+from unittest import mock
+
+from django.test import TestCase
+
+from benchmarks import serializers as benchmarks
+
+class BenchmarkTestCase(TestCase):
+    def test_run(self):
+        """Every benchmark runs and reports each size"""
+        with mock.patch.object(benchmarks, 'OBJECTS_PER_TIMING', 4):
+            results = benchmarks.run(sizes=(1, 2), repeat=2)
+        self.assertEqual(set(results), {name for name, _, _, _ in benchmarks.BENCHMARKS})
+        for name, sizes in results.items():
+            self.assertEqual(set(sizes), {'1', '2'})
+            for size, result in sizes.items():
+                self.assertEqual(result['repeat'], 2)
+                self.assertLessEqual(result['best'], result['median'])
+        self.assertEqual(results['MessageSerializer.serialize']['2']['calls'], 2)
+        self.assertAlmostEqual(results['MessageSerializer.serialize']['2']['per_object'], results['MessageSerializer.serialize']['2']['best'] / 2)
+        self.assertEqual(results['POST message']['2']['per_object'], results['POST message']['2']['best'])
+
+    def test_run_selected(self):
+        with mock.patch.object(benchmarks, 'OBJECTS_PER_TIMING', 1):
+            results = benchmarks.run(sizes=(1,), repeat=1, names=['PreKeySerializer.validate'])
+        self.assertEqual(list(results), ['PreKeySerializer.validate'])
+
+    def test_compare(self):
+        """Results slower than the previous run by more than the tolerance are flagged"""
+        previous = {'GET messages': {'1': {'best': 1.0}, '100': {'best': 1.0}}}
+        current = {
+            'GET messages': {'1': {'best': 1.2}, '100': {'best': 1.3}, '10000': {'best': 9.0}},
+            'POST message': {'1': {'best': 5.0}},
+        }
+        self.assertEqual(benchmarks.compare(previous, current, 0.25), [('GET messages', '100', 1.0, 1.3)])
+        self.assertEqual(benchmarks.compare({}, current, 0.25), [])
@@ -7,6 +7,8 @@ from django.contrib.auth import get_user_model
 
 from rest_framework.test import APIClient
 
+from dark_maps.api.v1.models import Device
+
 
 class DeviceTestCase(TestCase):
     def setUp(self):
@@ -46,6 +48,58 @@ class DeviceTestCase(TestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.data['code'], 'device_created')
 
+    def test_device_creation_duplicate_prekeys(self):
+        """A device cannot be created with two prekeys sharing a keyID"""
+        response = self.client.post('/v1/devices/', {
+            'address': 'test.1',
+            'identity_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            'registration_id': 1234,
+            'pre_keys': [
+                {
+                    'key_id': 1,
+                    'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+                },
+                {
+                    'key_id': 1,
+                    'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+                }
+            ],
+            'signed_pre_key': {
+                'key_id': 1,
+                'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+                'signature': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+            }
+        }, format='json')
+        self.user.refresh_from_db()
+        self.assertEqual(hasattr(self.user, 'device'), False)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['code'], 'incorrect_arguments')
+
+    def test_device_creation_duplicate_address(self):
+        """A device cannot be created with another device's address"""
+        other = get_user_model().objects.create_user(email='otheruser@test.com', password='12345')
+        Device.objects.create(user=other, address='test.1', identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd', registration_id=5678)
+        response = self.client.post('/v1/devices/', {
+            'address': 'test.1',
+            'identity_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            'registration_id': 1234,
+            'pre_keys': [
+                {
+                    'key_id': 1,
+                    'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+                }
+            ],
+            'signed_pre_key': {
+                'key_id': 1,
+                'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+                'signature': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+            }
+        }, format='json')
+        self.user.refresh_from_db()
+        self.assertEqual(hasattr(self.user, 'device'), False)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['code'], 'incorrect_arguments')
+
     def test_incorrect_device_creation(self):
         """A device cannot be created in the incorrect format"""
         response = self.client.post('/v1/devices/', {
@@ -0,0 +1,135 @@
+"""
+Tests for the device directory cache
+"""
+
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from rest_framework.test import APIClient
+
+from dark_maps.api.v1.models import Device, SignedPreKey
+from dark_maps.api.v1 import directory
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DirectoryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.client.force_authenticate(user=self.user1)
+        self.device1 = Device.objects.create(
+            user=self.user1,
+            address='testuser1@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234
+        )
+        self.user2 = User.objects.create_user(email='testuser2@test.com', password='12345')
+        self.device2 = Device.objects.create(
+            user=self.user2,
+            address='testuser2@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=5678
+        )
+        SignedPreKey.objects.create(
+            device=self.device2,
+            key_id=1,
+            public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            signature='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+        )
+
+    def send_message(self):
+        return self.client.post('/v1/1234/messages/', {
+            "recipient": "testuser2@test.com",
+            "message": '{"registration_id": 5678, "content": "test"}'
+        }, format='json')
+
+    def test_lookup(self):
+        """Devices can be found by their owner's email and by their address"""
+        self.assertEqual(directory.get_by_email('testuser2@test.com'), (self.device2.id, 5678, 'testuser2@test.com.1', 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'))
+        self.assertEqual(directory.get_by_address('testuser2@test.com.1').device_id, self.device2.id)
+        self.assertEqual(directory.get_by_email('testuser3@test.com'), None)
+
+    def test_send_message_cached(self):
+        """Once cached, sending a message needs no recipient lookup queries"""
+        self.send_message()
+        # Only the message insert and inbox counter update remain, inside a savepoint
+        with self.assertNumQueries(4):
+            response = self.send_message()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['recipient_address'], 'testuser2@test.com.1')
+        self.assertEqual(self.device2.received_messages.count(), 2)
+
+    def test_prekey_bundle_cached(self):
+        """Once cached, fetching a prekey bundle needs no recipient lookup queries"""
+        self.client.get('/v1/prekeybundles/74657374757365723240746573742e636f6d2e31/1234/')
+        # Signed prekey fetch and prekey count
+        with self.assertNumQueries(2):
+            response = self.client.get('/v1/prekeybundles/74657374757365723240746573742e636f6d2e31/1234/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['registration_id'], 5678)
+
+    def test_device_change_invalidates(self):
+        """Changing or deleting a device removes it from the directory"""
+        self.send_message()
+        self.device2.registration_id = 5679
+        self.device2.save()
+        self.assertEqual(directory.get_by_email('testuser2@test.com').registration_id, 5679)
+        response = self.send_message()
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['code'], 'recipient_identity_changed')
+        self.device2.delete()
+        self.assertEqual(directory.get_by_email('testuser2@test.com'), None)
+        self.assertEqual(directory.get_by_address('testuser2@test.com.1'), None)
+        response = self.send_message()
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['code'], 'no_recipient_device')
+
+    def test_registered_again_same_identity_cached_elsewhere(self):
+        """A device registered again with the same registration ID receives the message once read afresh"""
+        entry = directory.get_by_email('testuser2@test.com')
+        self.device2.delete()
+        device = Device.objects.create(user=self.user2, address='testuser2@test.com.1', identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd', registration_id=5678)
+        self.make_stale(entry)
+        response = self.send_message()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(device.received_messages.count(), 1)
+        self.assertEqual(directory.get_by_email('testuser2@test.com').device_id, device.id)
+
+    def make_stale(self, entry):
+        """Puts back entries as another process, whose cache was not cleared, would still hold them"""
+        cache.set(directory._key('email', 'testuser2@test.com'), tuple(entry))
+        cache.set(directory._key('address', entry.address), tuple(entry))
+
+    def test_deleted_device_cached_elsewhere(self):
+        """A device deleted while still cached is reported as missing rather than failing"""
+        entry = directory.get_by_email('testuser2@test.com')
+        self.device2.delete()
+        self.make_stale(entry)
+        response = self.send_message()
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['code'], 'no_recipient_device')
+        self.assertEqual(cache.get(directory._key('email', 'testuser2@test.com')), None)
+        response = self.client.get('/v1/prekeybundles/74657374757365723240746573742e636f6d2e31/1234/')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['code'], 'no_recipient_device')
+
+    def test_registered_again_cached_elsewhere(self):
+        """A device registered again while the old one is still cached is read afresh"""
+        entry = directory.get_by_email('testuser2@test.com')
+        self.device2.delete()
+        device = Device.objects.create(user=self.user2, address='testuser2@test.com.1', identity_key='efghefghefghefghefghefghefghefghefghefghefgh', registration_id=9999)
+        SignedPreKey.objects.create(device=device, key_id=1, public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd', signature='abcd' * 22)
+        self.make_stale(entry)
+        response = self.client.get('/v1/prekeybundles/74657374757365723240746573742e636f6d2e31/1234/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['registration_id'], 9999)
+        self.assertEqual(response.data['identity_key'], 'efghefghefghefghefghefghefghefghefghefghefgh')
+        self.make_stale(entry)
+        response = self.client.post('/v1/1234/messages/', {
+            "recipient": "testuser2@test.com",
+            "message": '{"registration_id": 9999, "content": "test"}'
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(device.received_messages.count(), 1)
@@ -0,0 +1,104 @@
+"""
+Tests for the request instrumentation middleware
+"""
+
+import json
+import re
+
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from rest_framework.test import APIClient
+
+from dark_maps.api.v1.models import Device, SignedPreKey
+
+def parse_server_timing(header):
+    metrics = {}
+    for entry in header.split(', '):
+        name, *params = entry.split(';')
+        metrics[name] = dict(param.split('=', 1) for param in params)
+    return metrics
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.client.force_authenticate(user=self.user1)
+        self.device1 = Device.objects.create(
+            user=self.user1,
+            address='testuser1@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234
+        )
+        self.user2 = User.objects.create_user(email='testuser2@test.com', password='12345')
+        self.device2 = Device.objects.create(
+            user=self.user2,
+            address='testuser2@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=5678
+        )
+        SignedPreKey.objects.create(
+            device=self.device2,
+            key_id=1,
+            public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            signature='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+        )
+
+    def send_message(self):
+        return self.client.post('/v1/1234/messages/', {
+            "recipient": "testuser2@test.com",
+            "message": '{"registration_id": 5678, "content": "test"}'
+        }, format='json')
+
+    def test_server_timing(self):
+        """Responses report total, database, cache and serializer timings"""
+        response = self.client.get('/v1/1234/messages/')
+        self.assertEqual(response.status_code, 200)
+        timings = parse_server_timing(response['Server-Timing'])
+        self.assertEqual(set(timings), {'total', 'db', 'cache', 'serializer'})
+        self.assertGreaterEqual(float(timings['total']['dur']), float(timings['db']['dur']))
+
+    def test_query_count(self):
+        """The database timing counts every query the request ran"""
+        self.send_message()
+        with self.assertNumQueries(1):
+            response = self.client.get('/v1/1234/messages/')
+        timings = parse_server_timing(response['Server-Timing'])
+        self.assertEqual(timings['db']['desc'], '"1 queries"')
+
+    def test_cache_hits(self):
+        """Directory lookups are counted as cache hits and misses"""
+        response = self.send_message()
+        timings = parse_server_timing(response['Server-Timing'])
+        self.assertEqual(timings['cache']['desc'], '"0 hits 1 misses"')
+        response = self.send_message()
+        timings = parse_server_timing(response['Server-Timing'])
+        self.assertEqual(timings['cache']['desc'], '"1 hits 0 misses"')
+
+    def test_error_response(self):
+        """Error responses are instrumented too"""
+        response = self.client.get('/v1/9999/messages/')
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('Server-Timing', response)
+
+    def test_log_record(self):
+        """Each request logs one structured record"""
+        with self.assertLogs('watchtower', level='INFO') as logs:
+            self.client.get('/v1/1234/messages/')
+        records = [json.loads(re.sub(r'^\[Request\] ', '', line.split(':', 2)[2])) for line in logs.output if '[Request] {' in line]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['method'], 'GET')
+        self.assertEqual(records[0]['status'], 200)
+        self.assertEqual(records[0]['db_queries'], 1)
+        self.assertIn('MessageList', records[0]['view'])
+
+    @override_settings(REQUEST_QUERY_BUDGET=0)
+    def test_query_budget(self):
+        """Requests over the query budget are logged as a warning"""
+        with self.assertLogs('watchtower', level='WARNING') as logs:
+            self.client.get('/v1/1234/messages/')
+        self.assertTrue(any('[Query budget exceeded] [1 queries]' in line for line in logs.output))
@@ -0,0 +1,41 @@
+"""
+Tests for the load test harness
+"""
+
+from django.core.servers.basehttp import WSGIServer
+from django.test import LiveServerTestCase, SimpleTestCase
+from django.test.testcases import LiveServerThread, QuietWSGIRequestHandler
+from django.contrib.auth import get_user_model
+
+import loadtest
+
+class PercentileTestCase(SimpleTestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 0.50), 50)
+        self.assertEqual(loadtest.percentile(values, 0.95), 95)
+        self.assertEqual(loadtest.percentile(values, 0.99), 99)
+        self.assertEqual(loadtest.percentile([7], 0.99), 7)
+        self.assertIsNone(loadtest.percentile([], 0.5))
+
+class SerialLiveServerThread(LiveServerThread):
+    # The in-memory test database raises "table is locked" for concurrent writes
+    def _create_server(self):
+        return WSGIServer((self.host, self.port), QuietWSGIRequestHandler, allow_reuse_address=False)
+
+class LoadTestTestCase(LiveServerTestCase):
+    server_thread_class = SerialLiveServerThread
+
+    def test_run(self):
+        """A short run exercises every endpoint and removes its users"""
+        results = loadtest.run(self.live_server_url, devices=3, duration=1)
+        self.assertEqual(results['devices'], 3)
+        for endpoint in ('sign up', 'log in', 'register device'):
+            self.assertEqual(results['setup']['endpoints'][endpoint]['requests'], 3)
+            self.assertEqual(results['setup']['endpoints'][endpoint]['errors'], 0)
+        steady = results['steady']['endpoints']
+        for endpoint in ('send message', 'poll inbox', 'fetch bundle'):
+            self.assertGreater(steady[endpoint]['requests'], 0)
+            self.assertEqual(steady[endpoint]['errors'], 0, steady[endpoint]['statuses'])
+            self.assertLessEqual(steady[endpoint]['p50'], steady[endpoint]['p99'])
+        self.assertFalse(get_user_model().objects.filter(email__startswith='loadtest-').exists())
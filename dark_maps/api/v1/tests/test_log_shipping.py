@@ -0,0 +1,91 @@
+"""
+Tests for the queued log shipping handler
+"""
+
+import logging
+import threading
+
+from django.test import SimpleTestCase
+
+from dark_maps.api.v1.log_shipping import QueuedBatchHandler, InMemoryLogHandler
+
+class BlockingLogHandler(InMemoryLogHandler):
+    """Holds the listener on its first record until released"""
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+    def emit(self, record):
+        self.released.wait(5)
+        super().emit(record)
+
+class LogShippingTestCase(SimpleTestCase):
+    def make_logger(self, handler):
+        logger = logging.getLogger(f"log_shipping_test_{id(handler)}")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(handler.close)
+        return logger
+
+    def test_records_shipped(self):
+        """Records reach the target formatted once, with their arguments merged"""
+        sink = InMemoryLogHandler()
+        handler = QueuedBatchHandler(sink)
+        handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+        logger = self.make_logger(handler)
+        logger.info("[Test] [%s]", "one")
+        logger.error("[Test] [two]")
+        handler.flush()
+        self.assertEqual(sink.records, ["[INFO] [Test] [one]", "[ERROR] [Test] [two]"])
+
+    def test_batches(self):
+        """The target is flushed once per batch rather than once per record"""
+        sink = InMemoryLogHandler()
+        handler = QueuedBatchHandler(sink, batch_size=10, flush_interval=5)
+        logger = self.make_logger(handler)
+        for i in range(25):
+            logger.info(f"[Test] [{i}]")
+        handler.flush()
+        self.assertEqual([len(batch) for batch in sink.batches if batch], [10, 10, 5])
+
+    def test_backpressure(self):
+        """INFO records are sampled and then dropped once the queue fills, errors wait for room"""
+        sink = BlockingLogHandler()
+        handler = QueuedBatchHandler(sink, queue_size=10, batch_size=1, high_water=0.5, info_sample_rate=2, block_timeout=5)
+        logger = self.make_logger(handler)
+        # The listener takes the first record and waits on the sink
+        logger.info("[Test] [first]")
+        while handler.queue.qsize():
+            pass
+        for i in range(20):
+            logger.info(f"[Test] [{i}]")
+        # 5 records below the high water mark, 5 of the next 10 sampled, the last 5 dropped
+        self.assertEqual(handler.queue.qsize(), 10)
+        self.assertEqual(handler.dropped, 10)
+        threading.Timer(0.1, sink.released.set).start()
+        logger.error("[Test] [error]")
+        handler.flush()
+        self.assertEqual(len(sink.records), 13)
+        self.assertEqual(sink.records[-1], "[Test] [error]")
+        self.assertIn("[Logging] [Dropped 10 records]", sink.records)
+
+    def test_flush_on_close(self):
+        """Closing the handler, as logging.shutdown does, ships every queued record"""
+        sink = InMemoryLogHandler()
+        handler = QueuedBatchHandler(sink, flush_interval=60)
+        logger = self.make_logger(handler)
+        logger.info("[Test] [pending]")
+        handler.close()
+        self.assertEqual(sink.records, ["[Test] [pending]"])
+        self.assertFalse(any(thread.name == 'log-shipping' and thread is handler.listener._thread for thread in threading.enumerate()))
+
+    def test_target_config(self):
+        """The target can be given as a dictConfig style class and arguments"""
+        handler = QueuedBatchHandler({"class": "dark_maps.api.v1.log_shipping.InMemoryLogHandler"})
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        logger = self.make_logger(handler)
+        logger.info("[Test] [configured]")
+        handler.flush()
+        self.assertIsInstance(handler.target, InMemoryLogHandler)
+        self.assertEqual(handler.target.records, ["INFO [Test] [configured]"])
@@ -0,0 +1,101 @@
+"""
+Tests long polls parked on the ASGI event loop
+"""
+
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+
+from rest_framework.authtoken.models import Token
+
+from dark_maps.api.v1.fanout import get_fanout
+from dark_maps.api.v1.long_poll import long_poll, requested_wait
+from dark_maps.api.v1.models import Device, Message
+
+
+class RecordingApplication:
+    """Stands in for Django, recording the scope of each request it is passed"""
+
+    def __init__(self):
+        self.scopes = []
+
+    async def __call__(self, scope, receive, send):
+        self.scopes.append(scope)
+
+
+def http_scope(query_string, token=None, path='/v1/1234/messages/'):
+    headers = [(b'authorization', f'Token {token}'.encode())] if token else []
+    return {'type': 'http', 'method': 'GET', 'path': path, 'headers': headers, 'query_string': query_string}
+
+
+class LongPollTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.token1 = Token.objects.create(user=self.user1)
+        self.device1 = Device.objects.create(
+            user=self.user1,
+            address='test1.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234
+        )
+
+    def add_message(self):
+        return Message.objects.create(recipient=self.device1, content='test', sender_registration_id=5678, sender_address='test2.1')
+
+    def test_requested_wait(self):
+        """Only GETs of an inbox with a wait in range are long polls"""
+        self.assertEqual(requested_wait(http_scope(b'wait=5')), 5)
+        self.assertEqual(requested_wait(http_scope(b'after=3&wait=30&limit=10')), 30)
+        self.assertEqual(requested_wait(http_scope(b'')), 0)
+        self.assertEqual(requested_wait(http_scope(b'wait=3600')), 0)
+        self.assertEqual(requested_wait(http_scope(b'wait=x')), 0)
+        self.assertEqual(requested_wait(http_scope(b'wait=5', path='/v1/devices/')), 0)
+        self.assertEqual(requested_wait(dict(http_scope(b'wait=5'), method='POST')), 0)
+
+    def test_waiting_messages(self):
+        """A long poll is passed on straight away when messages are waiting, without its wait"""
+        self.add_message()
+        application = RecordingApplication()
+        tic = time.perf_counter()
+        async_to_sync(long_poll)(http_scope(b'after=0&wait=5&limit=10', self.token1.key), None, None, application)
+        self.assertLess(time.perf_counter() - tic, 5)
+        self.assertEqual(application.scopes[0]['query_string'], b'after=0&limit=10')
+
+    def test_woken_without_blocking(self):
+        """A parked long poll is woken by a new message and does not hold up other requests"""
+        application = RecordingApplication()
+
+        async def run():
+            poll = asyncio.ensure_future(long_poll(http_scope(b'wait=10', self.token1.key), None, None, application))
+            await asyncio.sleep(0.2)
+            # The thread Django runs synchronous views on is free while the poll is parked
+            await asyncio.wait_for(sync_to_async(Device.objects.count)(), 1)
+            self.assertEqual(application.scopes, [])
+            message = await sync_to_async(self.add_message)()
+            get_fanout().publish(self.device1.id, lambda: {'id': message.id})
+            await asyncio.wait_for(poll, 5)
+
+        tic = time.perf_counter()
+        async_to_sync(run)()
+        self.assertLess(time.perf_counter() - tic, 10)
+        self.assertEqual([scope['query_string'] for scope in application.scopes], [b''])
+
+    def test_times_out(self):
+        application = RecordingApplication()
+        tic = time.perf_counter()
+        async_to_sync(long_poll)(http_scope(b'wait=1', self.token1.key), None, None, application)
+        self.assertGreaterEqual(time.perf_counter() - tic, 1)
+        self.assertEqual(len(application.scopes), 1)
+
+    def test_not_authenticated(self):
+        """Requests that fail authentication are passed on at once for the view to refuse"""
+        application = RecordingApplication()
+        tic = time.perf_counter()
+        async_to_sync(long_poll)(http_scope(b'wait=5', 'invalid'), None, None, application)
+        async_to_sync(long_poll)(http_scope(b'wait=5'), None, None, application)
+        self.assertLess(time.perf_counter() - tic, 5)
+        self.assertEqual(len(application.scopes), 2)
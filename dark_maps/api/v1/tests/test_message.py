@@ -2,12 +2,16 @@
 Tests for the message view
 """
 
-from django.test import TestCase
+import threading
+import time
+
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 
 from rest_framework.test import APIClient
 
 from dark_maps.api.v1.models import Device, PreKey, SignedPreKey, Message
+from dark_maps.api.v1.notifications import inbox_notifier
 
 class MessageTestCase(TestCase):
     def setUp(self):
@@ -168,6 +172,121 @@ class MessageTestCase(TestCase):
         self.assertEqual(isinstance(response.data, list), True)
         self.assertEqual(len(response.data), 0)
 
+    def test_receive_message_paginated(self):
+        """Messages can be recieved a page at a time using a cursor"""
+        for x in range(4):
+            Message.objects.create(
+                recipient=self.device1,
+                content='{"registration_id": 1234, "content": "test"}',
+                sender_registration_id=5678,
+                sender_address='test2.1'
+            )
+        response = self.client.get('/v1/1234/messages/?limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x['id'] for x in response.data['results']], [1, 2])
+        self.assertEqual(response.data['next'], 2)
+        response = self.client.get('/v1/1234/messages/?after=2&limit=2')
+        self.assertEqual([x['id'] for x in response.data['results']], [3, 4])
+        self.assertEqual(response.data['next'], 4)
+        response = self.client.get('/v1/1234/messages/?after=4&limit=2')
+        self.assertEqual([x['id'] for x in response.data['results']], [5])
+        self.assertEqual(response.data['results'][0]['recipient_address'], 'test1.1')
+        self.assertEqual(response.data['next'], None)
+
+    def test_receive_message_paginated_incorrect_arguments(self):
+        """Invalid pagination parameters are rejected"""
+        response = self.client.get('/v1/1234/messages/?after=abc')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['code'], "incorrect_arguments")
+        response = self.client.get('/v1/1234/messages/?limit=0')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['code'], "incorrect_arguments")
+
+    def test_consume_messages(self):
+        """Messages can be recieved and deleted in a single request"""
+        Message.objects.create(
+            recipient=self.device1,
+            content='{"registration_id": 1234, "content": "test2"}',
+            sender_registration_id=5678,
+            sender_address='test2.1'
+        )
+        Message.objects.create(
+            recipient=self.device2,
+            content='{"registration_id": 5678, "content": "test3"}',
+            sender_registration_id=1234,
+            sender_address='test1.1'
+        )
+        response = self.client.get('/v1/1234/messages/?consume=true&limit=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x['id'] for x in response.data], [1])
+        self.assertEqual(response.data[0]['recipient_address'], 'test1.1')
+        self.assertEqual(response.data[0]['content'], '{"registration_id": 1234, "content": "test"}')
+        response = self.client.get('/v1/1234/messages/?consume=true')
+        self.assertEqual([x['id'] for x in response.data], [2])
+        response = self.client.get('/v1/1234/messages/?consume=true')
+        self.assertEqual(response.data, [])
+        self.assertEqual(self.device1.received_messages.count(), 0)
+        self.assertEqual(self.device2.received_messages.count(), 1)
+
+    def test_long_poll_returns_waiting_messages(self):
+        """A long poll returns immediately when messages are already waiting"""
+        tic = time.perf_counter()
+        response = self.client.get('/v1/1234/messages/?wait=5')
+        self.assertLess(time.perf_counter() - tic, 5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]['id'], 1)
+
+    def test_long_poll_times_out(self):
+        """A long poll on an empty inbox returns an empty array once the wait expires"""
+        self.client.force_authenticate(user=self.user2)
+        tic = time.perf_counter()
+        response = self.client.get('/v1/5678/messages/?wait=1')
+        self.assertGreaterEqual(time.perf_counter() - tic, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [])
+
+    def test_long_poll_woken_by_message(self):
+        """A long poll is woken as soon as a message is stored for the device"""
+        self.client.force_authenticate(user=self.user2)
+        timer = threading.Timer(0.2, inbox_notifier.wake, [self.device2.id])
+        timer.start()
+        tic = time.perf_counter()
+        response = self.client.get('/v1/5678/messages/?wait=10')
+        timer.join()
+        self.assertLess(time.perf_counter() - tic, 10)
+        self.assertEqual(response.status_code, 200)
+
+    def test_send_message_notifies_recipient(self):
+        """Storing a message wakes listeners for the recipient device once committed"""
+        with inbox_notifier.listen(self.device2.id) as message_stored:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/v1/1234/messages/', {
+                    "recipient": "testuser2@test.com",
+                    "message": '{"registration_id": 5678, "content": "test"}'
+                }, format='json')
+            self.assertEqual(message_stored.is_set(), True)
+
+    @override_settings(MESSAGE_LONG_POLL_MAX_WAITERS=0)
+    def test_long_poll_busy(self):
+        """Once every place for a parked request is taken, long polls on an empty inbox are refused"""
+        self.client.force_authenticate(user=self.user2)
+        tic = time.perf_counter()
+        response = self.client.get('/v1/5678/messages/?wait=5')
+        self.assertLess(time.perf_counter() - tic, 5)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.data['code'], "long_poll_busy")
+        self.assertEqual(response['Retry-After'], "1")
+        # Waiting messages are still returned, as no wait is needed
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.get('/v1/1234/messages/?wait=5')
+        self.assertEqual(response.status_code, 200)
+
+    def test_long_poll_incorrect_arguments(self):
+        """A wait longer than the allowed maximum is rejected"""
+        response = self.client.get('/v1/1234/messages/?wait=3600')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['code'], "incorrect_arguments")
+
     def test_delete_message_not_owner(self):
         """User cannot delete messages they do not own"""
         self.client.force_authenticate(user=self.user2)
@@ -181,6 +300,105 @@ class MessageTestCase(TestCase):
         self.assertEqual(len(response.data), 1)
         self.assertEqual(response.data[0], 'not_message_owner')
 
+    def test_delete_messages_mixed(self):
+        """Deleting a mix of owned, unowned and missing messages reports on each and uses constant queries"""
+        Message.objects.create(
+            recipient=self.device1,
+            content='{"registration_id": 1234, "content": "test2"}',
+            sender_registration_id=5678,
+            sender_address='test2.1'
+        )
+        Message.objects.create(
+            recipient=self.device2,
+            content='{"registration_id": 5678, "content": "test3"}',
+            sender_registration_id=1234,
+            sender_address='test1.1'
+        )
+        # One lookup query, then the delete and inbox counter update inside a savepoint
+        with self.assertNumQueries(5):
+            response = self.client.delete('/v1/1234/messages/', [1, 3, 99, 2, 1, 'abc'], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [
+            'message_deleted',
+            'not_message_owner',
+            'non-existant_message',
+            'message_deleted',
+            'non-existant_message',
+            'non-existant_message'
+        ])
+        self.assertEqual(self.device1.received_messages.count(), 0)
+        self.assertEqual(self.device2.received_messages.count(), 1)
+
+    def test_send_message_v2(self):
+        """Version 2 messages are stored as raw ciphertext"""
+        response = self.client.post('/v1/1234/messages/', {
+            "recipient": "testuser2@test.com",
+            "registration_id": 5678,
+            "ciphertext": "AAECAw=="
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['ciphertext'], "AAECAw==")
+        message = self.user2.device.received_messages.first()
+        self.assertEqual(bytes(message.ciphertext), b'\x00\x01\x02\x03')
+        self.assertEqual(message.content, '')
+
+    def test_receive_message_v2(self):
+        """Version 2 messages can be recieved in either envelope format"""
+        Message.objects.create(
+            recipient=self.device1,
+            ciphertext=b'\x00\x01\x02\x03',
+            sender_registration_id=5678,
+            sender_address='test2.1'
+        )
+        response = self.client.get('/v1/1234/messages/')
+        self.assertEqual(response.data[0]['content'], '{"registration_id": 1234, "content": "test"}')
+        self.assertEqual(response.data[1]['content'], '{"registration_id": 1234, "content": "AAECAw=="}')
+        response = self.client.get('/v1/1234/messages/?envelope=2')
+        self.assertEqual(response.data[0]['content'], '{"registration_id": 1234, "content": "test"}')
+        self.assertEqual('ciphertext' in response.data[0], False)
+        self.assertEqual(response.data[1]['ciphertext'], 'AAECAw==')
+        self.assertEqual('content' in response.data[1], False)
+
+    def test_send_message_v2_invalid(self):
+        """Version 2 messages which are not base64 encoded or have no registration ID are rejected"""
+        response = self.client.post('/v1/1234/messages/', {
+            "recipient": "testuser2@test.com",
+            "registration_id": 5678,
+            "ciphertext": "not base64"
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/v1/1234/messages/', {
+            "recipient": "testuser2@test.com",
+            "ciphertext": "AAECAw=="
+        }, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['code'], "incorrect_arguments")
+        self.assertEqual(self.user2.device.received_messages.count(), 0)
+
+    def test_inbox_count(self):
+        """The recipient's inbox counter follows messages as they are sent, deleted and consumed"""
+        for x in range(3):
+            self.client.post('/v1/1234/messages/', {
+                "recipient": "testuser2@test.com",
+                "message": '{"registration_id": 5678, "content": "test"}'
+            }, format='json')
+        self.device2.refresh_from_db()
+        self.assertEqual(self.device2.inbox_count, 3)
+        self.client.force_authenticate(user=self.user2)
+        self.client.delete('/v1/5678/messages/', [2], format='json')
+        self.device2.refresh_from_db()
+        self.assertEqual(self.device2.inbox_count, 2)
+        self.client.get('/v1/5678/messages/?consume=true')
+        self.device2.refresh_from_db()
+        self.assertEqual(self.device2.inbox_count, 0)
+
+    def test_receive_message_prekeys_remaining(self):
+        """Fetching messages reports how many prekeys the device has left"""
+        Device.objects.filter(id=self.device1.id).update(prekey_count=1)
+        self.user1.device.refresh_from_db()
+        response = self.client.get('/v1/1234/messages/')
+        self.assertEqual(response['X-Prekeys-Remaining'], '1')
+
     def test_put_message(self):
         """The /messages PUT method should fail"""
         response = self.client.put('/v1/1234/messages/', [], format='json')
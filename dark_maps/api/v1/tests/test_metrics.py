@@ -0,0 +1,103 @@
+"""
+Tests for the Prometheus metrics endpoint
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.urls import resolve
+
+from prometheus_client import REGISTRY
+
+from rest_framework.test import APIClient
+
+from dark_maps.api.v1 import metrics
+from dark_maps.api.v1.instrumentation import RequestMetrics
+from dark_maps.api.v1.models import Device
+
+WORKER_SCRIPT = """
+import django, os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'dark_maps.development_settings'
+django.setup()
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.urls import resolve
+from dark_maps.api.v1 import metrics
+from dark_maps.api.v1.instrumentation import RequestMetrics
+request = RequestFactory().get('/v1/1234/messages/')
+request.resolver_match = resolve('/v1/1234/messages/')
+metrics.observe(request, HttpResponse(status=200), RequestMetrics(), 0.01)
+"""
+
+@override_settings(METRICS_TOKEN='scrape')
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.client.force_authenticate(user=self.user1)
+        self.device1 = Device.objects.create(
+            user=self.user1,
+            address='testuser1@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234
+        )
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_recorded(self):
+        """Latency, status codes and query counts are recorded per view"""
+        before = self.sample('darkmaps_request_latency_seconds_count', view='MessageList', method='GET')
+        before_ok = self.sample('darkmaps_responses_total', view='MessageList', method='GET', status='200')
+        before_queries = self.sample('darkmaps_request_db_queries_sum', view='MessageList', method='GET')
+        self.client.get('/v1/1234/messages/')
+        self.assertEqual(self.sample('darkmaps_request_latency_seconds_count', view='MessageList', method='GET'), before + 1)
+        self.assertEqual(self.sample('darkmaps_responses_total', view='MessageList', method='GET', status='200'), before_ok + 1)
+        self.assertEqual(self.sample('darkmaps_request_db_queries_sum', view='MessageList', method='GET'), before_queries + 1)
+
+    def test_untracked_views(self):
+        """Views outside the API are grouped together"""
+        before = self.sample('darkmaps_request_latency_seconds_count', view='other', method='GET')
+        self.client.get('/')
+        self.assertEqual(self.sample('darkmaps_request_latency_seconds_count', view='other', method='GET'), before + 1)
+
+    def test_throttled(self):
+        """Throttled responses are counted"""
+        request = RequestFactory().get('/v1/prekeybundles/dGVzdA==.1/1234/')
+        request.resolver_match = resolve('/v1/prekeybundles/dGVzdA==.1/1234/')
+        before = self.sample('darkmaps_throttled_requests_total', view='PreKeyBundleView', method='GET')
+        metrics.observe(request, HttpResponse(status=429), RequestMetrics(), 0.01)
+        self.assertEqual(self.sample('darkmaps_throttled_requests_total', view='PreKeyBundleView', method='GET'), before + 1)
+
+    def test_endpoint(self):
+        """The endpoint serves the metrics to a client with the scrape token"""
+        self.client.get('/v1/1234/messages/')
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'darkmaps_request_latency_seconds_bucket{', response.content)
+
+    def test_endpoint_token(self):
+        """The endpoint refuses clients without the scrape token"""
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 401)
+        with self.settings(METRICS_TOKEN=None):
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 404)
+
+    def test_multiprocess(self):
+        """Samples written by separate worker processes are added together"""
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory)
+            for _ in range(2):
+                subprocess.run([sys.executable, '-c', WORKER_SCRIPT], env=env, check=True, cwd=os.getcwd())
+            with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+                body, _ = metrics.render()
+        self.assertIn(b'darkmaps_request_latency_seconds_count{method="GET",view="MessageList"} 2.0', body)
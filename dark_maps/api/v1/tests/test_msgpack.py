@@ -0,0 +1,142 @@
+"""
+Tests MessagePack requests and responses, with ciphertext as raw bytes and keys as text
+"""
+
+import base64
+import json
+
+import msgpack
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+
+from rest_framework.test import APIClient
+from dark_maps.api.v1.models import Device, PreKey, SignedPreKey, Message
+
+IDENTITY_KEY = bytes(range(33))
+PUBLIC_KEY = bytes(range(100, 133))
+SIGNATURE = bytes(range(66))
+
+def b64(value):
+    return base64.b64encode(value).decode()
+
+class MessagePackTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.client.force_authenticate(user=self.user1)
+        self.device1 = Device.objects.create(user=self.user1, address='testuser1@test.com.1', identity_key=b64(IDENTITY_KEY), registration_id=1234)
+        SignedPreKey.objects.create(device=self.device1, key_id=1, public_key=b64(PUBLIC_KEY), signature=b64(SIGNATURE))
+        self.user2 = User.objects.create_user(email='testuser2@test.com', password='12345')
+        self.device2 = Device.objects.create(user=self.user2, address='testuser2@test.com.1', identity_key=b64(IDENTITY_KEY), registration_id=5678, prekey_count=1)
+        PreKey.objects.create(device=self.device2, key_id=1, public_key=b64(PUBLIC_KEY))
+        SignedPreKey.objects.create(device=self.device2, key_id=1, public_key=b64(PUBLIC_KEY), signature=b64(SIGNATURE))
+
+    def get(self, url):
+        response = self.client.get(url, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        return response, msgpack.unpackb(response.content)
+
+    def post(self, url, data):
+        response = self.client.post(url, msgpack.packb(data), content_type='application/msgpack', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        return response, msgpack.unpackb(response.content) if response.content else None
+
+    def test_device(self):
+        """Devices are registered and returned with their keys as text"""
+        self.client.force_authenticate(user=get_user_model().objects.create_user(email='testuser3@test.com', password='12345'))
+        response, _ = self.post('/v1/devices/', {
+            'address': 'testuser3@test.com.1',
+            'identity_key': b64(IDENTITY_KEY),
+            'registration_id': 4321,
+            'pre_keys': [{'key_id': 1, 'public_key': b64(PUBLIC_KEY)}],
+            'signed_pre_key': {'key_id': 1, 'public_key': b64(PUBLIC_KEY), 'signature': b64(SIGNATURE)}
+        })
+        self.assertEqual(response.status_code, 201)
+        device = Device.objects.get(address='testuser3@test.com.1')
+        self.assertEqual(device.identity_key, b64(IDENTITY_KEY))
+        self.assertEqual(device.prekey_set.get().public_key, b64(PUBLIC_KEY))
+        self.assertEqual(device.signedprekey.signature, b64(SIGNATURE))
+
+        response, data = self.get('/v1/devices/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['identity_key'], b64(IDENTITY_KEY))
+
+    def test_prekeys(self):
+        response, _ = self.post('/v1/1234/prekeys/', [{'key_id': x, 'public_key': b64(PUBLIC_KEY)} for x in range(5)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(PreKey.objects.filter(device=self.device1).values_list('public_key', flat=True).distinct()), [b64(PUBLIC_KEY)])
+
+    def test_prekey_bundle(self):
+        address = self.device2.address.encode().hex()
+        response, data = self.get(f'/v1/prekeybundles/{address}/1234/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['identity_key'], b64(IDENTITY_KEY))
+        self.assertEqual(data['pre_key'], {'key_id': 1, 'public_key': b64(PUBLIC_KEY)})
+        self.assertEqual(data['signed_pre_key'], {'key_id': 1, 'public_key': b64(PUBLIC_KEY), 'signature': b64(SIGNATURE)})
+
+        response, data = self.post('/v1/prekeybundles/1234/', [self.device2.address])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data[self.device2.address]['signed_pre_key']['signature'], b64(SIGNATURE))
+
+    def test_messages(self):
+        """Ciphertext is sent and received as raw bytes"""
+        ciphertext = bytes(range(256))
+        self.client.force_authenticate(user=self.user2)
+        response, data = self.post('/v1/5678/messages/', {'recipient': self.user1.email, 'registration_id': 1234, 'ciphertext': ciphertext})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data['ciphertext'], ciphertext)
+        self.assertEqual(bytes(Message.objects.get().ciphertext), ciphertext)
+
+        self.client.force_authenticate(user=self.user1)
+        response, data = self.get('/v1/1234/messages/?envelope=2&limit=10')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['results'][0]['ciphertext'], ciphertext)
+
+        # The same inbox in JSON is unchanged, and larger
+        json_response = self.client.get('/v1/1234/messages/?envelope=2&limit=10')
+        self.assertEqual(json_response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(json_response.content)['results'][0]['ciphertext'], b64(ciphertext))
+        self.assertLess(len(response.content), len(json_response.content))
+
+        # Version 1 envelopes keep the base64 text inside their JSON content
+        response, data = self.get('/v1/1234/messages/')
+        self.assertEqual(json.loads(data[0]['content'])['content'], b64(ciphertext))
+
+    def test_errors(self):
+        """Validation errors are returned in MessagePack, malformed bodies are refused"""
+        response, data = self.post('/v1/1234/signedprekeys/', {'key_id': 2, 'public_key': b64(PUBLIC_KEY[:10]), 'signature': b64(SIGNATURE)})
+        self.assertEqual(response.status_code, 400)
+        self.assertIsInstance(data, dict)
+
+        response = self.client.post('/v1/prekeybundles/1234/', b'\xc1', content_type='application/msgpack')
+        self.assertEqual(response.status_code, 400)
+
+    def test_shared_errors(self):
+        """An error sent in MessagePack is still sent in JSON to the next client"""
+        self.client.force_authenticate(user=get_user_model().objects.create_user(email='testuser3@test.com', password='12345'))
+        response, data = self.get('/v1/1234/messages/')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['code'], 'no_device')
+        response = self.client.get('/v1/1234/messages/', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content)['code'], 'no_device')
+
+    def test_fixed_types(self):
+        """Keys are always text, whatever they hold, and ciphertext always bytes"""
+        Device.objects.filter(id=self.device2.id).update(identity_key='not base64 but stored before it was checked')
+        address = self.device2.address.encode().hex()
+        _, data = self.get(f'/v1/prekeybundles/{address}/1234/')
+        self.assertEqual(data['identity_key'], 'not base64 but stored before it was checked')
+        self.assertEqual(data['signed_pre_key']['signature'], b64(SIGNATURE))
+
+        # Keys sent as bytes are refused rather than stored in another form
+        response, data = self.post('/v1/1234/signedprekeys/', {'key_id': 2, 'public_key': PUBLIC_KEY, 'signature': SIGNATURE})
+        self.assertEqual(response.status_code, 400)
+
+        # Ciphertext may still be sent as base64 text, it is returned as bytes
+        self.client.force_authenticate(user=self.user2)
+        response, data = self.post('/v1/5678/messages/', {'recipient': self.user1.email, 'registration_id': 1234, 'ciphertext': b64(b'test')})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data['ciphertext'], b'test')
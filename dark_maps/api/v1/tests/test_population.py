@@ -0,0 +1,155 @@
+"""
+Tests for the population counters
+"""
+
+from io import StringIO
+
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+
+from rest_framework.test import APIClient
+
+from dark_maps.api.v1.models import Device, PreKey, SignedPreKey, PopulationTotal
+from dark_maps.api.v1 import population
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PopulationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.user2 = User.objects.create_user(email='testuser2@test.com', password='12345')
+        self.device2 = Device.objects.create(
+            user=self.user2,
+            address='testuser2@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=5678,
+            prekey_count=2
+        )
+        SignedPreKey.objects.create(
+            device=self.device2,
+            key_id=1,
+            public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            signature='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+        )
+        for key_id in (1, 2):
+            PreKey.objects.create(device=self.device2, key_id=key_id, public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd')
+        population.reconcile()
+        self.client.force_authenticate(user=self.user1)
+
+    def create_device(self):
+        return self.client.post('/v1/devices/', {
+            'address': 'testuser1@test.com.1',
+            'identity_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            'registration_id': 1234,
+            'pre_keys': [
+                {'key_id': 1, 'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'},
+                {'key_id': 2, 'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'},
+                {'key_id': 3, 'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'}
+            ],
+            'signed_pre_key': {
+                'key_id': 1,
+                'public_key': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+                'signature': 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+            }
+        }, format='json')
+
+    def test_reconcile(self):
+        """Reconciling counts every table"""
+        self.assertEqual(population.get_totals(), {'users': 2, 'devices': 1, 'messages': 0, 'prekeys': 2})
+
+    def test_read_without_counting(self):
+        """Reading the totals is one lookup of the stored totals, never a count"""
+        with self.assertNumQueries(1):
+            population.get_totals()
+
+    def test_shared_totals(self):
+        """Totals are kept in the database, so each worker's cache holds no copy"""
+        with self.captureOnCommitCallbacks(execute=True):
+            get_user_model().objects.create_user(email='testuser3@test.com', password='12345')
+        cache.clear()
+        self.assertEqual(population.get_totals()['users'], 3)
+        self.assertEqual(PopulationTotal.objects.get(name='users').value, 3)
+
+    def test_users(self):
+        """Users are counted as they are created and deleted"""
+        with self.captureOnCommitCallbacks(execute=True):
+            user = get_user_model().objects.create_user(email='testuser3@test.com', password='12345')
+        self.assertEqual(population.get_totals()['users'], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            user.delete()
+        self.assertEqual(population.get_totals()['users'], 2)
+
+    def test_device_lifecycle(self):
+        """Devices, their prekeys and their messages are counted until the device is deleted"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_device()
+        self.assertEqual(population.get_totals(), {'users': 2, 'devices': 2, 'messages': 0, 'prekeys': 5})
+        self.user1.refresh_from_db()
+        self.client.force_authenticate(user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/v1/1234/messages/', {
+                "recipient": "testuser2@test.com",
+                "message": '{"registration_id": 5678, "content": "test"}'
+            }, format='json')
+        self.assertEqual(population.get_totals()['messages'], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get('/v1/prekeybundles/74657374757365723240746573742e636f6d2e31/1234/')
+        self.assertEqual(population.get_totals()['prekeys'], 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete('/v1/devices/')
+        self.assertEqual(population.get_totals(), {'users': 2, 'devices': 1, 'messages': 1, 'prekeys': 1})
+
+    def test_consumed_messages(self):
+        """Fetched and deleted messages leave the count"""
+        self.client.force_authenticate(user=self.user2)
+        self.user1.device = Device.objects.create(
+            user=self.user1,
+            address='testuser1@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234
+        )
+        self.client.force_authenticate(user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(2):
+                self.client.post('/v1/1234/messages/', {
+                    "recipient": "testuser1@test.com",
+                    "message": '{"registration_id": 1234, "content": "test"}'
+                }, format='json')
+        self.assertEqual(population.get_totals()['messages'], 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get('/v1/1234/messages/?consume=true&limit=1')
+        self.assertEqual(population.get_totals()['messages'], 1)
+
+    def test_missing_totals(self):
+        """Totals missing from the database are unknown until the next reconcile"""
+        PopulationTotal.objects.filter(name='users').delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            get_user_model().objects.create_user(email='testuser3@test.com', password='12345')
+        self.assertEqual(population.get_totals()['users'], None)
+        population.reconcile()
+        self.assertEqual(population.get_totals()['users'], 3)
+
+    def test_command(self):
+        """The management command reconciles the totals"""
+        PopulationTotal.objects.all().delete()
+        out = StringIO()
+        call_command('reconcile_population', stdout=out)
+        self.assertIn('users: 2', out.getvalue())
+        self.assertEqual(population.get_totals()['prekeys'], 2)
+
+    def test_admin_view(self):
+        """Staff can read and reconcile the totals, other users cannot"""
+        client = APIClient()
+        client.force_login(self.user1)
+        response = client.get('/admin/population/')
+        self.assertEqual(response.status_code, 302)
+        staff = get_user_model().objects.create_user(email='staff@test.com', password='12345', is_staff=True)
+        client.force_login(staff)
+        response = client.get('/admin/population/')
+        self.assertEqual(response.json(), {'users': 2, 'devices': 1, 'messages': 0, 'prekeys': 2})
+        response = client.post('/admin/population/')
+        self.assertEqual(response.json(), {'users': 3, 'devices': 1, 'messages': 0, 'prekeys': 2})
@@ -86,6 +86,24 @@ class PrekeysTestCase(TestCase):
         self.assertEqual(response.data['signed_pre_key']['public_key'], 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd')
         self.assertEqual(response.data['signed_pre_key']['signature'], 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd')
 
+    def test_get_prekey_bundle_claims_distinct_prekeys(self):
+        """Each bundle fetch claims a different prekey until none remain"""
+        for key_id in [2, 3]:
+            PreKey.objects.create(
+                device=self.device2,
+                key_id=key_id,
+                public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+            )
+        claimed = []
+        for x in range(3):
+            response = self.client.get('/v1/prekeybundles/74657374757365723240746573742e636f6d2e31/1234/', format='json')
+            self.assertEqual(response.status_code, 200)
+            claimed.append(response.data['pre_key']['key_id'])
+        self.assertEqual(claimed, [1, 2, 3])
+        response = self.client.get('/v1/prekeybundles/74657374757365723240746573742e636f6d2e31/1234/', format='json')
+        self.assertEqual('pre_key' in response.data, False)
+        self.assertEqual(PreKey.objects.claim(self.device2), None)
+
     def test_get_prekey_bundle_address_not_hex(self):
         """An error is returned if the address is not provided in hex format"""
         response = self.client.get('/v1/prekeybundles/test2.1/1234/', format='json')
@@ -123,6 +141,65 @@ class PrekeysTestCase(TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(response.data['code'], 'no_recipient_user')
 
+    def test_get_prekey_bundles_batch(self):
+        """Prekey bundles for several recipients can be obtained in one request"""
+        self.client.force_authenticate(user=self.user3)
+        Device.objects.create(
+            user=self.user3,
+            address='testuser3@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=9012
+        )
+        response = self.client.post('/v1/prekeybundles/9012/', [
+            'testuser1@test.com.1',
+            'testuser2@test.com.1',
+            'testuser4@test.com.1'
+        ], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'testuser1@test.com.1', 'testuser2@test.com.1', 'testuser4@test.com.1'})
+        self.assertEqual('pre_key' in response.data['testuser1@test.com.1'], False)
+        self.assertEqual(response.data['testuser1@test.com.1']['registration_id'], 1234)
+        self.assertEqual(response.data['testuser2@test.com.1']['pre_key']['key_id'], 1)
+        self.assertEqual(response.data['testuser2@test.com.1']['signed_pre_key']['key_id'], 1)
+        self.assertEqual(response.data['testuser4@test.com.1'], None)
+        self.assertEqual(self.device2.prekey_set.count(), 0)
+
+    def test_get_prekey_bundles_batch_constant_queries(self):
+        """A batch bundle fetch uses the same number of queries however many recipients are requested"""
+        User = get_user_model()
+        addresses = []
+        for x in range(5, 15):
+            user = User.objects.create_user(email=f'testuser{x}@test.com', password='12345')
+            device = Device.objects.create(
+                user=user,
+                address=f'testuser{x}@test.com.1',
+                identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+                registration_id=x
+            )
+            PreKey.objects.create(device=device, key_id=1, public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd')
+            SignedPreKey.objects.create(
+                device=device,
+                key_id=1,
+                public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+                signature='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+            )
+            addresses.append(device.address)
+        # Devices, then the claim inside a savepoint: chosen prekeys, delete and counter update
+        with self.assertNumQueries(6):
+            response = self.client.post('/v1/prekeybundles/1234/', addresses, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(all(response.data[x]['pre_key']['key_id'] == 1 for x in addresses), True)
+        self.assertEqual(PreKey.objects.filter(device__address__in=addresses).count(), 0)
+
+    def test_get_prekey_bundles_batch_incorrect_arguments(self):
+        """A batch bundle fetch must include a list of addresses"""
+        response = self.client.post('/v1/prekeybundles/1234/', [], format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['code'], 'incorrect_arguments')
+        response = self.client.post('/v1/prekeybundles/1235/', ['testuser2@test.com.1'], format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['code'], 'device_changed')
+
     def test_put_prekey_bundle(self):
         """The /prekeybundle PUT method should fail"""
         response = self.client.put('/v1/prekeybundles/74657374757365723240746573742e636f6d2e31/1235/', {}, format='json')
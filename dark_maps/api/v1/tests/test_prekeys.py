@@ -2,12 +2,16 @@
 Tests for the prekey view
 """
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
 
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
 from dark_maps.api.v1.models import Device, PreKey, SignedPreKey
+from dark_maps.api.v1.serializers import PreKeySerializer
 
 class PrekeysTestCase(TestCase):
     def setUp(self):
@@ -20,7 +24,8 @@ class PrekeysTestCase(TestCase):
             user=self.user,
             address='test.1',
             identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
-            registration_id=1234
+            registration_id=1234,
+            prekey_count=1
         )
         PreKey.objects.create(
             device=self.device,
@@ -62,6 +67,74 @@ class PrekeysTestCase(TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.data['code'], 'prekey_id_exists')
 
+    def test_bulk_prekeys(self):
+        """A full set of prekeys is stored with a constant number of queries"""
+        prekeys = [{"key_id": x, "public_key": "abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd"} for x in range(2, 101)]
+        # Savepoint, prekey counter update, duplicate ID check, insert and savepoint release
+        with self.assertNumQueries(5):
+            response = self.client.post('/v1/1234/prekeys/', prekeys, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['code'], 'prekeys_stored')
+        self.assertEqual(self.device.prekey_set.count(), 100)
+
+    def test_prekey_count(self):
+        """The prekey counter follows uploads and claims and is reported to the device"""
+        response = self.client.post('/v1/1234/prekeys/', [
+            {"key_id": 2, "public_key": "abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd"},
+            {"key_id": 3, "public_key": "abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd"}
+        ], format='json')
+        self.assertEqual(response['X-Prekeys-Remaining'], '3')
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.prekey_count, 3)
+        PreKey.objects.claim(self.device)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.prekey_count, 2)
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.data['prekey_count'], 2)
+        self.assertEqual(response.data['inbox_count'], 0)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_prekey_count_cached_authentication(self):
+        """Devices loaded from the authentication cache report the stored counter after each upload"""
+        cache.clear()
+        self.client.force_authenticate(user=None)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=self.user).key}")
+        for key_id, remaining in ((2, '2'), (3, '3')):
+            response = self.client.post('/v1/1234/prekeys/', [{"key_id": key_id, "public_key": "abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd"}], format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Prekeys-Remaining'], remaining)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.prekey_count, 3)
+
+    def test_too_many_prekeys(self):
+        """Uploads which would exceed the prekey limit are rejected without storing any prekeys"""
+        prekeys = [{"key_id": x, "public_key": "abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd"} for x in range(2, 102)]
+        response = self.client.post('/v1/1234/prekeys/', prekeys, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['code'], 'reached_max_prekeys')
+        self.assertEqual(self.device.prekey_set.count(), 1)
+
+    def test_too_many_prekeys_stale_count(self):
+        """The limit is checked against the stored count, not the count read with the device"""
+        serializer = PreKeySerializer(data=[{"key_id": x, "public_key": "abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd"} for x in range(2, 12)], many=True, context={'device': self.device})
+        self.assertTrue(serializer.is_valid())
+        # Another upload stores keys after this device was read
+        Device.objects.filter(id=self.device.id).update(prekey_count=95)
+        with self.assertRaises(PermissionDenied):
+            serializer.save()
+        self.assertEqual(self.device.prekey_set.count(), 1)
+        self.assertEqual(Device.objects.get(id=self.device.id).prekey_count, 95)
+
+    def test_duplicate_prekeys_in_upload(self):
+        """Uploads containing the same keyID twice are rejected without storing any prekeys"""
+        response = self.client.post('/v1/1234/prekeys/', [
+            {"key_id": 2, "public_key": "abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd"},
+            {"key_id": 2, "public_key": "abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd"}
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['code'], 'prekey_id_exists')
+        self.assertEqual(self.device.prekey_set.count(), 1)
+
     def test_incorrect_prekeys(self):
         """Prekeys with incorrect format cannot be created"""
         response = self.client.post('/v1/1234/prekeys/', [
@@ -0,0 +1,208 @@
+"""
+Query-count budgets for the v1 endpoints. Each endpoint is called against a
+small and a large fixture and must run the same number of queries for both,
+and no more than its budget. Raise a budget only when a new query is
+intended, never to absorb one that grows with the data.
+"""
+
+import base64
+from types import SimpleNamespace
+
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from dark_maps.api.v1 import signed_tokens
+from dark_maps.api.v1.models import Device, PreKey, SignedPreKey, Message
+
+SMALL = 2
+LARGE = 20
+
+# Most queries each endpoint may run with nothing cached, including authentication
+# and the savepoints of atomic blocks
+BUDGETS = {
+    'device_get': 1,
+    'device_post': 8,
+    'device_delete': 6,
+    'prekeys_post': 6,
+    'signed_prekeys_post': 5,
+    'messages_get': 2,
+    'messages_get_v2': 2,
+    'messages_get_page': 2,
+    'messages_consume': 6,
+    'messages_post': 6,
+    'messages_post_v2': 6,
+    'messages_delete': 6,
+    'prekey_bundle_get': 8,
+    'prekey_bundle_list': 7,
+    'signed_token_issue': 2,
+    'signed_token_refresh': 2,
+    'signed_token_logout': 4,
+}
+
+IDENTITY_KEY = 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+SIGNATURE = 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, SIGNED_TOKENS_ENABLED=True)
+class QueryBudgetTestCase(TestCase):
+    def create_user(self, email):
+        user = get_user_model()(email=email)
+        user.set_unusable_password()
+        user.save()
+        return user
+
+    def create_device(self, user, address, registration_id, prekeys=0):
+        device = Device.objects.create(user=user, address=address, identity_key=IDENTITY_KEY, registration_id=registration_id, prekey_count=prekeys)
+        SignedPreKey.objects.create(device=device, key_id=1, public_key=IDENTITY_KEY, signature=SIGNATURE)
+        PreKey.objects.bulk_create([PreKey(device=device, key_id=key_id, public_key=IDENTITY_KEY) for key_id in range(prekeys)])
+        return device
+
+    def fill_inbox(self, device, sender, count):
+        # Alternate version 1 and version 2 messages so both representations are covered
+        Message.objects.bulk_create([
+            Message(
+                recipient=device,
+                content='{"registration_id": 1234, "content": "test"}' if (x % 2) else '',
+                ciphertext=None if (x % 2) else b'test',
+                sender_registration_id=sender.registration_id,
+                sender_address=sender.address
+            )
+            for x in range(count)
+        ])
+        Device.objects.filter(id=device.id).update(inbox_count=count)
+
+    def fixture(self, scale):
+        """Builds an owner and a contact with `scale` prekeys and messages each, and `scale` other users"""
+        data = SimpleNamespace()
+        data.owner = self.create_user('owner@test.com')
+        data.owner_device = self.create_device(data.owner, 'owner.1', 1234, prekeys=scale)
+        data.contact = self.create_user('contact@test.com')
+        data.contact_device = self.create_device(data.contact, 'contact.1', 5678, prekeys=scale)
+        self.fill_inbox(data.owner_device, data.contact_device, scale)
+        self.fill_inbox(data.contact_device, data.owner_device, scale)
+        data.peers = []
+        for x in range(scale):
+            peer = self.create_user(f'peer{x}@test.com')
+            data.peers.append(self.create_device(peer, f'peer{x}.1', 10000 + x, prekeys=1))
+        data.token = Token.objects.create(user=data.owner)
+        return data
+
+    def authenticate(self, user):
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+    def assertWithinBudget(self, name, prepare, status_code):
+        """
+        Runs `prepare(data, scale)` against each fixture, then counts the
+        queries run by the request it returns
+        """
+        captured = {}
+        for scale in (SMALL, LARGE):
+            with transaction.atomic():
+                self.client = APIClient()
+                data = self.fixture(scale)
+                self.authenticate(data.owner)
+                request = prepare(data, scale)
+                signed_tokens.denylist.reload()
+                cache.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    response = request()
+                self.assertEqual(response.status_code, status_code, getattr(response, 'data', None))
+                captured[scale] = [query['sql'] for query in queries.captured_queries]
+                transaction.set_rollback(True)
+        listing = '\n'.join(captured[LARGE])
+        self.assertEqual(len(captured[SMALL]), len(captured[LARGE]), f"{name} runs more queries as data grows:\n{listing}")
+        self.assertLessEqual(len(captured[LARGE]), BUDGETS[name], f"{name} is over its budget of {BUDGETS[name]} queries:\n{listing}")
+
+    def test_device_get(self):
+        self.assertWithinBudget('device_get', lambda data, scale: lambda: self.client.get('/v1/devices/'), 200)
+
+    def test_device_post(self):
+        def prepare(data, scale):
+            self.authenticate(self.create_user('newcomer@test.com'))
+            body = {
+                'address': 'newcomer.1',
+                'identity_key': IDENTITY_KEY,
+                'registration_id': 4321,
+                'pre_keys': [{'key_id': key_id, 'public_key': IDENTITY_KEY} for key_id in range(scale)],
+                'signed_pre_key': {'key_id': 1, 'public_key': IDENTITY_KEY, 'signature': SIGNATURE}
+            }
+            return lambda: self.client.post('/v1/devices/', body, format='json')
+        self.assertWithinBudget('device_post', prepare, 201)
+
+    def test_device_delete(self):
+        self.assertWithinBudget('device_delete', lambda data, scale: lambda: self.client.delete('/v1/devices/'), 204)
+
+    def test_prekeys_post(self):
+        def prepare(data, scale):
+            body = [{'key_id': 1000 + key_id, 'public_key': IDENTITY_KEY} for key_id in range(scale)]
+            return lambda: self.client.post('/v1/1234/prekeys/', body, format='json')
+        self.assertWithinBudget('prekeys_post', prepare, 200)
+
+    def test_signed_prekeys_post(self):
+        def prepare(data, scale):
+            body = {'key_id': 2, 'public_key': IDENTITY_KEY, 'signature': SIGNATURE}
+            return lambda: self.client.post('/v1/1234/signedprekeys/', body, format='json')
+        self.assertWithinBudget('signed_prekeys_post', prepare, 200)
+
+    def test_messages_get(self):
+        self.assertWithinBudget('messages_get', lambda data, scale: lambda: self.client.get('/v1/1234/messages/'), 200)
+
+    def test_messages_get_v2(self):
+        self.assertWithinBudget('messages_get_v2', lambda data, scale: lambda: self.client.get('/v1/1234/messages/?envelope=2'), 200)
+
+    def test_messages_get_page(self):
+        self.assertWithinBudget('messages_get_page', lambda data, scale: lambda: self.client.get(f'/v1/1234/messages/?limit={scale}'), 200)
+
+    def test_messages_consume(self):
+        self.assertWithinBudget('messages_consume', lambda data, scale: lambda: self.client.get(f'/v1/1234/messages/?consume=true&limit={scale}'), 200)
+
+    def test_messages_post(self):
+        def prepare(data, scale):
+            body = {'recipient': 'contact@test.com', 'message': '{"registration_id": 5678, "content": "test"}'}
+            return lambda: self.client.post('/v1/1234/messages/', body, format='json')
+        self.assertWithinBudget('messages_post', prepare, 201)
+
+    def test_messages_post_v2(self):
+        def prepare(data, scale):
+            body = {'recipient': 'contact@test.com', 'registration_id': 5678, 'ciphertext': base64.b64encode(b'test').decode()}
+            return lambda: self.client.post('/v1/1234/messages/', body, format='json')
+        self.assertWithinBudget('messages_post_v2', prepare, 201)
+
+    def test_messages_delete(self):
+        def prepare(data, scale):
+            # The owner's messages, and as many belonging to the contact
+            body = list(Message.objects.order_by('id').values_list('id', flat=True))
+            return lambda: self.client.delete('/v1/1234/messages/', body, format='json')
+        self.assertWithinBudget('messages_delete', prepare, 200)
+
+    def test_prekey_bundle_get(self):
+        self.assertWithinBudget('prekey_bundle_get', lambda data, scale: lambda: self.client.get(f"/v1/prekeybundles/{'contact.1'.encode().hex()}/1234/"), 200)
+
+    def test_prekey_bundle_list(self):
+        def prepare(data, scale):
+            body = [device.address for device in data.peers]
+            return lambda: self.client.post('/v1/prekeybundles/1234/', body, format='json')
+        self.assertWithinBudget('prekey_bundle_list', prepare, 200)
+
+    def test_signed_token_issue(self):
+        self.assertWithinBudget('signed_token_issue', lambda data, scale: lambda: self.client.post('/v1/auth/signed/'), 200)
+
+    def test_signed_token_refresh(self):
+        def prepare(data, scale):
+            refresh, _ = signed_tokens.issue(data.owner)
+            self.client.credentials()
+            return lambda: self.client.post('/v1/auth/signed/refresh/', {'refresh': str(refresh)}, format='json')
+        self.assertWithinBudget('signed_token_refresh', prepare, 200)
+
+    def test_signed_token_logout(self):
+        def prepare(data, scale):
+            refresh, access = signed_tokens.issue(data.owner)
+            self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+            return lambda: self.client.post('/v1/auth/signed/logout/', {'refresh': str(refresh)}, format='json')
+        self.assertWithinBudget('signed_token_logout', prepare, 204)
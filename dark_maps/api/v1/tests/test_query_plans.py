@@ -0,0 +1,140 @@
+"""
+Checks the hot lookups are served by an index. Each query is explained against
+a seeded database and fails if the plan scans a whole table, or sorts rows an
+index should already return in order.
+"""
+
+import re
+from datetime import timedelta
+
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Min
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
+
+from dark_maps.api.v1.models import Device, PreKey, SignedPreKey, Message, DeniedToken
+
+DEVICES = 50
+PREKEYS_PER_DEVICE = 10
+MESSAGES_PER_DEVICE = 20
+
+class QueryPlanTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        User.objects.bulk_create([User(email=f'testuser{x}@test.com', password='12345') for x in range(DEVICES)])
+        users = list(User.objects.order_by('id'))
+        Device.objects.bulk_create([
+            Device(
+                user=user,
+                address=f'testuser{x}@test.com.1',
+                identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+                registration_id=x
+            )
+            for x, user in enumerate(users)
+        ])
+        devices = list(Device.objects.order_by('id'))
+        SignedPreKey.objects.bulk_create([
+            SignedPreKey(
+                device=device,
+                key_id=1,
+                public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+                signature='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+            )
+            for device in devices
+        ])
+        PreKey.objects.bulk_create([
+            PreKey(device=device, key_id=key_id, public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd')
+            for device in devices for key_id in range(PREKEYS_PER_DEVICE)
+        ])
+        Message.objects.bulk_create([
+            Message(
+                recipient=device,
+                content='{"registration_id": 1234, "content": "test"}',
+                sender_registration_id=1,
+                sender_address='testuser1@test.com.1',
+                expires=(timezone.now() + timedelta(days=1)) if (x % 4 == 0) else None
+            )
+            for device in devices for x in range(MESSAGES_PER_DEVICE)
+        ])
+        for user in users:
+            Token.objects.create(user=user)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        cls.device = devices[DEVICES // 2]
+
+    def explain(self, queryset):
+        if connection.vendor == 'postgresql':
+            # The seeded tables are small enough that a scan is cheapest, only
+            # fall back to one when no index can serve the query
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+                cursor.execute("SET enable_sort = off")
+            try:
+                return queryset.explain()
+            finally:
+                with connection.cursor() as cursor:
+                    cursor.execute("RESET enable_seqscan")
+                    cursor.execute("RESET enable_sort")
+        return queryset.explain()
+
+    def assertIndexed(self, queryset, ordered=False):
+        plan = self.explain(queryset)
+        if connection.vendor == 'postgresql':
+            self.assertNotIn('Seq Scan', plan, f"Sequential scan for {queryset.query}\n{plan}")
+            if ordered:
+                self.assertNotRegex(plan, r'\bSort\b', f"Sort for {queryset.query}\n{plan}")
+        else:
+            # SQLite reports a full table or index scan as SCAN and an index lookup as SEARCH
+            self.assertNotRegex(plan, re.compile(r'\bSCAN (TABLE )?\S+'), f"Sequential scan for {queryset.query}\n{plan}")
+            if ordered:
+                self.assertNotIn('TEMP B-TREE', plan, f"Sort for {queryset.query}\n{plan}")
+
+    def test_device_by_address(self):
+        """Directory lookups by address, used to fetch prekey bundles"""
+        self.assertIndexed(Device.objects.filter(address=self.device.address).values_list('id', 'registration_id', 'address', 'identity_key')[:1])
+        addresses = list(Device.objects.values_list('address', flat=True)[:5])
+        self.assertIndexed(Device.objects.filter(address__in=addresses).select_related('signedprekey'))
+
+    def test_device_by_email(self):
+        """Directory lookups by the owner's email, used to send messages"""
+        self.assertIndexed(Device.objects.filter(user__email='testuser1@test.com').values_list('id', 'registration_id', 'address', 'identity_key')[:1])
+
+    def test_token_authentication(self):
+        """Token, user and device are loaded together on every request"""
+        key = Token.objects.values_list('key', flat=True).first()
+        self.assertIndexed(Token.objects.select_related('user__device').filter(key=key))
+
+    def test_signed_prekey(self):
+        self.assertIndexed(SignedPreKey.objects.filter(device=self.device))
+
+    def test_prekey_claim(self):
+        """Claims take the oldest prekey of one or several devices"""
+        self.assertIndexed(PreKey.objects.filter(device=self.device).order_by('id')[:1], ordered=True)
+        firstIds = PreKey.objects.filter(device__in=[self.device.id, self.device.id + 1]).values('device').annotate(first=Min('id')).values('first')
+        self.assertIndexed(PreKey.objects.filter(id__in=firstIds))
+
+    def test_prekey_key_id_probe(self):
+        """Uploads check the new key IDs are not already stored"""
+        self.assertIndexed(self.device.prekey_set.filter(key_id__in=[1, 2, 3]))
+        self.assertIndexed(self.device.prekey_set.filter(key_id=1))
+
+    def test_inbox(self):
+        """A device's inbox in the default order, by page, and consumed"""
+        self.assertIndexed(self.device.received_messages.unexpired(), ordered=True)
+        self.assertIndexed(self.device.received_messages.unexpired().filter(id__gt=10).order_by('id')[:101], ordered=True)
+        self.assertIndexed(Message.objects.filter(recipient=self.device).unexpired().order_by('id')[:100], ordered=True)
+
+    def test_message_delete(self):
+        self.assertIndexed(Message.objects.filter(id__in=[1, 2, 3]).order_by().values_list('id', 'recipient_id'))
+
+    def test_purge(self):
+        """The expiry purge finds old and expired messages"""
+        self.assertIndexed(Message.objects.filter(created__lt=timezone.now() - timedelta(days=30)).order_by().values_list('id', 'recipient_id')[:5000])
+        self.assertIndexed(Message.objects.filter(expires__lte=timezone.now()).order_by().values_list('id', 'recipient_id')[:5000])
+
+    def test_denylist(self):
+        self.assertIndexed(DeniedToken.objects.filter(expires__gt=timezone.now()).values_list('jti', flat=True))
@@ -0,0 +1,96 @@
+"""
+Tests the orjson renderer and parser are interchangeable with REST framework's
+"""
+
+import io
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from dark_maps.api.v1.models import Device, PreKey, SignedPreKey, Message
+from dark_maps.api.v1.renderers import ORJSONRenderer, ORJSONParser
+from dark_maps.api.v1.serializers import DeviceSerializer, MessageSerializer, MessageV2Serializer, PreKeySerializer, represent_prekey_bundle
+
+IDENTITY_KEY = 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+SIGNATURE = 'abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+
+class RendererTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.device = Device.objects.create(user=self.user, address='testuser1@test.com.1', identity_key=IDENTITY_KEY, registration_id=1234)
+        self.signed_pre_key = SignedPreKey.objects.create(device=self.device, key_id=7, public_key=IDENTITY_KEY, signature=SIGNATURE)
+        self.pre_key = PreKey.objects.create(device=self.device, key_id=3, public_key=IDENTITY_KEY)
+        Message.objects.create(recipient=self.device, content='{"registration_id": 1234, "content": "test"}', sender_registration_id=5678, sender_address='testuser2@test.com.1')
+        Message.objects.create(recipient=self.device, ciphertext=b'\x00\x01\x02\xff', sender_registration_id=5678, sender_address='testuser2@test.com.1')
+        Message.objects.create(recipient=self.device, content='"quoted" é \u2028 \u2029 \x00 \x1f 😀', sender_registration_id=0, sender_address='')
+
+    def assertSameRender(self, data, accepted_media_type=None, renderer_context=None):
+        expected = JSONRenderer().render(data, accepted_media_type, renderer_context)
+        self.assertEqual(ORJSONRenderer().render(data, accepted_media_type, renderer_context), expected)
+        return expected
+
+    def test_messages(self):
+        """Inboxes in both envelope versions, including text JSONRenderer escapes"""
+        messages = list(self.device.received_messages.all())
+        rendered = self.assertSameRender(MessageSerializer(messages, many=True).data)
+        self.assertIn(b'\\u2028 \\u2029', rendered)
+        self.assertSameRender(MessageV2Serializer(messages, many=True).data)
+
+    def test_prekeys(self):
+        self.assertSameRender(represent_prekey_bundle(self.device, self.signed_pre_key, self.pre_key))
+        self.assertSameRender(PreKeySerializer(PreKey.objects.all(), many=True).data)
+
+    def test_errors(self):
+        """Validation errors hold ErrorDetail strings and lazy translations"""
+        serializer = DeviceSerializer(data={'address': self.device.address, 'registration_id': 'x', 'pre_keys': [{}]})
+        self.assertFalse(serializer.is_valid())
+        self.assertSameRender(serializer.errors)
+        self.assertSameRender({'detail': _('Not found.')})
+
+    def test_other_types(self):
+        """Types orjson hands back to REST framework's encoder"""
+        self.assertSameRender({
+            'utc': datetime(2021, 6, 1, 12, 30, 15, 123456, tzinfo=timezone.utc),
+            'naive': datetime(2021, 6, 1, 12, 30),
+            'offset': datetime(2021, 6, 1, 12, 30, tzinfo=timezone(timedelta(hours=2))),
+            'date': date(2021, 6, 1),
+            'uuid': uuid.UUID(int=1),
+            'bytes': b'abc',
+            'tuple': (1, 2),
+            1: 'integer key',
+            None: True,
+        })
+
+    def test_fallback(self):
+        """Indented output and integers wider than 64 bits are rendered by JSONRenderer"""
+        self.assertSameRender({'id': 2 ** 70})
+        self.assertSameRender({'id': 1, 'key': [1, 2]}, 'application/json; indent=4')
+        self.assertSameRender({'id': 1}, None, {'indent': 2})
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+
+class ParserTestCase(TestCase):
+    def assertSameParse(self, body, encoding='utf-8'):
+        context = {'encoding': encoding}
+        expected = JSONParser().parse(io.BytesIO(body), 'application/json', context)
+        self.assertEqual(ORJSONParser().parse(io.BytesIO(body), 'application/json', context), expected)
+
+    def test_bodies(self):
+        prekeys = b',\n'.join(b'{"key_id": %d, "public_key": "%s"}' % (x, IDENTITY_KEY.encode()) for x in range(100))
+        self.assertSameParse(b'[' + prekeys + b']')
+        self.assertSameParse('{"recipient": "é\\u00e9😀", "registration_id": 5678, "nested": {"list": [true, false, null, -1]}}'.encode())
+        self.assertSameParse('{"recipient": "é"}'.encode('latin-1'), 'iso-8859-1')
+
+    def test_invalid(self):
+        for body in (b'', b'{"key_id": ', b'[NaN]', b'{"key": "\xff"}'):
+            with self.assertRaises(ParseError):
+                JSONParser().parse(io.BytesIO(body), 'application/json', {'encoding': 'utf-8'})
+            with self.assertRaises(ParseError):
+                ORJSONParser().parse(io.BytesIO(body), 'application/json', {'encoding': 'utf-8'})
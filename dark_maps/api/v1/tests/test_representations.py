@@ -0,0 +1,73 @@
+"""
+Tests the read paths built from column tuples match the serializers exactly
+"""
+
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+
+from rest_framework.renderers import JSONRenderer
+
+from dark_maps.api.v1.models import Device, PreKey, SignedPreKey, Message
+from dark_maps.api.v1.serializers import (
+    MessageSerializer, MessageV2Serializer, PreKeyBundleSerializer,
+    MESSAGE_COLUMNS, message_columns, represent_messages, represent_prekey_bundle
+)
+from dark_maps.api.v1 import directory
+
+class RepresentationTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.device = Device.objects.create(
+            user=self.user,
+            address='testuser1@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234
+        )
+        self.signed_pre_key = SignedPreKey.objects.create(
+            device=self.device,
+            key_id=7,
+            public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            signature='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+        )
+        self.pre_key = PreKey.objects.create(device=self.device, key_id=3, public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd')
+        Message.objects.create(recipient=self.device, content='{"registration_id": 1234, "content": "test"}', sender_registration_id=5678, sender_address='testuser2@test.com.1')
+        Message.objects.create(recipient=self.device, ciphertext=b'\x00\x01\x02\xff', sender_registration_id=5678, sender_address='testuser2@test.com.1')
+        Message.objects.create(recipient=self.device, content='"quoted" é', sender_registration_id=0, sender_address='')
+
+    def assertSameJSON(self, fast, serialized):
+        self.assertEqual(JSONRenderer().render(fast), JSONRenderer().render(serialized))
+
+    def test_messages(self):
+        """Both envelope versions match their serializer for version 1 and version 2 messages"""
+        messages = list(self.device.received_messages.all())
+        rows = list(self.device.received_messages.values_list(*MESSAGE_COLUMNS))
+        self.assertSameJSON(represent_messages(rows, self.device), MessageSerializer(messages, many=True).data)
+        self.assertSameJSON(represent_messages(rows, self.device, 2), MessageV2Serializer(messages, many=True).data)
+        self.assertEqual(rows, [message_columns(message) for message in messages])
+
+    def test_messages_binary(self):
+        """Version 2 ciphertext for MessagePack is bytes from both"""
+        messages = list(self.device.received_messages.all())
+        rows = list(self.device.received_messages.values_list(*MESSAGE_COLUMNS))
+        data = represent_messages(rows, self.device, 2, binary=True)
+        self.assertEqual(data, MessageV2Serializer(messages, many=True, context={'binary': True}).data)
+        self.assertEqual(data[1]['ciphertext'], b'\x00\x01\x02\xff')
+
+    def test_memoryview_ciphertext(self):
+        """Postgres returns binary columns as memoryview"""
+        message = Message.objects.filter(ciphertext__isnull=False).get()
+        row = message_columns(message)[:4] + (memoryview(b'\x00\x01\x02\xff'),)
+        self.assertSameJSON(represent_messages([row], self.device, 2), MessageV2Serializer([message], many=True).data)
+        self.assertSameJSON(represent_messages([row], self.device), MessageSerializer([message], many=True).data)
+
+    def test_prekey_bundle(self):
+        """Bundles match the serializer with and without a one-time prekey"""
+        recipient = directory.get_by_address(self.device.address)
+        signed_pre_key = SignedPreKey.objects.filter(device=self.device).values_list('key_id', 'public_key', 'signature', named=True).get()
+        bundle = recipient._asdict()
+        bundle['signed_pre_key'] = self.signed_pre_key
+        self.assertSameJSON(represent_prekey_bundle(recipient, signed_pre_key), PreKeyBundleSerializer(bundle).data)
+        bundle['pre_key'] = self.pre_key
+        self.assertSameJSON(represent_prekey_bundle(recipient, signed_pre_key, self.pre_key), PreKeyBundleSerializer(bundle).data)
+        self.assertSameJSON(represent_prekey_bundle(self.device, self.signed_pre_key, self.pre_key), PreKeyBundleSerializer(bundle).data)
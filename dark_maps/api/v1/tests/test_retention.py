@@ -0,0 +1,149 @@
+"""
+Tests for message TTLs and the expiry purge
+"""
+
+from datetime import timedelta
+from io import StringIO
+
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+
+from dark_maps.api.v1.models import Device, PreKey, SignedPreKey, Message
+
+class RetentionTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.client.force_authenticate(user=self.user1)
+        self.device1 = Device.objects.create(
+            user=self.user1,
+            address='test1.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234
+        )
+        self.user2 = User.objects.create_user(email='testuser2@test.com', password='12345')
+        self.device2 = Device.objects.create(
+            user=self.user2,
+            address='test2.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=5678
+        )
+        for device in (self.device1, self.device2):
+            PreKey.objects.create(device=device, key_id=1, public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd')
+            SignedPreKey.objects.create(
+                device=device,
+                key_id=1,
+                public_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+                signature='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd'
+            )
+
+    def create_message(self, recipient, age=timedelta(0), expires=None):
+        message = Message.objects.create(
+            recipient=recipient,
+            content='{"registration_id": 1234, "content": "test"}',
+            sender_registration_id=5678,
+            sender_address='test2.1',
+            expires=expires
+        )
+        Device.objects.adjust_counts(recipient, inbox_count=1)
+        if age:
+            Message.objects.filter(id=message.id).update(created=timezone.now() - age)
+        return message
+
+    def test_send_message_with_ttl(self):
+        """A TTL supplied at send time sets the message's expiry"""
+        response = self.client.post('/v1/1234/messages/', {
+            "recipient": "testuser2@test.com",
+            "message": '{"registration_id": 5678, "content": "test"}',
+            "ttl": 60
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('ttl', response.data)
+        expires = self.device2.received_messages.get().expires
+        self.assertAlmostEqual(expires, timezone.now() + timedelta(seconds=60), delta=timedelta(seconds=5))
+
+    def test_send_message_without_ttl(self):
+        """Messages without a TTL are kept for the retention period"""
+        response = self.client.post('/v1/1234/messages/', {
+            "recipient": "testuser2@test.com",
+            "message": '{"registration_id": 5678, "content": "test"}'
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(self.device2.received_messages.get().expires)
+
+    @override_settings(MESSAGE_RETENTION_DAYS=1)
+    def test_send_message_ttl_too_long(self):
+        """A TTL may not outlast the retention period"""
+        response = self.client.post('/v1/1234/messages/', {
+            "recipient": "testuser2@test.com",
+            "message": '{"registration_id": 5678, "content": "test"}',
+            "ttl": 24 * 60 * 60 + 1
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ttl', response.data)
+        self.assertEqual(self.device2.received_messages.count(), 0)
+
+    def test_send_message_invalid_ttl(self):
+        """A TTL must be a positive whole number of seconds"""
+        for ttl, status_code in (("60", 403), (True, 403), (0, 400)):
+            response = self.client.post('/v1/1234/messages/', {
+                "recipient": "testuser2@test.com",
+                "message": '{"registration_id": 5678, "content": "test"}',
+                "ttl": ttl
+            }, format='json')
+            self.assertEqual(response.status_code, status_code)
+        self.assertEqual(self.device2.received_messages.count(), 0)
+
+    def test_expired_messages_hidden(self):
+        """Messages past their TTL are not returned before they are purged"""
+        kept = self.create_message(self.device1, expires=timezone.now() + timedelta(hours=1))
+        self.create_message(self.device1, expires=timezone.now() - timedelta(seconds=1))
+        response = self.client.get('/v1/1234/messages/')
+        self.assertEqual([message['id'] for message in response.data], [kept.id])
+        response = self.client.get('/v1/1234/messages/?limit=10')
+        self.assertEqual([message['id'] for message in response.data['results']], [kept.id])
+        response = self.client.get('/v1/1234/messages/?consume=true')
+        self.assertEqual([message['id'] for message in response.data], [kept.id])
+
+    def test_purge_expired(self):
+        """Messages past the retention period or their TTL are deleted in batches"""
+        self.create_message(self.device1, age=timedelta(days=31))
+        self.create_message(self.device1, age=timedelta(days=31))
+        self.create_message(self.device2, age=timedelta(days=31))
+        self.create_message(self.device2, expires=timezone.now() - timedelta(seconds=1))
+        kept = self.create_message(self.device1, age=timedelta(days=29))
+        created_before = timezone.now() - timedelta(days=30)
+
+        self.assertEqual(Message.objects.purge_expired(created_before, 2), 2)
+        self.assertEqual(Message.objects.purge_expired(created_before, 2), 1)
+        self.assertEqual(Message.objects.purge_expired(created_before, 2), 1)
+        self.assertEqual(Message.objects.purge_expired(created_before, 2), 0)
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [kept.id])
+        self.device1.refresh_from_db()
+        self.device2.refresh_from_db()
+        self.assertEqual(self.device1.inbox_count, 1)
+        self.assertEqual(self.device2.inbox_count, 0)
+
+    def test_purge_command(self):
+        """The command purges everything expired, however many batches it takes"""
+        for _ in range(3):
+            self.create_message(self.device1, age=timedelta(days=31))
+        self.create_message(self.device2, expires=timezone.now() - timedelta(seconds=1))
+        kept = self.create_message(self.device2)
+        out = StringIO()
+        call_command('purge_messages', batch_size=2, pause=0, stdout=out)
+        self.assertIn("Deleted 4 expired messages", out.getvalue())
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [kept.id])
+
+    @override_settings(MESSAGE_RETENTION_DAYS=0)
+    def test_purge_command_keep_forever(self):
+        """With no retention period only messages past their TTL are purged"""
+        old = self.create_message(self.device1, age=timedelta(days=365))
+        self.create_message(self.device2, expires=timezone.now() - timedelta(seconds=1))
+        call_command('purge_messages', stdout=StringIO())
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [old.id])
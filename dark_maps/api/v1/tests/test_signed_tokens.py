@@ -0,0 +1,171 @@
+"""
+Tests for the signed token authentication mode
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from dark_maps.api.v1.models import Device, DeniedToken, Message
+from dark_maps.api.v1.signed_tokens import denylist
+
+@override_settings(SIGNED_TOKENS_ENABLED=True)
+class SignedTokenTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.device1 = Device.objects.create(
+            user=self.user1,
+            address='testuser1@test.com.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234,
+            prekey_count=7
+        )
+        self.token = Token.objects.create(user=self.user1)
+        denylist.reload()
+
+    def get_tokens(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+        response = self.client.post('/v1/auth/signed/')
+        self.assertEqual(response.status_code, 200)
+        return response.data['refresh'], response.data['access']
+
+    def test_claims(self):
+        """Access tokens carry the user's device"""
+        _, access = self.get_tokens()
+        claims = AccessToken(access)
+        self.assertEqual(claims['user_id'], self.user1.id)
+        self.assertEqual(claims['device'], {'id': self.device1.id, 'registration_id': 1234, 'address': 'testuser1@test.com.1'})
+
+    def test_no_lookup(self):
+        """Requests are authenticated without any query"""
+        _, access = self.get_tokens()
+        Message.objects.create(recipient=self.device1, content='test', sender_registration_id=5678, sender_address='testuser2@test.com.1')
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        # Only the lookup of the messages to delete
+        with self.assertNumQueries(1):
+            response = self.client.delete('/v1/1234/messages/', ['99'], format='json')
+        self.assertEqual(response.status_code, 200)
+        # The inbox, then the counter for the header
+        with self.assertNumQueries(2):
+            response = self.client.get('/v1/1234/messages/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response['X-Prekeys-Remaining'], '7')
+
+    def test_disabled(self):
+        """Signed tokens are refused unless enabled"""
+        _, access = self.get_tokens()
+        with self.settings(SIGNED_TOKENS_ENABLED=False):
+            self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+            response = self.client.get('/v1/devices/')
+            self.assertEqual(response.status_code, 401)
+            self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+            response = self.client.post('/v1/auth/signed/')
+            self.assertEqual(response.status_code, 404)
+
+    def test_refresh(self):
+        """A refresh token obtains a new access token"""
+        refresh, _ = self.get_tokens()
+        self.client.credentials()
+        response = self.client.post('/v1/auth/signed/refresh/', {'refresh': refresh}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AccessToken(response.data['access'])['device']['registration_id'], 1234)
+        response = self.client.post('/v1/auth/signed/refresh/', {'refresh': 'invalid'}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_logout(self):
+        """Logging out revokes the refresh and access tokens"""
+        refresh, access = self.get_tokens()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        response = self.client.post('/v1/auth/signed/logout/', {'refresh': refresh}, format='json')
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 401)
+        self.client.credentials()
+        response = self.client.post('/v1/auth/signed/refresh/', {'refresh': refresh}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_access_token_cannot_obtain_refresh(self):
+        """Refresh tokens are only issued for the opaque token"""
+        _, access = self.get_tokens()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        response = self.client.post('/v1/auth/signed/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_logout_revokes_refresh(self):
+        """Logging out the opaque token revokes refresh tokens issued before it"""
+        refresh, _ = self.get_tokens()
+        response = self.client.post('/v1/auth/logout/')
+        self.assertEqual(response.status_code, 204)
+        self.client.credentials()
+        response = self.client.post('/v1/auth/signed/refresh/', {'refresh': refresh}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+        # Tokens issued after logging in again are accepted
+        self.token = Token.objects.create(user=self.user1)
+        refresh, _ = self.get_tokens()
+        self.client.credentials()
+        response = self.client.post('/v1/auth/signed/refresh/', {'refresh': refresh}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_password_change_revokes_refresh(self):
+        """Changing or resetting the password revokes refresh tokens issued before it"""
+        refresh, _ = self.get_tokens()
+        response = self.client.post('/v1/auth/users/set_password/', {'current_password': '12345', 'new_password': 'a new password 67890'}, format='json')
+        self.assertEqual(response.status_code, 204)
+        self.client.credentials()
+        response = self.client.post('/v1/auth/signed/refresh/', {'refresh': refresh}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+        refresh, _ = self.get_tokens()
+        self.user1.refresh_from_db()
+        self.user1.set_password('another password 13579')
+        self.user1.save()
+        self.client.credentials()
+        response = self.client.post('/v1/auth/signed/refresh/', {'refresh': refresh}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+        # Other saves of the user leave tokens alone
+        refresh, _ = self.get_tokens()
+        self.user1.refresh_from_db()
+        self.user1.save()
+        self.client.credentials()
+        response = self.client.post('/v1/auth/signed/refresh/', {'refresh': refresh}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_device_change(self):
+        """Changing the device revokes the access token, a refreshed one carries the new device"""
+        refresh, access = self.get_tokens()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        response = self.client.delete('/v1/devices/')
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 401)
+        self.client.credentials()
+        response = self.client.post('/v1/auth/signed/refresh/', {'refresh': refresh}, format='json')
+        self.assertNotIn('device', AccessToken(response.data['access']))
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_denylist_shared(self):
+        """Revocations made by other processes are picked up on reload, expired entries are removed"""
+        _, access = self.get_tokens()
+        claims = AccessToken(access)
+        DeniedToken.objects.create(jti=claims['jti'], expires=datetime.now(tz=timezone.utc) + timedelta(minutes=5))
+        DeniedToken.objects.create(jti='expired', expires=datetime.now(tz=timezone.utc) - timedelta(minutes=5))
+        denylist.reload()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        response = self.client.get('/v1/devices/')
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(denylist.is_denied('expired'))
+        _, other = self.get_tokens()
+        denylist.deny(AccessToken(other))
+        self.assertFalse(DeniedToken.objects.filter(jti='expired').exists())
@@ -0,0 +1,180 @@
+"""
+Tests for the message WebSocket and fan-out layer
+"""
+
+import asyncio
+import json
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+
+from rest_framework.authtoken.models import Token
+
+from dark_maps.api.v1.models import Device, Message
+from dark_maps.api.v1.serializers import MessageSerializer
+from dark_maps.api.v1.fanout import InMemoryFanout, BrokerFanout, LocalBroker, get_fanout
+from dark_maps.api.v1.websocket import websocket_application
+
+
+class WebSocketClient:
+    """Drives the ASGI WebSocket application in place of a server"""
+
+    def __init__(self, path, token=None):
+        headers = []
+        if token:
+            headers.append((b'authorization', f'Token {token}'.encode()))
+        self.scope = {'type': 'websocket', 'path': path, 'headers': headers, 'query_string': b''}
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+
+    async def connect(self):
+        self.task = asyncio.ensure_future(websocket_application(self.scope, self.incoming.get, self.outgoing.put))
+        await self.incoming.put({'type': 'websocket.connect'})
+        return await self.receive()
+
+    async def receive(self):
+        return await asyncio.wait_for(self.outgoing.get(), 5)
+
+    async def disconnect(self):
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(self.task, 5)
+
+
+class WebSocketTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user1 = User.objects.create_user(email='testuser1@test.com', password='12345')
+        self.token1 = Token.objects.create(user=self.user1)
+        self.device1 = Device.objects.create(
+            user=self.user1,
+            address='test1.1',
+            identity_key='abcdabcdabcdabcdabcdabcdabcdabcdabcdabcdabcd',
+            registration_id=1234
+        )
+        Message.objects.create(
+            recipient=self.device1,
+            content='{"registration_id": 1234, "content": "test"}',
+            sender_registration_id=5678,
+            sender_address='test2.1'
+        )
+
+    def send_message(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            serializer = MessageSerializer(data={
+                'content': '{"registration_id": 1234, "content": "test2"}',
+                'sender_address': 'test2.1',
+                'sender_registration_id': 5678
+            }, context={'recipient_device': self.device1})
+            serializer.is_valid()
+            serializer.save()
+
+    def test_messages_pushed(self):
+        """Waiting messages are sent on connection and new messages are pushed as they are stored"""
+        async def run():
+            client = WebSocketClient('/v1/1234/messages/', self.token1.key)
+            self.assertEqual((await client.connect())['type'], 'websocket.accept')
+            backlog = json.loads((await client.receive())['text'])
+            self.assertEqual(backlog['id'], 1)
+            await sync_to_async(self.send_message)()
+            pushed = json.loads((await client.receive())['text'])
+            self.assertEqual(pushed['id'], 2)
+            self.assertEqual(pushed['content'], '{"registration_id": 1234, "content": "test2"}')
+            self.assertEqual(pushed['recipient_address'], 'test1.1')
+            await client.disconnect()
+        async_to_sync(run)()
+
+    @override_settings(MESSAGE_PAGE_SIZE=2)
+    def test_backlog_paged(self):
+        """The backlog is read a page at a time and every waiting message is sent in order"""
+        for x in range(4):
+            Message.objects.create(recipient=self.device1, content='test', sender_registration_id=5678, sender_address='test2.1')
+        async def run():
+            client = WebSocketClient('/v1/1234/messages/', self.token1.key)
+            self.assertEqual((await client.connect())['type'], 'websocket.accept')
+            ids = [json.loads((await client.receive())['text'])['id'] for _ in range(5)]
+            await client.disconnect()
+            return ids
+        self.assertEqual(async_to_sync(run)(), list(Message.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_pushed_out_of_order(self):
+        """Messages committed out of ID order are all pushed, only those in the backlog are skipped"""
+        async def run():
+            client = WebSocketClient('/v1/1234/messages/', self.token1.key)
+            self.assertEqual((await client.connect())['type'], 'websocket.accept')
+            self.assertEqual(json.loads((await client.receive())['text'])['id'], 1)
+            for message_id in (1, 11, 10):
+                get_fanout().publish(self.device1.id, lambda message_id=message_id: {'id': message_id})
+            self.assertEqual(json.loads((await client.receive())['text'])['id'], 11)
+            self.assertEqual(json.loads((await client.receive())['text'])['id'], 10)
+            await client.disconnect()
+            self.assertTrue(client.outgoing.empty())
+        async_to_sync(run)()
+
+    def test_invalid_token(self):
+        """Connections with an invalid token are closed"""
+        async def run():
+            client = WebSocketClient('/v1/1234/messages/', 'invalid')
+            return await client.connect()
+        response = async_to_sync(run)()
+        self.assertEqual(response, {'type': 'websocket.close', 'code': 4001})
+
+    def test_token_in_first_frame(self):
+        """Clients that cannot set headers send their token in the first frame"""
+        async def run():
+            client = WebSocketClient('/v1/1234/messages/')
+            self.assertEqual((await client.connect())['type'], 'websocket.accept')
+            await client.incoming.put({'type': 'websocket.receive', 'text': json.dumps({'token': self.token1.key})})
+            backlog = json.loads((await client.receive())['text'])
+            self.assertEqual(backlog['id'], 1)
+            await client.disconnect()
+        async_to_sync(run)()
+
+    def test_token_in_query_string(self):
+        """Tokens in the URL are ignored, as URLs are logged"""
+        async def run():
+            client = WebSocketClient('/v1/1234/messages/')
+            client.scope['query_string'] = f'token={self.token1.key}'.encode()
+            self.assertEqual((await client.connect())['type'], 'websocket.accept')
+            await client.incoming.put({'type': 'websocket.receive', 'text': 'not json'})
+            return await client.receive()
+        response = async_to_sync(run)()
+        self.assertEqual(response, {'type': 'websocket.close', 'code': 4001})
+
+    def test_changed_identity(self):
+        """Connections for an altered identity are closed"""
+        async def run():
+            client = WebSocketClient('/v1/1235/messages/', self.token1.key)
+            return await client.connect()
+        response = async_to_sync(run)()
+        self.assertEqual(response, {'type': 'websocket.close', 'code': 4003})
+
+
+class FanoutTestCase(TestCase):
+    def test_in_memory_fanout(self):
+        """Published messages reach subscribers for the same device only"""
+        fanout = InMemoryFanout()
+        async def run():
+            async with fanout.subscribe(1) as subscription, fanout.subscribe(2) as other:
+                fanout.publish(1, lambda: {'id': 1})
+                self.assertEqual(await asyncio.wait_for(subscription.get(), 5), {'id': 1})
+                self.assertEqual(other._queue.empty(), True)
+        async_to_sync(run)()
+
+    def test_built_for_subscribers_only(self):
+        """Messages for devices nobody is subscribed to are never built"""
+        fanout = InMemoryFanout()
+        built = []
+        fanout.publish(1, lambda: built.append(1))
+        self.assertEqual(built, [])
+
+    def test_broker_fanout(self):
+        """Messages published on one node reach subscribers on another through the broker"""
+        broker = LocalBroker()
+        node1 = BrokerFanout(broker)
+        node2 = BrokerFanout(broker)
+        async def run():
+            async with node2.subscribe(1) as subscription:
+                node1.publish(1, lambda: {'id': 1})
+                self.assertEqual(await asyncio.wait_for(subscription.get(), 5), {'id': 1})
+        async_to_sync(run)()
@@ -16,8 +16,12 @@ v1_urlpatterns = [
     url(r'^(?P<requestedDeviceregistration_id>[0-9]+)/signedprekeys/$', v1_views.UserSignedPreKeys.as_view()),
     url(r'^(?P<requestedDeviceregistration_id>[0-9]+)/messages/$', v1_views.MessageList.as_view()),
     url(r'^prekeybundles/(?P<recipient_address>[0-9A-Za-z./=+]+)/(?P<ownDeviceregistration_id>[0-9]+)/$', v1_views.PreKeyBundleView.as_view()),
+    url(r'^prekeybundles/(?P<ownDeviceregistration_id>[0-9]+)/$', v1_views.PreKeyBundleListView.as_view()),
 
     # Auth URLs
+    url(r'^auth/signed/$', v1_views.SignedTokenView.as_view()),
+    url(r'^auth/signed/refresh/$', v1_views.SignedTokenRefreshView.as_view()),
+    url(r'^auth/signed/logout/$', v1_views.SignedTokenLogoutView.as_view()),
     url(r'^auth/', include('trench.urls')), # Base endpoints
     url(r'^auth/', include('djoser.urls')),
     url(r'^auth/', include('trench.urls.djoser')),  # for Token Based Authorization
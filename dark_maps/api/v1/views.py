@@ -4,36 +4,53 @@ Defines Django views
 import json
 import re
 import logging
-import time
+import sys
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import PermissionDenied, FieldError
 from django.forms.models import model_to_dict
-from django.contrib.auth.models import User
 from django.db.models.signals import post_delete
+from django.db import transaction
 from django.dispatch import receiver
 
-from dark_maps.api.v1.models import Message, Device
-from dark_maps.api.v1.serializers import MessageSerializer, DeviceSerializer, PreKeyBundleSerializer, PreKeySerializer, SignedPreKeySerializer
-from dark_maps.api.v1 import errors
+from dark_maps.api.v1.models import Message, Device, PreKey, SignedPreKey
+from dark_maps.api.v1.serializers import MessageSerializer, MessageV2Serializer, DeviceSerializer, PreKeySerializer, SignedPreKeySerializer
+from dark_maps.api.v1.serializers import MESSAGE_COLUMNS, message_columns, represent_messages, represent_prekey_bundle
+from dark_maps.api.v1 import errors, directory, population
+from dark_maps.api.v1.notifications import inbox_notifier
+from dark_maps.api.v1.renderers import accepts_binary
+from dark_maps.api.v1.authentication import CachedTokenAuthentication
+from dark_maps.api.v1 import signed_tokens
+from dark_maps.api.v1.signed_tokens import SignedTokenAuthentication
 
 from djoser.signals import user_registered
 
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import AllowAny
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+def revoke_signed_access(request):
+    """Signed access tokens describe the device, so they are revoked when it changes"""
+    if isinstance(request.auth, AccessToken):
+        signed_tokens.denylist.deny(request.auth)
+
+def with_prekey_count(response, device):
+    """Tells the device how many one-time prekeys it has left so it can refill early"""
+    response['X-Prekeys-Remaining'] = device.prekey_count
+    return response
 
 class MessageList(APIView):
 
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, SignedTokenAuthentication)
 
     # User can get a list of messages for their device
     def get(self, request, **kwargs):
         user = self.request.user
         logger = logging.getLogger("watchtower")
-        tic = time.perf_counter()
-        logger.info(f"[Get Messages] [Started]")
 
         # Check correct arguments provided
         if 'requestedDeviceregistration_id' not in kwargs:
@@ -43,24 +60,68 @@ class MessageList(APIView):
         # Check device exists and owned by user
         if not hasattr(user, "device"):
             logger.error(f"[Get Messages] [Error - User has no device]")
-            return errors.no_device
+            return errors.no_device()
 
         # Check device ID has not changed
         if int(kwargs['requestedDeviceregistration_id']) != user.device.registration_id:
             logger.error(f"[Get Messages] [Error - Device changed]")
-            return errors.device_changed
+            return errors.device_changed()
 
-        messages = user.device.received_messages.all()
-        serializer = MessageSerializer(messages, many=True)
-        toc = time.perf_counter()
-        logger.info(f"[Get messages] [Complete] [{toc - tic:0.4f}]")
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        try:
+            after = int(request.query_params.get('after', 0))
+            limit = int(request.query_params.get('limit', settings.MESSAGE_PAGE_SIZE))
+            wait = int(request.query_params.get('wait', 0))
+        except ValueError:
+            logger.error(f"[Get Messages] [Error - Incorrect arguments]")
+            return errors.incorrectArguments("The 'after', 'limit' and 'wait' parameters must be integers.")
+        if (after < 0) or (limit < 1) or (limit > settings.MESSAGE_PAGE_MAX_SIZE):
+            logger.error(f"[Get Messages] [Error - Incorrect arguments]")
+            return errors.incorrectArguments(f"The 'after' parameter must be positive and 'limit' must be between 1 and {settings.MESSAGE_PAGE_MAX_SIZE}.")
+        if (wait < 0) or (wait > settings.MESSAGE_LONG_POLL_MAX_WAIT):
+            logger.error(f"[Get Messages] [Error - Incorrect arguments]")
+            return errors.incorrectArguments(f"The 'wait' parameter must be between 0 and {settings.MESSAGE_LONG_POLL_MAX_WAIT} seconds.")
+
+        # Version 2 readers receive the ciphertext base64 encoded rather than the version 1 JSON string,
+        # or as bytes in MessagePack
+        envelope = 2 if (request.query_params.get('envelope') == '2') else 1
+        binary = accepts_binary(request)
+
+        # Long poll, park the request until a message arrives or the wait expires.
+        # Under ASGI long polls wait in dark_maps/api/v1/long_poll.py and arrive here without a wait
+        if wait > 0:
+            with inbox_notifier.listen(user.device.id) as message_stored:
+                if not user.device.received_messages.unexpired().filter(id__gt=after).exists():
+                    # Each parked request holds a worker thread, so only a few may wait at once
+                    with inbox_notifier.park() as parked:
+                        if not parked:
+                            logger.error(f"[Get Messages] [Error - Too many long polls]")
+                            return errors.long_poll_busy()
+                        message_stored.wait(wait)
+
+        # Destructive read, messages are deleted as they are returned
+        if request.query_params.get('consume') == 'true':
+            messages = Message.objects.consume(user.device, limit)
+            data = represent_messages([message_columns(message) for message in messages], user.device, envelope, binary)
+            return with_prekey_count(Response(data, status=status.HTTP_200_OK), user.device)
+
+        # Keyset pagination is opt-in so existing clients still receive a plain list
+        if ('after' in request.query_params) or ('limit' in request.query_params):
+            # Fetch one extra row to find out whether another page follows
+            rows = list(user.device.received_messages.unexpired().filter(id__gt=after).order_by('id').values_list(*MESSAGE_COLUMNS)[:limit + 1])
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = rows[-1][0]
+            data = represent_messages(rows, user.device, envelope, binary)
+            return with_prekey_count(Response({"results": data, "next": next_cursor}, status=status.HTTP_200_OK), user.device)
+
+        rows = user.device.received_messages.unexpired().values_list(*MESSAGE_COLUMNS)
+        data = represent_messages(rows, user.device, envelope, binary)
+        return with_prekey_count(Response(data, status=status.HTTP_200_OK), user.device)
 
     # User can post messages.
     def post(self, request, **kwargs):
         logger = logging.getLogger("watchtower")
-        tic = time.perf_counter()
-        logger.info(f"[Post Messages] [Started]")
 
         # Check correct arguments provided
         if 'requestedDeviceregistration_id' not in kwargs:
@@ -72,69 +133,106 @@ class MessageList(APIView):
         if not (("recipient" in request.data) & isinstance(request.data["recipient"], str)):
             logger.error(f"[Post Messages] [Error - Incorrect Arguments]")
             return errors.incorrectArguments("The request body must include the recipient's email address in the 'recipient' field.")
-        if not (("message" in request.data) & isinstance(request.data["message"], str)):
+        # Version 2 envelopes carry the ciphertext and the recipient's registration ID as separate fields
+        envelopeVersion = 2 if ("ciphertext" in request.data) else 1
+        if envelopeVersion == 2:
+            # MessagePack clients send the ciphertext as bytes
+            if not (isinstance(request.data["ciphertext"], (str, bytes)) & isinstance(request.data.get("registration_id"), int)):
+                logger.error(f"[Post Messages] [Error - Incorrect Arguments]")
+                return errors.incorrectArguments("The request body must include the base64 encoded ciphertext in the 'ciphertext' field and the recipient's registration ID in the 'registration_id' field.")
+        elif not (("message" in request.data) & isinstance(request.data["message"], str)):
             logger.error(f"[Post Messages] [Error - Incorrect Arguments]")
             return errors.incorrectArguments("The request body must include the message content in the 'message' field.")
+        if ("ttl" in request.data) and not (isinstance(request.data["ttl"], int) & (not isinstance(request.data["ttl"], bool))):
+            logger.error(f"[Post Messages] [Error - Incorrect Arguments]")
+            return errors.incorrectArguments("The 'ttl' field must be a whole number of seconds.")
 
         ownUser = self.request.user
         recipientEmail = request.data["recipient"]
         emailPattern = re.compile(r'(?:[a-z0-9!#$%&\'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&\'*+/=?^_`{|}~-]+)*|"(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21\x23-\x5b\x5d-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])*")@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\[(?:(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9]))\.){3}(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9])|[a-z0-9-]*[a-z0-9]:(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21-\x5a\x53-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])+)\])')
         if not (emailPattern.match(recipientEmail.lower())):
             logger.error(f"[Post Messages] [Error - Invalid Email]")
-            return errors.invalid_recipient_email
+            return errors.invalid_recipient_email()
 
-        try:
-            messageDataParsed = json.loads(request.data['message'])
-        except Exception:
-            logger.error(f"[Post Messages] [Error - Incorrect Arguments]")
-            return errors.incorrectArguments("The request body must include the message content in JSON string format in the 'message' field.")
+        if envelopeVersion == 2:
+            recipientRegistrationId = request.data['registration_id']
+        else:
+            try:
+                messageDataParsed = json.loads(request.data['message'])
+            except Exception:
+                logger.error(f"[Post Messages] [Error - Incorrect Arguments]")
+                return errors.incorrectArguments("The request body must include the message content in JSON string format in the 'message' field.")
+            recipientRegistrationId = messageDataParsed['registration_id']
 
         # Check device exists and owned by user
         if not hasattr(ownUser, "device"):
             logger.error(f"[Post Messages] [Error - User has no device]")
-            return errors.no_device
+            return errors.no_device()
 
         # Check own device ID has not changed
         if int(kwargs['requestedDeviceregistration_id']) != ownUser.device.registration_id:
             logger.error(f"[Post Messages] [Error - Device changed]")
-            return errors.device_changed
-
-        # Check repient user exists
-        recipientUser = {}
-        userModel = get_user_model()
-        try:
-            recipientUser = userModel.objects.get(email=recipientEmail)
-        except Exception:
-            logger.error(f"[Post Messages] [Error - Recipient doesn't exist]")
-            return errors.no_recipient_user
-
-        # Check recipient device exists
-        if not hasattr(recipientUser, "device"):
+            return errors.device_changed()
+
+        # Check recipient user and device exist
+        recipient = directory.get_by_email(recipientEmail)
+        if recipient is None:
+            userModel = get_user_model()
+            if not userModel.objects.filter(email=recipientEmail).exists():
+                logger.error(f"[Post Messages] [Error - Recipient doesn't exist]")
+                return errors.no_recipient_user()
             logger.error(f"[Post Messages] [Error - Recipient has no device]")
-            return errors.no_recipient_device
-        recipient_device = recipientUser.device
-
-        # Check recipient device registration_id matches that sent in message
-        if not (recipientUser.device.registration_id == int(messageDataParsed['registration_id'])):
+            return errors.no_recipient_device()
+        recipient_device = recipient.as_device()
+
+        # Check recipient device registration_id matches that sent in message,
+        # reading the device afresh in case it was registered again since it was cached
+        if not (recipient.registration_id == int(recipientRegistrationId)):
+            recipient = directory.get_by_email(recipientEmail, cached=False)
+            if recipient is None:
+                logger.error(f"[Post Messages] [Error - Recipient has no device]")
+                return errors.no_recipient_device()
+            recipient_device = recipient.as_device()
+        if not (recipient.registration_id == int(recipientRegistrationId)):
             logger.error(f"[Post Messages] [Error - Recipient identity changed]")
-            return errors.recipient_identity_changed
-
-        serializer = MessageSerializer(data={'content': request.data['message'], 'sender_address':ownUser.device.address, 'sender_registration_id':ownUser.device.registration_id}, context={'recipient_device': recipient_device})
+            return errors.recipient_identity_changed()
+
+        if envelopeVersion == 2:
+            messageData = {'ciphertext': request.data['ciphertext'], 'sender_address':ownUser.device.address, 'sender_registration_id':ownUser.device.registration_id}
+        else:
+            messageData = {'content': request.data['message'], 'sender_address':ownUser.device.address, 'sender_registration_id':ownUser.device.registration_id}
+        if "ttl" in request.data:
+            messageData['ttl'] = request.data['ttl']
+        serializer_class = MessageV2Serializer if (envelopeVersion == 2) else MessageSerializer
+        serializer = serializer_class(data=messageData, context={'recipient_device': recipient_device, 'binary': accepts_binary(request)})
         if not serializer.is_valid():
             logger.error("[Post Messages] [Error - MessageSerialiser returned invalid response]")
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        serializer.save()
-        toc = time.perf_counter()
-        logger.info(f"[Post Messages] [Complete] [{toc - tic:0.4f}]")
+        try:
+            serializer.save()
+        except Device.DoesNotExist:
+            # Deleted since it was cached, read it afresh in case it was registered again with the same identity
+            recipient = directory.get_by_email(recipientEmail, cached=False)
+            if recipient is None:
+                logger.error(f"[Post Messages] [Error - Recipient has no device]")
+                return errors.no_recipient_device()
+            if not (recipient.registration_id == int(recipientRegistrationId)):
+                logger.error(f"[Post Messages] [Error - Recipient identity changed]")
+                return errors.recipient_identity_changed()
+            serializer = serializer_class(data=messageData, context={'recipient_device': recipient.as_device(), 'binary': accepts_binary(request)})
+            serializer.is_valid()
+            try:
+                serializer.save()
+            except Device.DoesNotExist:
+                logger.error(f"[Post Messages] [Error - Recipient has no device]")
+                return errors.no_recipient_device()
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     # User can delete any message for which they are the recipient
     def delete(self, request, **kwargs):
 
         logger = logging.getLogger("watchtower")
-        tic = time.perf_counter()
-        logger.info(f"[Delete Message] [Started]")
 
         # Check correct arguments provided
         if 'requestedDeviceregistration_id' not in kwargs:
@@ -151,54 +249,68 @@ class MessageList(APIView):
         # Check device exists and owned by user
         if not hasattr(user, "device"):
             logger.error(f"[Delete Message] [Error - User has no device]")
-            return errors.no_device
+            return errors.no_device()
 
         # Check device ID has not changed
         if int(kwargs['requestedDeviceregistration_id']) != user.device.registration_id:
             logger.error(f"[Delete Message] [Error - Device changed]")
-            return errors.device_changed
+            return errors.device_changed()
 
+        # Find the recipient of every requested message with a single query
+        requestedIds = set()
         for message_id in messageList:
             try:
-                message = Message.objects.get(id=message_id)
-                # Check user owns message
-                if not message.recipient.user == user:
-                    logger.error(f"[Delete Message] [Error - Message not owned by user]")
-                    response.append(errors.not_message_owner)
-                else:
-                    message.delete()
-                    response.append('message_deleted')
-            except Exception:
+                requestedIds.add(int(message_id))
+            except (TypeError, ValueError):
+                pass
+        messageRecipients = dict(Message.objects.filter(id__in=requestedIds).order_by().values_list('id', 'recipient_id'))
+
+        ownedIds = set()
+        for message_id in messageList:
+            try:
+                message_id = int(message_id)
+            except (TypeError, ValueError):
+                message_id = None
+            if (message_id not in messageRecipients) or (message_id in ownedIds):
+                # A repeated ID will already have been deleted by its first occurrence
                 logger.error(f"[Delete Message] [Error - Tried to delete non-existant message]")
                 response.append(errors.non_existant_message)
+            # Check user owns message
+            elif messageRecipients[message_id] != user.device.id:
+                logger.error(f"[Delete Message] [Error - Message not owned by user]")
+                response.append(errors.not_message_owner)
+            else:
+                ownedIds.add(message_id)
+                response.append('message_deleted')
+
+        if ownedIds:
+            with transaction.atomic():
+                deleted, _ = user.device.received_messages.filter(id__in=ownedIds).delete()
+                Device.objects.adjust_counts(user.device, inbox_count=-deleted)
 
-        toc = time.perf_counter()
-        logger.info(f"[Delete Message] [Complete] [{toc - tic:0.4f}]")
         return Response(response, status=status.HTTP_200_OK)
 
 class DeviceView(APIView):
 
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, SignedTokenAuthentication)
 
     def get(self, request, **kwargs):
         logger = logging.getLogger("watchtower")
-        tic = time.perf_counter()
-        logger.info(f"[Get Device] [Started]")
         user = self.request.user
         # Check device exists and owned by user
         if not hasattr(user, "device"):
             logger.error(f"[Get Device] [Error - Tried to get non-existant device]")
-            return errors.no_device
+            return errors.no_device()
+        # Devices cached by authentication load their counters on first use, fetch both at once
+        deferred = user.device.get_deferred_fields()
+        if deferred:
+            user.device.refresh_from_db(fields=deferred)
         device = model_to_dict(user.device)
-        toc = time.perf_counter()
-        logger.info(f"[Delete Message] [Complete] [{toc - tic:0.4f}]")
-        return Response(device, status=status.HTTP_200_OK)
+        return with_prekey_count(Response(device, status=status.HTTP_200_OK), user.device)
 
     # User can register details of a new device
     def post(self, request, **kwargs):
         logger = logging.getLogger("watchtower")
-        tic = time.perf_counter()
-        logger.info(f"[Post Device] [Started]")
 
         # Check correct arguments provided
         # Note - do not verify registration_id here as device should not exist
@@ -211,7 +323,7 @@ class DeviceView(APIView):
         # Check device does not already exist
         if hasattr(user, "device"):
             logger.error(f"[Post Device] [Error - Device already exists]")
-            return errors.device_exists
+            return errors.device_exists()
 
         deviceData = request.data
         serializer = DeviceSerializer(data=deviceData, context={'user': user})
@@ -221,37 +333,31 @@ class DeviceView(APIView):
             return errors.invalidSerializerData(serializer.errors)
 
         serializer.save()
-        toc = time.perf_counter()
-        logger.info(f"[Post Device] [Complete] [{toc - tic:0.4f}]")
+        revoke_signed_access(request)
         return Response({"code": "device_created", "message": "Device successfully created"}, status=status.HTTP_201_CREATED)
 
     # User can delete a device they own
     def delete(self, requested, **kwargs):
         logger = logging.getLogger("watchtower")
-        tic = time.perf_counter()
-        logger.info(f"[Delete Device] [Started]")
 
         user = self.request.user
         # Check device exists and owned by user
         if not hasattr(user, "device"):
             logger.error(f"[Delete Device] [Error - Tried to delete non-existant device]")
-            return errors.no_device
+            return errors.no_device()
         device = user.device
         device.delete()
-        toc = time.perf_counter()
-        logger.info(f"[Delete Device] [Complete] [{toc - tic:0.4f}]")
+        revoke_signed_access(self.request)
         return Response({"code": "device_deleted", "message": "Device successfully deleted"}, status=status.HTTP_204_NO_CONTENT)
 
 
 class PreKeyBundleView(APIView):
     throttle_scope = 'pre_keyBundle'
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, SignedTokenAuthentication)
 
     # User can optain a pre_keyBundle from another user
     def get(self, request, **kwargs):
         logger = logging.getLogger("watchtower")
-        tic = time.perf_counter()
-        logger.info(f"[Get Prekey Bundle] [Started]")
 
         ownUser = self.request.user
 
@@ -267,12 +373,12 @@ class PreKeyBundleView(APIView):
         # Check device exists and owned by user
         if not hasattr(ownUser, "device"):
             logger.error(f"[Get Prekey Bundle] [Error - User has no device]")
-            return errors.no_device
+            return errors.no_device()
 
         # Check device ID has not changed
         if int(kwargs['ownDeviceregistration_id']) != ownUser.device.registration_id:
             logger.error(f"[Get Prekey Bundle] [Error - Device changed]")
-            return errors.device_changed
+            return errors.device_changed()
 
         # Decode hex
         try:
@@ -280,47 +386,88 @@ class PreKeyBundleView(APIView):
         except Exception:
             logger.error(f"[Get Prekey Bundle] [Error - Unable to decode hex]")
             return errors.incorrectArguments("The recipient's address must be encoded in HEX format")
-        try:
+        recipient = directory.get_by_address(recipient_address)
+        if recipient is None:
             email = recipient_address.rpartition('.')[0]
             User = get_user_model()
-            user = User.objects.get(email=email)
-        except Exception as e:
-            logger.error(f"[Get Prekey Bundle] [Error - Tried to get prekey bundle for non-existant user]")
-            return errors.no_recipient_user
-        try:
-            device = Device.objects.get(address=recipient_address)
-        except Exception:
+            if not User.objects.filter(email=email).exists():
+                logger.error(f"[Get Prekey Bundle] [Error - Tried to get prekey bundle for non-existant user]")
+                return errors.no_recipient_user()
             logger.error(f"[Get Prekey Bundle] [Error - Tried to get prekey bundle for non-existant device]")
-            return errors.no_recipient_device
-
-        pre_keyBundle = device.__dict__
-        pre_keyBundle['signed_pre_key'] = device.signedprekey
+            return errors.no_recipient_device()
+        try:
+            signed_pre_key = SignedPreKey.objects.filter(device_id=recipient.device_id).values_list('key_id', 'public_key', 'signature', named=True).get()
+        except SignedPreKey.DoesNotExist:
+            # The cached device may have been deleted or registered again, read it afresh
+            recipient = directory.get_by_address(recipient_address, cached=False)
+            signed_pre_key = None
+            if recipient is not None:
+                signed_pre_key = SignedPreKey.objects.filter(device_id=recipient.device_id).values_list('key_id', 'public_key', 'signature', named=True).first()
+            if signed_pre_key is None:
+                logger.error(f"[Get Prekey Bundle] [Error - Tried to get prekey bundle for non-existant device]")
+                return errors.no_recipient_device()
+        device = recipient.as_device()
 
         # Build pre key bundle, removing a pre_key from the requested user's list
-        if (device.prekey_set.count() > 0):
-            pre_keyToReturn = device.prekey_set.all()[:1].get()
-            pre_keyBundle['pre_key'] = pre_keyToReturn
-            # Update stored pre key
-            pre_keyToReturn.delete()
-
-        serializer = PreKeyBundleSerializer(pre_keyBundle)
+        pre_keyToReturn = PreKey.objects.claim(device)
 
-        toc = time.perf_counter()
-        logger.info(f"[Get Prekey Bundle] [Complete] [{toc - tic:0.4f}]")
         # Return bundle
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(represent_prekey_bundle(recipient, signed_pre_key, pre_keyToReturn), status=status.HTTP_200_OK)
+
+
+class PreKeyBundleListView(APIView):
+    throttle_scope = 'pre_keyBundle'
+    authentication_classes = (CachedTokenAuthentication, SignedTokenAuthentication)
+
+    # User can obtain pre_keyBundles for several other users at once, for example to start a group conversation
+    def post(self, request, **kwargs):
+        logger = logging.getLogger("watchtower")
+
+        ownUser = self.request.user
+
+        # Check correct arguments provided
+        if 'ownDeviceregistration_id' not in kwargs:
+            logger.error(f"[Post Prekey Bundles] [Error - Incorrect arguments]")
+            return errors.incorrectArguments("The request URL must include the sender's registration ID")
+        if not (hasattr(request, "data") and isinstance(request.data, list) and (0 < len(request.data) <= settings.PREKEY_BUNDLE_BATCH_MAX_SIZE) and all(isinstance(x, str) for x in request.data)):
+            logger.error(f"[Post Prekey Bundles] [Error - Incorrect arguments]")
+            return errors.incorrectArguments(f"The request body must be a list of between 1 and {settings.PREKEY_BUNDLE_BATCH_MAX_SIZE} recipient addresses.")
+
+        # Check device exists and owned by user
+        if not hasattr(ownUser, "device"):
+            logger.error(f"[Post Prekey Bundles] [Error - User has no device]")
+            return errors.no_device()
+
+        # Check device ID has not changed
+        if int(kwargs['ownDeviceregistration_id']) != ownUser.device.registration_id:
+            logger.error(f"[Post Prekey Bundles] [Error - Device changed]")
+            return errors.device_changed()
+
+        recipient_addresses = list(dict.fromkeys(request.data))
+        devices = list(Device.objects.filter(address__in=recipient_addresses).select_related('signedprekey').only(
+            'id', 'address', 'identity_key', 'registration_id', 'signedprekey__key_id', 'signedprekey__public_key', 'signedprekey__signature'
+        ))
+        devices = [device for device in devices if hasattr(device, 'signedprekey')]
+
+        # Remove one pre_key from each requested user's list
+        pre_keys = PreKey.objects.claim_many(devices)
+
+        pre_keyBundles = dict.fromkeys(recipient_addresses)
+        for device in devices:
+            pre_keyBundles[device.address] = represent_prekey_bundle(device, device.signedprekey, pre_keys.get(device.id))
+
+        # Addresses without a registered device map to null
+        return Response(pre_keyBundles, status=status.HTTP_200_OK)
 
 
 
 class UserPreKeys(APIView):
 
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, SignedTokenAuthentication)
 
     # User can post a new set of pre_keys
     def post(self, request, **kwargs):
         logger = logging.getLogger("watchtower")
-        tic = time.perf_counter()
-        logger.info(f"[Post Pre-Keys] [Started]")
 
         try:
 
@@ -337,47 +484,43 @@ class UserPreKeys(APIView):
              # Check device exists and owned by user
             if not hasattr(user, "device"):
                 logger.error(f"[Post Pre-Keys] [Error - User has no device]")
-                return errors.no_device
+                return errors.no_device()
 
             # Check device ID has not changed
             if int(kwargs['requestedDeviceregistration_id']) != user.device.registration_id:
                 logger.error(f"[Post Pre-Keys] [Error - Device changed]")
-                return errors.device_changed
+                return errors.device_changed()
 
             newPreKeys = request.data
 
-            for x in newPreKeys:
-                serializer = PreKeySerializer(data=x, context={'user': user, 'registration_id': user.device.registration_id})
+            # Validate the whole list before storing any of it
+            serializer = PreKeySerializer(data=newPreKeys, many=True, context={'device': user.device})
 
-                if not serializer.is_valid():
-                    logger.error(f"[Post Pre-Keys] [Error - PreKeySerializer returned invalid]")
-                    return errors.invalidSerializerData(serializer.errors)
+            if not serializer.is_valid():
+                logger.error(f"[Post Pre-Keys] [Error - PreKeySerializer returned invalid]")
+                return errors.invalidSerializerData(serializer.errors)
 
-                serializer.save()
+            serializer.save()
 
-            toc = time.perf_counter()
-            logger.info(f"[Post Pre-Keys] [Complete] [{toc - tic:0.4f}]")
-            return Response({"code": "prekeys_stored", "message": "Prekeys successfully stored"}, status=status.HTTP_200_OK)
+            return with_prekey_count(Response({"code": "prekeys_stored", "message": "Prekeys successfully stored"}, status=status.HTTP_200_OK), user.device)
 
         except PermissionDenied:
             logger.error(f"[Post Pre-Keys] [Error - Reached Max PreKeys]")
-            return errors.reached_max_prekeys
+            return errors.reached_max_prekeys()
         except FieldError:
             logger.error(f"[Post Pre-Keys] [Error - Prekey ID Exists]")
-            return errors.prekey_id_exists
+            return errors.prekey_id_exists()
         except:
             logger.critical(f"[Post Pre-Keys] [Error - Unexpected Error: {sys.exc_info()[0]}]")
 
 
 class UserSignedPreKeys(APIView):
 
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, SignedTokenAuthentication)
 
     # User can post a new signed_pre_key
     def post(self, request, **kwargs):
         logger = logging.getLogger("watchtower")
-        tic = time.perf_counter()
-        logger.info(f"[Post Signed Pre-Key] [Started]")
 
         user = self.request.user
 
@@ -392,12 +535,12 @@ class UserSignedPreKeys(APIView):
         # Check device exists and owned by user
         if not hasattr(user, "device"):
             logger.error(f"[Post Signed Pre-Key] [Error - User has no device]")
-            return errors.no_device
+            return errors.no_device()
 
         # Check device ID has not changed
         if int(kwargs['requestedDeviceregistration_id']) != user.device.registration_id:
             logger.error(f"[Post Signed Pre-Key] [Error - Device changed]")
-            return errors.device_changed
+            return errors.device_changed()
 
         serializer = SignedPreKeySerializer(data=request.data, context={'user': user, 'registration_id': user.device.registration_id})
 
@@ -407,20 +550,79 @@ class UserSignedPreKeys(APIView):
 
         user.device.signedprekey.delete()
         serializer.save()
-        toc = time.perf_counter()
-        logger.info(f"[Post Signed Pre-Key] [Complete] [{toc - tic:0.4f}]")
         return Response({"code": "signed_prekey_stored", "message": "Signed prekey successfully stored"}, status=status.HTTP_200_OK)
 
-@receiver(post_delete, sender=User)
+class SignedTokenView(APIView):
+    # Only the opaque token can obtain a refresh token, an access token cannot extend itself
+    authentication_classes = (CachedTokenAuthentication, )
+
+    # User can exchange their token for a signed refresh and access token pair
+    def post(self, request, **kwargs):
+        logger = logging.getLogger("watchtower")
+
+        if not settings.SIGNED_TOKENS_ENABLED:
+            logger.error(f"[Post Signed Token] [Error - Signed tokens disabled]")
+            return errors.signed_tokens_disabled()
+
+        refresh, access = signed_tokens.issue(request.user)
+        return Response({"refresh": str(refresh), "access": str(access)}, status=status.HTTP_200_OK)
+
+
+class SignedTokenRefreshView(APIView):
+    authentication_classes = ()
+    permission_classes = (AllowAny, )
+
+    # Anyone holding a refresh token can obtain a new access token
+    def post(self, request, **kwargs):
+        logger = logging.getLogger("watchtower")
+
+        if not settings.SIGNED_TOKENS_ENABLED:
+            logger.error(f"[Refresh Signed Token] [Error - Signed tokens disabled]")
+            return errors.signed_tokens_disabled()
+
+        if not (isinstance(request.data, dict) and isinstance(request.data.get('refresh'), str)):
+            logger.error(f"[Refresh Signed Token] [Error - Incorrect arguments]")
+            return errors.incorrectArguments("The request body must include the refresh token.")
+
+        try:
+            access = signed_tokens.refresh(request.data['refresh'])
+        except TokenError:
+            logger.error(f"[Refresh Signed Token] [Error - Invalid refresh token]")
+            return errors.invalid_refresh_token()
+        return Response({"access": str(access)}, status=status.HTTP_200_OK)
+
+
+class SignedTokenLogoutView(APIView):
+    authentication_classes = (SignedTokenAuthentication, )
+
+    # User can revoke their refresh token and the access token used for the request
+    def post(self, request, **kwargs):
+        logger = logging.getLogger("watchtower")
+
+        if not (isinstance(request.data, dict) and isinstance(request.data.get('refresh'), str)):
+            logger.error(f"[Signed Token Logout] [Error - Incorrect arguments]")
+            return errors.incorrectArguments("The request body must include the refresh token.")
+
+        try:
+            refresh = RefreshToken(request.data['refresh'])
+        except TokenError:
+            logger.error(f"[Signed Token Logout] [Error - Invalid refresh token]")
+            return errors.invalid_refresh_token()
+        if refresh['user_id'] != request.user.id:
+            logger.error(f"[Signed Token Logout] [Error - Refresh token belongs to another user]")
+            return errors.invalid_refresh_token()
+
+        signed_tokens.denylist.deny(refresh)
+        signed_tokens.denylist.deny(request.auth)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
 def user_delete_callback(sender, **kwargs):
-    userModel = get_user_model()
-    userCount = userModel.objects.count()
     logger = logging.getLogger("watchtower")
-    logger.info(f"[User Deleted] [{userCount}]")
+    # Logged once the population counters have been updated
+    transaction.on_commit(lambda: logger.info(f"[User Deleted] [{population.get_totals()['users']}]"))
 
 @receiver(user_registered)
 def user_registered_callback(sender, **kwargs):
-    userModel = get_user_model()
-    userCount = userModel.objects.count()
     logger = logging.getLogger("watchtower")
-    logger.info(f"[User Registered] [{userCount}]")
+    transaction.on_commit(lambda: logger.info(f"[User Registered] [{population.get_totals()['users']}]"))
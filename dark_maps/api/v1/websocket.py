@@ -0,0 +1,155 @@
+"""
+Pushes new messages to devices over a WebSocket
+"""
+
+import asyncio
+import json
+import logging
+import re
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework.authtoken.models import Token
+
+from dark_maps.api.v1.fanout import get_fanout
+from dark_maps.api.v1.serializers import MESSAGE_COLUMNS, represent_messages
+
+inbox_path = re.compile(r'^/v1/(?P<requestedDeviceregistration_id>[0-9]+)/messages/$')
+
+# Close codes in the range reserved for applications
+CLOSE_NOT_AUTHENTICATED = 4001
+CLOSE_NO_DEVICE = 4004
+CLOSE_DEVICE_CHANGED = 4003
+
+# Seconds a client without an Authorization header has to send its token
+AUTH_FRAME_TIMEOUT = 10
+
+
+def get_token_key(scope):
+    """Reads the token from the Authorization header"""
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            parts = value.decode('latin1').split()
+            if (len(parts) == 2) and (parts[0].lower() == 'token'):
+                return parts[1]
+    return None
+
+
+async def receive_token_key(receive):
+    """
+    Reads the token from the first frame, {"token": "<key>"}, for clients such
+    as browsers that cannot set headers. Tokens are never read from the URL as
+    URLs are written to proxy and access logs.
+    """
+    try:
+        event = await asyncio.wait_for(receive(), AUTH_FRAME_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    if event['type'] != 'websocket.receive':
+        return None
+    try:
+        token_key = json.loads(event.get('text') or '')['token']
+    except (ValueError, KeyError, TypeError):
+        return None
+    return token_key if isinstance(token_key, str) else None
+
+
+def get_device(token_key):
+    """Returns (user, device) for a token, with device None if it has not been registered"""
+    try:
+        token = Token.objects.select_related('user__device').get(key=token_key)
+    except Token.DoesNotExist:
+        return None, None
+    if not token.user.is_active:
+        return None, None
+    return token.user, getattr(token.user, 'device', None)
+
+
+def get_backlog(device, after):
+    """Returns the next MESSAGE_PAGE_SIZE waiting messages after the ID `after`"""
+    rows = device.received_messages.unexpired().filter(id__gt=after).order_by('id').values_list(*MESSAGE_COLUMNS)[:settings.MESSAGE_PAGE_SIZE]
+    return represent_messages(rows, device)
+
+
+async def inbox_websocket(scope, receive, send):
+    logger = logging.getLogger("watchtower")
+
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    match = inbox_path.match(scope['path'])
+    token_key = get_token_key(scope)
+    accepted = False
+    if token_key is None:
+        # The token follows in the first frame, which can only be sent once accepted
+        await send({'type': 'websocket.accept'})
+        accepted = True
+        token_key = await receive_token_key(receive)
+    user, device = (None, None)
+    if token_key:
+        user, device = await sync_to_async(get_device)(token_key)
+    if user is None:
+        logger.error(f"[Inbox WebSocket] [Error - Not authenticated]")
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_AUTHENTICATED})
+        return
+    if device is None:
+        logger.error(f"[Inbox WebSocket] [Error - User has no device]")
+        await send({'type': 'websocket.close', 'code': CLOSE_NO_DEVICE})
+        return
+    if int(match.group('requestedDeviceregistration_id')) != device.registration_id:
+        logger.error(f"[Inbox WebSocket] [Error - Device changed]")
+        await send({'type': 'websocket.close', 'code': CLOSE_DEVICE_CHANGED})
+        return
+
+    if not accepted:
+        await send({'type': 'websocket.accept'})
+    logger.info(f"[Inbox WebSocket] [Connected]")
+
+    # Subscribe before reading the backlog so nothing stored in between is missed
+    async with get_fanout().subscribe(device.id) as subscription:
+        # Send the waiting messages a page at a time, as the HTTP endpoint does
+        after = 0
+        # Messages can commit out of ID order, so pushes are only checked
+        # against what the backlog sent rather than against the highest ID
+        backlog_ids = set()
+        while True:
+            backlog = await sync_to_async(get_backlog)(device, after)
+            for message in backlog:
+                await send({'type': 'websocket.send', 'text': json.dumps(message)})
+                backlog_ids.add(message['id'])
+                after = message['id']
+            if len(backlog) < settings.MESSAGE_PAGE_SIZE:
+                break
+
+        receive_task = asyncio.ensure_future(receive())
+        message_task = asyncio.ensure_future(subscription.get())
+        try:
+            while True:
+                done, _ = await asyncio.wait({receive_task, message_task}, return_when=asyncio.FIRST_COMPLETED)
+                if receive_task in done:
+                    if receive_task.result()['type'] == 'websocket.disconnect':
+                        break
+                    # Clients acknowledge messages over HTTP, anything they send here is ignored
+                    receive_task = asyncio.ensure_future(receive())
+                if message_task in done:
+                    message = message_task.result()
+                    if message['id'] in backlog_ids:
+                        # Each message is pushed once, so it will not be seen again
+                        backlog_ids.discard(message['id'])
+                    else:
+                        await send({'type': 'websocket.send', 'text': json.dumps(message)})
+                    message_task = asyncio.ensure_future(subscription.get())
+        finally:
+            receive_task.cancel()
+            message_task.cancel()
+    logger.info(f"[Inbox WebSocket] [Disconnected]")
+
+
+async def websocket_application(scope, receive, send):
+    """Routes WebSocket connections, refusing any path without a handler"""
+    if inbox_path.match(scope['path']):
+        await inbox_websocket(scope, receive, send)
+        return
+    await receive()
+    await send({'type': 'websocket.close'})
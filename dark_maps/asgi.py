@@ -0,0 +1,32 @@
+"""
+ASGI config for dark_maps project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests are handled by Django, WebSocket connections by the v1 API's
+WebSocket handlers. Long-polling inbox fetches wait on the event loop before
+reaching Django.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dark_maps.settings')
+
+django_application = get_asgi_application()
+
+# Imported once Django is set up as the handlers use the ORM
+from dark_maps.api.v1.websocket import websocket_application
+from dark_maps.api.v1.long_poll import long_poll, requested_wait
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    elif (scope['type'] == 'http') and requested_wait(scope):
+        await long_poll(scope, receive, send, django_application)
+    else:
+        await django_application(scope, receive, send)
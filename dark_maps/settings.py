@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+from datetime import timedelta
 from boto3.session import Session
 import django_heroku
 import dj_database_url
@@ -52,6 +53,7 @@ INSTALLED_APPS = [
 SITE_ID = 1
 
 MIDDLEWARE = [
+    'dark_maps.api.v1.middleware.instrumentation_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'dark_maps.api.v1.middleware.x_robots_middleware',
@@ -94,6 +96,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'dark_maps.wsgi.application'
+ASGI_APPLICATION = 'dark_maps.asgi.application'
 DEFAULT_AUTO_FIELD='django.db.models.AutoField'
 
 
@@ -171,12 +174,32 @@ STATIC_ROOT = 'static/'
 
 # Rest framework
 # http://www.django-rest-framework.org/api-guide/settings/
+# "orjson" renders and parses request and response bodies with orjson, the output is identical, see dark_maps/api/v1/renderers.py
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'json')
+if JSON_BACKEND == 'orjson':
+    JSON_RENDERER_CLASS = 'dark_maps.api.v1.renderers.ORJSONRenderer'
+    JSON_PARSER_CLASS = 'dark_maps.api.v1.renderers.ORJSONParser'
+else:
+    JSON_RENDERER_CLASS = 'rest_framework.renderers.JSONRenderer'
+    JSON_PARSER_CLASS = 'rest_framework.parsers.JSONParser'
 REST_FRAMEWORK = {
+    # JSON stays the default, MessagePack is used when a client asks for application/msgpack
+    'DEFAULT_RENDERER_CLASSES': (
+        JSON_RENDERER_CLASS,
+        'dark_maps.api.v1.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        JSON_PARSER_CLASS,
+        'dark_maps.api.v1.renderers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'dark_maps.api.v1.authentication.CachedTokenAuthentication',
     ),
     'DEFAULT_THROTTLE_CLASSES': (
         'rest_framework.throttling.AnonRateThrottle',
@@ -194,6 +217,45 @@ REST_FRAMEWORK = {
     'ALLOWED_VERSIONS': ['v1'],
 }
 
+# Authentication
+# Seconds a token, its user and their device are cached for, changes to any of them remove the entry sooner
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.environ.get('AUTH_TOKEN_CACHE_TIMEOUT', 60))
+# Signed access tokens carry the user's device and are checked without any lookup, see dark_maps/api/v1/signed_tokens.py
+SIGNED_TOKENS_ENABLED = os.environ.get('SIGNED_TOKENS_ENABLED', 'false').lower() == 'true'
+# Seconds before a revoked signed token is refused by every process
+SIGNED_TOKEN_DENYLIST_REFRESH = int(os.environ.get('SIGNED_TOKEN_DENYLIST_REFRESH', 5))
+SIMPLE_JWT = {
+    'ACCESS_TOKEN_LIFETIME': timedelta(minutes=int(os.environ.get('SIGNED_ACCESS_TOKEN_MINUTES', 5))),
+    'REFRESH_TOKEN_LIFETIME': timedelta(days=int(os.environ.get('SIGNED_REFRESH_TOKEN_DAYS', 14))),
+    'AUTH_HEADER_TYPES': ('Bearer',),
+}
+
+# Messages
+# Default and maximum page sizes when a client fetches its inbox with ?after= / ?limit=
+MESSAGE_PAGE_SIZE = int(os.environ.get('MESSAGE_PAGE_SIZE', 100))
+MESSAGE_PAGE_MAX_SIZE = int(os.environ.get('MESSAGE_PAGE_MAX_SIZE', 1000))
+# Longest time, in seconds, a client may park an inbox fetch with ?wait=
+MESSAGE_LONG_POLL_MAX_WAIT = int(os.environ.get('MESSAGE_LONG_POLL_MAX_WAIT', 30))
+# Most long polls each WSGI process parks at once, each holds a worker thread so keep it below gunicorn's --threads
+MESSAGE_LONG_POLL_MAX_WAITERS = int(os.environ.get('MESSAGE_LONG_POLL_MAX_WAITERS', 8))
+# Delivers new messages to WebSocket connections, see dark_maps/api/v1/fanout.py
+MESSAGE_FANOUT_BACKEND = os.environ.get('MESSAGE_FANOUT_BACKEND', 'dark_maps.api.v1.fanout.InMemoryFanout')
+# Days an unfetched message is kept for before the purge deletes it, 0 keeps messages until fetched
+MESSAGE_RETENTION_DAYS = int(os.environ.get('MESSAGE_RETENTION_DAYS', 30))
+# Most messages the purge deletes in one transaction, and the seconds it pauses between batches
+MESSAGE_PURGE_BATCH_SIZE = int(os.environ.get('MESSAGE_PURGE_BATCH_SIZE', 5000))
+MESSAGE_PURGE_PAUSE = float(os.environ.get('MESSAGE_PURGE_PAUSE', 0.5))
+
+# Keys
+# Most recipients a client may request prekey bundles for in one request
+PREKEY_BUNDLE_BATCH_MAX_SIZE = int(os.environ.get('PREKEY_BUNDLE_BATCH_MAX_SIZE', 100))
+
+# Instrumentation
+# Requests running more database queries than this are logged as a warning
+REQUEST_QUERY_BUDGET = int(os.environ.get('REQUEST_QUERY_BUDGET', 20))
+# Bearer token Prometheus must send to scrape /metrics, the endpoint is hidden when unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', None)
+
 # Only using REST framework, therefore safe
 CORS_ORIGIN_ALLOW_ALL = True
 
@@ -274,11 +336,19 @@ if os.environ.get('MEMCACHE_LOCATION', False):
     CACHES = memcache_settings
 else:
     CACHES = local_cache_settings
+# Seconds recipient device lookups are cached for, 0 disables the cache. Changes only clear the
+# cache of the process making them, so a per-process cache is kept for a few seconds only
+DEVICE_DIRECTORY_TIMEOUT = int(os.environ.get('DEVICE_DIRECTORY_TIMEOUT', 3600 if os.environ.get('MEMCACHE_LOCATION', False) else 5))
 
 
 CLOUDWATCH_AWS_ID = os.environ.get('CLOUDWATCH_AWS_ID', None)
 CLOUDWATCH_AWS_KEY = os.environ.get('CLOUDWATCH_AWS_KEY', None)
 CLOUDWATCH_AWS_DEFAULT_REGION = os.environ.get('CLOUDWATCH_AWS_DEFAULT_REGION', None)
+# Records waiting to be shipped, INFO records are sampled and then dropped as the queue fills
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Most records sent to CloudWatch at once, and the longest a record waits for a batch to fill
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 100))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 1.0))
 if CLOUDWATCH_AWS_ID != None:
     logger_boto3_session = Session(
         aws_access_key_id=CLOUDWATCH_AWS_ID,
@@ -297,12 +367,19 @@ if CLOUDWATCH_AWS_ID != None:
         "handlers": {
             "watchtower": {
                 "level": "INFO",
-                "class": "watchtower.CloudWatchLogHandler",
-                # From step 2
-                "boto3_session": logger_boto3_session,
-                "log_group": "DarkMaps",
-                # Different stream for each environment
-                "stream_name": f"Lightsail",
+                # Records are shipped in batches from a background thread, see dark_maps/api/v1/log_shipping.py
+                "class": "dark_maps.api.v1.log_shipping.QueuedBatchHandler",
+                "target": {
+                    "class": "watchtower.CloudWatchLogHandler",
+                    # From step 2
+                    "boto3_session": logger_boto3_session,
+                    "log_group": "DarkMaps",
+                    # Different stream for each environment
+                    "stream_name": f"Lightsail",
+                },
+                "queue_size": LOG_QUEUE_SIZE,
+                "batch_size": LOG_BATCH_SIZE,
+                "flush_interval": LOG_FLUSH_INTERVAL,
                 "formatter": "aws",
             },
             "console": {"class": "logging.StreamHandler", "formatter": "aws",},
@@ -25,7 +25,10 @@ from . import views
 urlpatterns = [
     url(r'^v1/', include((v1_urlpatterns, 'v1'), namespace='v1')),
     # Admin URLs
+    path('admin/population/', views.population_view),
     path('admin/', admin.site.urls),
+    # Prometheus scrape endpoint
+    path('metrics', views.metrics_view),
     # Required for health check
     url('', views.index)
 ]
@@ -1,4 +1,28 @@
-from django.http import HttpResponse
+import hmac
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, Http404, JsonResponse
+from django.views.decorators.http import require_http_methods
+
+from dark_maps.api.v1 import metrics, population
 
 def index(request):
     return HttpResponse("Nothing here")
+
+def metrics_view(request):
+    # Hidden unless a scrape token has been configured
+    if not settings.METRICS_TOKEN:
+        raise Http404()
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f"Bearer {settings.METRICS_TOKEN}"):
+        return HttpResponse(status=401)
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
+
+@staff_member_required
+@require_http_methods(["GET", "POST"])
+def population_view(request):
+    # POST recounts the tables, GET only reads the running totals
+    if request.method == 'POST':
+        return JsonResponse(population.reconcile())
+    return JsonResponse(population.get_totals())
@@ -0,0 +1,21 @@
+"""
+Gunicorn hooks which keep the Prometheus metrics of every worker in the
+PROMETHEUS_MULTIPROC_DIR directory, see dark_maps/api/v1/metrics.py
+"""
+
+import os
+import shutil
+
+
+def on_starting(server):
+    # Samples left by a previous run would be added to the new totals
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def worker_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,251 @@
+"""
+Load test for the v1 API
+
+Simulates messaging devices against a running server. Each device signs up,
+logs in and registers itself, then until the run ends it sends messages to
+the other devices, fetches their prekey bundles, polls and acknowledges its
+inbox and refills its prekeys when they run low. Throughput and latency
+percentiles are reported for each endpoint.
+
+Run the server with the development settings, whose throttles allow the
+request rate, for example:
+
+    python manage.py runserver --settings=dark_maps.development_settings --noreload
+    python loadtest.py --url http://127.0.0.1:8000 --devices 20 --duration 60
+
+Users are deleted once the run ends unless --keep is given.
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import requests
+
+IDENTITY_KEY_BYTES = 33
+SIGNATURE_BYTES = 66
+PREKEY_BATCH = 20
+# Refill once fewer prekeys than this are left
+PREKEY_LOW_WATER = 10
+CIPHERTEXT_BYTES = 200
+POLL_LIMIT = 100
+
+# Relative frequency of each action in the steady state
+ACTION_WEIGHTS = {'send': 5, 'poll': 3, 'bundle': 2}
+
+
+def random_key(length):
+    return base64.b64encode(os.urandom(length)).decode()
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    rank = max(1, math.ceil(fraction * len(values)))
+    return values[rank - 1]
+
+
+class Stats:
+    """Latencies and status codes of every request, grouped by endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.started = None
+        self.finished = None
+
+    def record(self, endpoint, status, latency):
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][status] += 1
+
+    def summary(self):
+        """Returns one row for each endpoint, latencies in milliseconds"""
+        elapsed = (self.finished or time.monotonic()) - self.started
+        rows = {}
+        with self._lock:
+            for endpoint, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                statuses = dict(self.statuses[endpoint])
+                rows[endpoint] = {
+                    'requests': len(latencies),
+                    'throughput': round(len(latencies) / elapsed, 2),
+                    'errors': sum(count for status, count in statuses.items() if (status is None) or (status >= 400)),
+                    'p50': round(percentile(latencies, 0.50) * 1000, 2),
+                    'p95': round(percentile(latencies, 0.95) * 1000, 2),
+                    'p99': round(percentile(latencies, 0.99) * 1000, 2),
+                    'statuses': {str(status): count for status, count in statuses.items()},
+                }
+        return {'elapsed': round(elapsed, 2), 'endpoints': rows}
+
+
+class SimulatedDevice:
+    def __init__(self, url, stats, index, run_id):
+        self.url = url.rstrip('/')
+        self.stats = stats
+        self.session = requests.Session()
+        self.email = f"loadtest-{run_id}-{index}@example.com"
+        self.password = uuid.uuid4().hex
+        self.address = f"{self.email}.1"
+        self.registration_id = random.randint(1, 999999)
+        self.next_key_id = 1
+        self.prekeys_remaining = 0
+
+    def request(self, endpoint, method, path, **kwargs):
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, self.url + path, timeout=30, **kwargs)
+        except requests.RequestException:
+            self.stats.record(endpoint, None, time.monotonic() - started)
+            return None
+        self.stats.record(endpoint, response.status_code, time.monotonic() - started)
+        remaining = response.headers.get('X-Prekeys-Remaining')
+        if remaining is not None:
+            self.prekeys_remaining = int(remaining)
+        return response
+
+    def new_prekeys(self, count):
+        keys = [{'key_id': key_id, 'public_key': random_key(IDENTITY_KEY_BYTES)} for key_id in range(self.next_key_id, self.next_key_id + count)]
+        self.next_key_id += count
+        return keys
+
+    def setup(self):
+        """Signs up, logs in and registers the device, returns whether all three succeeded"""
+        credentials = {'email': self.email, 'password': self.password}
+        response = self.request('sign up', 'POST', '/v1/auth/users/', json=credentials)
+        if (response is None) or (response.status_code != 201):
+            return False
+        response = self.request('log in', 'POST', '/v1/auth/login/', json=credentials)
+        if (response is None) or (response.status_code != 200):
+            return False
+        self.session.headers['Authorization'] = f"Token {response.json()['auth_token']}"
+        response = self.request('register device', 'POST', '/v1/devices/', json={
+            'address': self.address,
+            'identity_key': random_key(IDENTITY_KEY_BYTES),
+            'registration_id': self.registration_id,
+            'pre_keys': self.new_prekeys(PREKEY_BATCH),
+            'signed_pre_key': {'key_id': 1, 'public_key': random_key(IDENTITY_KEY_BYTES), 'signature': random_key(SIGNATURE_BYTES)}
+        })
+        if (response is None) or (response.status_code != 201):
+            return False
+        self.prekeys_remaining = PREKEY_BATCH
+        return True
+
+    def refill(self):
+        self.request('refill prekeys', 'POST', f'/v1/{self.registration_id}/prekeys/', json=self.new_prekeys(PREKEY_BATCH))
+
+    def fetch_bundle(self, peer):
+        address = peer.address.encode().hex()
+        self.request('fetch bundle', 'GET', f'/v1/prekeybundles/{address}/{self.registration_id}/')
+
+    def send(self, peer):
+        self.request('send message', 'POST', f'/v1/{self.registration_id}/messages/', json={
+            'recipient': peer.email,
+            'registration_id': peer.registration_id,
+            'ciphertext': random_key(CIPHERTEXT_BYTES)
+        })
+
+    def poll(self):
+        response = self.request('poll inbox', 'GET', f'/v1/{self.registration_id}/messages/', params={'limit': POLL_LIMIT, 'envelope': 2})
+        if (response is None) or (response.status_code != 200):
+            return
+        ids = [message['id'] for message in response.json()['results']]
+        if ids:
+            self.request('acknowledge messages', 'DELETE', f'/v1/{self.registration_id}/messages/', json=ids)
+
+    def run(self, peers, deadline):
+        actions = list(ACTION_WEIGHTS)
+        weights = list(ACTION_WEIGHTS.values())
+        while time.monotonic() < deadline:
+            if self.prekeys_remaining < PREKEY_LOW_WATER:
+                self.refill()
+                continue
+            action = random.choices(actions, weights)[0]
+            if action == 'poll':
+                self.poll()
+            elif action == 'send':
+                self.send(random.choice(peers))
+            else:
+                self.fetch_bundle(random.choice(peers))
+
+    def teardown(self):
+        self.request('delete user', 'DELETE', '/v1/auth/users/me/', json={'current_password': self.password})
+
+
+def run_threads(target, items):
+    threads = [threading.Thread(target=target, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run(url, devices=10, duration=30, keep=False):
+    """Runs the load test and returns the summary of the steady state"""
+    stats = Stats()
+    run_id = uuid.uuid4().hex[:8]
+    simulated = [SimulatedDevice(url, stats, index, run_id) for index in range(devices)]
+
+    stats.started = time.monotonic()
+    ready = []
+    def setup(device):
+        if device.setup():
+            ready.append(device)
+    run_threads(setup, simulated)
+    setup_summary = stats.summary()
+    if len(ready) < 2:
+        raise RuntimeError(f"Only {len(ready)} of {devices} devices could register, see the errors in {json.dumps(setup_summary)}")
+
+    # The steady state is reported separately from sign up and registration
+    steady = Stats()
+    for device in ready:
+        device.stats = steady
+    steady.started = time.monotonic()
+    deadline = steady.started + duration
+    run_threads(lambda device: device.run([peer for peer in ready if peer is not device], deadline), ready)
+    steady.finished = time.monotonic()
+
+    if not keep:
+        for device in simulated:
+            device.stats = stats
+        run_threads(SimulatedDevice.teardown, simulated)
+
+    return {'devices': len(ready), 'setup': setup_summary, 'steady': steady.summary()}
+
+
+def print_table(title, summary, out):
+    out.write(f"\n{title} ({summary['elapsed']}s)\n")
+    out.write(f"{'endpoint':<22}{'requests':>10}{'req/s':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}\n")
+    for endpoint, row in summary['endpoints'].items():
+        out.write(f"{endpoint:<22}{row['requests']:>10}{row['throughput']:>10}{row['errors']:>8}{row['p50']:>10}{row['p95']:>10}{row['p99']:>10}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulates messaging devices against a running server")
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help="Server to test")
+    parser.add_argument('--devices', type=int, default=10, help="Devices to simulate, each in its own thread")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to run once every device has registered")
+    parser.add_argument('--keep', action='store_true', help="Keep the users created by the run")
+    parser.add_argument('--json', help="Also write the results to this file, to compare runs")
+    args = parser.parse_args(argv)
+
+    results = run(args.url, devices=args.devices, duration=args.duration, keep=args.keep)
+    print_table('Setup', results['setup'], sys.stdout)
+    print_table(f"Steady state, {results['devices']} devices", results['steady'], sys.stdout)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
 # Start Gunicorn processes
 echo Starting Gunicorn.
+# Workers share their metrics through this directory
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/dark_maps_metrics}
 exec gunicorn dark_maps.wsgi:application \
+    --config gunicorn.conf.py \
     --bind 0.0.0.0:8000 \
-    --workers 3
+    --workers 3 \
+    --worker-class gthread \
+    --threads 16